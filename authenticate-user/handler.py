@@ -1,27 +1,66 @@
 import os
 import json
-import pymysql
 import base64
-import pyotp
+import logging
 import time
 
+try:
+    from .common import aiopool, asgi, breaker, credcache, hashing, lazy, metrics, pool, userfilter, versions, warmup, writebehind
+except ImportError:
+    from common import aiopool, asgi, breaker, credcache, hashing, lazy, metrics, pool, userfilter, versions, warmup, writebehind
 
-def get_db_connection():
+pyotp = lazy.module("pyotp")
+
+log = logging.getLogger(__name__)
+
+BATCH_MAX_SIZE = int(os.environ.get("AUTH_BATCH_MAX_SIZE", 500))
+# Deployments running the expire-credentials sweeper can turn the
+# login-time write off: the sweeper flags every overdue account
+MARK_EXPIRED_ON_LOGIN = os.environ.get("MARK_EXPIRED_ON_LOGIN", "1") != "0"
+EXPIRY_SECONDS = 6 * 30 * 24 * 60 * 60
+# Legacy base64 rows, and hashes weaker than the current cost, are hashed
+# again after a successful login
+REHASH_ON_LOGIN = os.environ.get("PASSWORD_REHASH_ON_LOGIN", "1") != "0"
+
+EXPIRED_RESULT = {"status": "expired", "message": "Password and MFA expired. Please reset credentials."}
+NOT_FOUND_RESULT = {"status": "auth_failed", "message": "User not found"}
+MISSING_PARAMS_RESULT = {"status": "error", "message": "Missing parameters"}
+INVALID_PASSWORD_RESULT = {"status": "auth_failed", "message": "Invalid password"}
+
+FETCH_USER_SQL = "SELECT password, mfa, gendate, expired FROM users WHERE username = %s"
+# Compare-and-set: a rotation racing with the login keeps its new password
+UPGRADE_PASSWORD_SQL = "UPDATE users SET password = %s WHERE username = %s AND password = %s"
+
+
+def get_db_connection(usernames):
+    """
+    Borrow a connection to the MariaDB database holding the rows of `usernames`.
+
+    It comes from the worker's shared pool, or from the pool of the shard
+    owning them when `DB_SHARDS` is set.
+
+    Returns
+    -------
+    contextmanager
+        Yields an active connection and hands it back to the pool on exit.
     """
-    Establish a connection to the MariaDB database using credentials
-    and host information from environment variables.
+    return pool.connection(usernames)
+
+
+def get_read_connection(usernames):
+    """
+    Borrow a connection for reading the rows of `usernames`.
+
+    It comes from a read replica when `DB_READ_HOSTS` is set, unless one of
+    the users changed their credentials within the replica staleness window,
+    and from the shard owning them when `DB_SHARDS` is set.
 
     Returns
     -------
-    pymysql.Connection
-        An active connection object to the MariaDB database.
+    contextmanager
+        Yields an active connection and hands it back to its pool on exit.
     """
-    return pymysql.connect(
-        host=os.environ['DB_HOST'],
-        user=os.environ['DB_USER'],
-        password=os.environ['DB_PASSWORD'],
-        database=os.environ['DB_NAME']
-    )
+    return pool.read_connection(usernames)
 
 
 def decode_b64(value):
@@ -56,8 +95,18 @@ def is_expired(gendate_timestamp):
         True if credentials are expired, False otherwise.
     """
     now = int(time.time())
-    six_months = 6 * 30 * 24 * 60 * 60
-    return (now - int(gendate_timestamp)) > six_months
+    return (now - int(gendate_timestamp)) > EXPIRY_SECONDS
+
+
+def fetch_users_sql(count):
+    placeholders = ", ".join(["%s"] * count)
+    return f"SELECT username, password, mfa, gendate, expired FROM users WHERE username IN ({placeholders})"
+
+
+def mark_expired_many_sql(count):
+    # Guarded by `gendate`: a flush landing after a password reset leaves the new credentials alone
+    placeholders = ", ".join(["%s"] * count)
+    return f"UPDATE users SET expired = 1 WHERE expired = 0 AND gendate < %s AND username IN ({placeholders})"
 
 
 def fetch_user(username):
@@ -74,27 +123,292 @@ def fetch_user(username):
     tuple or None
         A tuple containing (password, mfa, gendate, expired) or None if user is not found.
     """
-    connection = get_db_connection()
-    with connection:
+    with get_read_connection((username,)) as connection, metrics.phase("db_query"):
         with connection.cursor() as cursor:
-            cursor.execute("SELECT password, mfa, gendate, expired FROM users WHERE username = %s", (username,))
+            cursor.execute(FETCH_USER_SQL, (username,))
             return cursor.fetchone()
 
 
+def fetch_users(usernames):
+    """
+    Retrieve the details of several users with a single query.
+
+    Parameters
+    ----------
+    usernames : list of str
+        Distinct usernames to fetch.
+
+    Returns
+    -------
+    dict
+        Maps each username found to its (password, mfa, gendate, expired) tuple.
+    """
+    found = {}
+    # One query per shard holding some of them
+    for group in pool.group(usernames).values():
+        with get_read_connection(group) as connection, metrics.phase("db_query"):
+            with connection.cursor() as cursor:
+                cursor.execute(fetch_users_sql(len(group)), tuple(group))
+                found.update((row[0], row[1:]) for row in cursor.fetchall())
+    return found
+
+
+def write_expired(usernames):
+    """
+    Flag several users as expired with a single `UPDATE` statement per shard.
+
+    Flush function of the `expired` write-behind queue: runs on the queue's
+    thread, never on a request. Users whose credentials were reset since
+    they were queued, or already flagged, are left untouched.
+
+    Parameters
+    ----------
+    usernames : list of str
+        Distinct usernames found expired at login.
+
+    Returns
+    -------
+    int
+        The number of rows flagged.
+    """
+    cutoff = int(time.time()) - EXPIRY_SECONDS
+    total = 0
+    for group in pool.group(usernames).values():
+        with get_db_connection(group) as connection, metrics.phase("db_write"):
+            connection.begin()
+            with connection.cursor() as cursor:
+                flagged = cursor.execute(mark_expired_many_sql(len(group)), (cutoff, *group))
+                if not flagged:
+                    connection.rollback()
+                    continue
+                versions.bump(cursor)
+            connection.commit()
+        total += flagged
+    return total
+
+
+def get_expiry_queue():
+    """Return the worker-wide write-behind queue of the expiry flags, flushed by `write_expired`."""
+    return writebehind.get_queue("expired", write_expired)
+
+
 def mark_expired(username):
     """
-    Update the user’s status to 'expired' in the database.
+    Queue the user’s status change to 'expired'.
+
+    The `UPDATE` is issued later, batched with the other transitions seen by
+    this worker (see `common.writebehind`). Losing it is harmless: the next
+    login, or the `expire-credentials` sweeper, finds the account expired again.
 
     Parameters
     ----------
     username : str
         The username to be marked as expired.
     """
-    connection = get_db_connection()
-    with connection:
-        with connection.cursor() as cursor:
-            cursor.execute("UPDATE users SET expired = 1 WHERE username = %s", (username,))
-        connection.commit()
+    get_expiry_queue().add(username)
+
+
+def check_expiry(username, creds):
+    """
+    Tell whether a login must be refused as expired.
+
+    The stored `expired` flag settles it without any write. Credentials
+    found past their lifetime are flagged on the cached object, so the next
+    attempts take the same short path, and queued for `write_expired`.
+
+    Returns
+    -------
+    bool
+        True if the credentials are expired.
+    """
+    if creds.expired:
+        return True
+    if not is_expired(creds.gendate):
+        return False
+    creds.expired = 1
+    if MARK_EXPIRED_ON_LOGIN:
+        mark_expired(username)
+    return True
+
+
+def build_credentials(row):
+    """
+    Decode a `(password, mfa, gendate, expired)` row into ready-to-use credentials.
+
+    Returns
+    -------
+    credcache.Credentials
+        Password verifier (a parsed `hashing.PasswordHash`, or the decoded
+        plaintext of a legacy base64 row), `pyotp.TOTP` verifier and expiry fields.
+    """
+    db_password, mfa_enc, gendate, expired = row
+    with metrics.phase("decode"):
+        return credcache.Credentials(
+            password=hashing.PasswordHash.parse(db_password) if hashing.is_hash(db_password) else decode_b64(db_password),
+            totp=pyotp.TOTP(decode_b64(mfa_enc)),
+            gendate=gendate,
+            expired=expired
+        )
+
+
+def load_credentials(username):
+    """
+    Return the decoded credentials of a user, from the cache when possible.
+
+    On a cache miss the row is read with `fetch_user`, the password and MFA
+    secret are decoded and a `pyotp.TOTP` verifier is built, then the result
+    is cached for the next logins. Names that `common.userfilter` knows to be
+    unknown are rejected without a query.
+
+    Parameters
+    ----------
+    username : str
+        The user's login.
+
+    Returns
+    -------
+    credcache.Credentials or None
+        The decoded credentials, or None if the user does not exist.
+    """
+    cache = credcache.get_cache()
+    cache.sync(pool.partitions())
+    creds = cache.get(username)
+    if creds is None:
+        known = userfilter.get_known_users()
+        if known is not None and not known.might_exist(username):
+            return None
+        user = fetch_user(username)
+        if not user:
+            if known is not None:
+                known.record_missing(username)
+            return None
+        creds = build_credentials(user)
+        cache.put(username, creds)
+    return creds
+
+
+def load_credentials_many(usernames):
+    """
+    Return the decoded credentials of several users.
+
+    Cached users are served from memory; all the others are read with one
+    `fetch_users` query.
+
+    Parameters
+    ----------
+    usernames : set of str
+        The users' logins.
+
+    Returns
+    -------
+    dict
+        Maps each existing username to its `credcache.Credentials`.
+    """
+    cache = credcache.get_cache()
+    cache.sync(pool.partitions())
+    found = {}
+    missing = []
+    for username in usernames:
+        creds = cache.get(username)
+        if creds is None:
+            missing.append(username)
+        else:
+            found[username] = creds
+    missing = filter_unknown(missing)
+    rows = fetch_users(missing)
+    record_missing(missing, rows)
+    for username, row in rows.items():
+        found[username] = build_credentials(row)
+        cache.put(username, found[username])
+    return found
+
+
+def filter_unknown(usernames):
+    """Drop the names that `common.userfilter` knows not to exist."""
+    known = userfilter.get_known_users()
+    if known is None:
+        return usernames
+    return [username for username in usernames if known.might_exist(username)]
+
+
+def record_missing(usernames, rows):
+    """Feed the names the database did not return to the negative cache."""
+    known = userfilter.get_known_users()
+    if known is not None:
+        for username in usernames:
+            if username not in rows:
+                known.record_missing(username)
+
+
+def stored_password(verifier):
+    """Return the `users.password` value a password verifier was built from."""
+    if isinstance(verifier, hashing.PasswordHash):
+        return verifier.encoded
+    return base64.b64encode(verifier.encode()).decode()
+
+
+def should_rehash(result, creds):
+    """Tell whether a login's stored password must be upgraded (see `upgrade_passwords`)."""
+    return result["status"] == "success" and REHASH_ON_LOGIN and hashing.needs_rehash(creds.password)
+
+
+def upgrade_passwords(upgrades):
+    """
+    Replace legacy or weaker stored passwords by hashes at the current cost.
+
+    Runs after successful logins, the only time the plaintext is known. Each
+    `UPDATE` only applies if the row still holds the value the login was
+    verified against. Best effort: a failure is logged and the logins still
+    succeed; the rows are upgraded at a later login. With `DB_SHARDS`, each
+    shard's rows are upgraded in a transaction of their own.
+
+    Parameters
+    ----------
+    upgrades : list of tuple
+        `(username, password, verifier)` of each user who just logged in:
+        the password they typed and the verifier it was checked against.
+    """
+    if not upgrades:
+        return
+    try:
+        new_hashes = hashing.hash_passwords([password for _, password, _ in upgrades])
+        rows = {username: (new_hash, username, stored_password(verifier))
+                for new_hash, (username, _, verifier) in zip(new_hashes, upgrades)}
+        for group in pool.group(rows).values():
+            with get_db_connection(group) as connection, metrics.phase("db_write"):
+                connection.begin()
+                with connection.cursor() as cursor:
+                    cursor.executemany(UPGRADE_PASSWORD_SQL, [rows[username] for username in group])
+                    credcache.publish_invalidations(cursor, group)
+                connection.commit()
+    except Exception:
+        log.warning("could not upgrade the password hashes of %s", [u for u, _, _ in upgrades], exc_info=True)
+
+
+def check_otp(creds, otp_code):
+    """Return the result of a login whose password was verified."""
+    with metrics.phase("totp_verify"):
+        valid = creds.totp.verify(otp_code, valid_window=1)
+    if not valid:
+        return {"status": "auth_failed", "message": "Invalid 2FA code"}
+
+    return {"status": "success", "message": "Authentication successful"}
+
+
+def verify_credentials(creds, password, otp_code):
+    """
+    Check a password and TOTP code against decoded, non-expired credentials.
+
+    Hashed passwords are verified in the `common.hashing` pool.
+
+    Returns
+    -------
+    dict
+        A JSON-serializable dictionary with `status` and `message`.
+    """
+    if not hashing.verify(password, creds.password):
+        return dict(INVALID_PASSWORD_RESULT)
+    return check_otp(creds, otp_code)
 
 
 def authenticate_user(username, password, otp_code):
@@ -115,31 +429,107 @@ def authenticate_user(username, password, otp_code):
     dict
         A JSON-serializable dictionary with `status` and `message`.
     """
-    user = fetch_user(username)
-    if not user:
-        return {"status": "auth_failed", "message": "User not found"}
-
-    db_password_enc, mfa_enc, gendate, expired = user
-    db_password = decode_b64(db_password_enc)
-    mfa_secret = decode_b64(mfa_enc)
+    creds = load_credentials(username)
+    if creds is None:
+        return dict(NOT_FOUND_RESULT)
 
     # Check expiration
-    if is_expired(gendate):
-        mark_expired(username)
-        return {"status": "expired", "message": "Password and MFA expired. Please reset credentials."}
+    if check_expiry(username, creds):
+        return dict(EXPIRED_RESULT)
 
-    # Check password
-    if db_password != password:
-        return {"status": "auth_failed", "message": "Invalid password"}
+    result = verify_credentials(creds, password, otp_code)
+    if should_rehash(result, creds):
+        upgrade_passwords([(username, password, creds.password)])
+    return result
 
-    # Check TOTP
-    totp = pyotp.TOTP(mfa_secret)
-    if not totp.verify(otp_code, valid_window=1):
-        return {"status": "auth_failed", "message": "Invalid 2FA code"}
 
-    return {"status": "success", "message": "Authentication successful"}
+def parse_batch(entries):
+    """Turn batch entries into `(username, password, otp_code)` triples."""
+    triples = []
+    for entry in entries:
+        entry = entry if isinstance(entry, dict) else {}
+        triples.append((entry.get("username"), entry.get("password"), entry.get("otp_code")))
+    return triples
 
 
+def check_batch(triples, creds_by_user):
+    """
+    Settle the batch entries that need no password check.
+
+    Returns
+    -------
+    tuple
+        The list of results, in order, with None for the entries whose
+        password must be verified; and those entries, as
+        `(index, username, creds, password, otp_code)`.
+    """
+    results = []
+    pending = []
+    for username, password, otp_code in triples:
+        if not username or not password or not otp_code:
+            results.append(dict(MISSING_PARAMS_RESULT))
+            continue
+        creds = creds_by_user.get(username)
+        if creds is None:
+            results.append(dict(NOT_FOUND_RESULT))
+        elif check_expiry(username, creds):
+            results.append(dict(EXPIRED_RESULT))
+        else:
+            pending.append((len(results), username, creds, password, otp_code))
+            results.append(None)
+    return results, pending
+
+
+def complete_batch(results, pending, verified):
+    """
+    Fill in the results of the `pending` entries from their password checks.
+
+    Returns
+    -------
+    list of tuple
+        `(username, password, verifier)` of the logins to pass to `upgrade_passwords`.
+    """
+    upgrades = {}
+    for (index, username, creds, password, otp_code), valid in zip(pending, verified):
+        results[index] = check_otp(creds, otp_code) if valid else dict(INVALID_PASSWORD_RESULT)
+        if should_rehash(results[index], creds):
+            upgrades[username] = (username, password, creds.password)
+    return list(upgrades.values())
+
+
+def authenticate_users(entries):
+    """
+    Authenticate a batch of users with one read query and no write but the hash upgrades.
+
+    Parameters
+    ----------
+    entries : list of dict
+        Each entry holds `username`, `password` and `otp_code`.
+
+    Returns
+    -------
+    list of dict
+        One result per entry, in order, in the format of `authenticate_user`.
+    """
+    triples = parse_batch(entries)
+    creds_by_user = load_credentials_many({t[0] for t in triples if all(t)})
+    results, pending = check_batch(triples, creds_by_user)
+    verified = hashing.verify_many([(password, creds.password) for _, _, creds, password, _ in pending])
+    upgrade_passwords(complete_batch(results, pending, verified))
+    return results
+
+
+def batch_error(entries):
+    """Return the error message of an invalid batch, or None."""
+    if not isinstance(entries, list) or not entries:
+        return "credentials must be a non-empty list"
+    if len(entries) > BATCH_MAX_SIZE:
+        return f"batch is limited to {BATCH_MAX_SIZE} entries"
+    return None
+
+
+@warmup.hook("db", "credcache", "userfilter", "hashing", "totp")
+@metrics.instrumented("authenticate-user")
 def handle(req):
     """
     OpenFaaS entry point function that handles a JSON request containing
@@ -148,24 +538,194 @@ def handle(req):
     Parameters
     ----------
     req : str
-        A JSON-formatted string with 'username', 'password', and '2fa_code'.
+        A JSON-formatted string with 'username', 'password', and 'otp_code',
+        or a batch `{"credentials": [{...}, ...]}` of up to `AUTH_BATCH_MAX_SIZE` such triples.
 
     Returns
     -------
     str
-        A JSON-formatted response indicating success or failure.
+        A JSON-formatted response indicating success or failure, or
+        `{"results": [...]}` with one result per batch entry, in order.
+        Over HTTP the body carries a `Server-Timing` header, and `GET /metrics`
+        returns the replica's Prometheus metrics (see `common.metrics`).
+    tuple
+        `(body, 503, headers)` with status `unavailable` while the database
+        circuit breaker is open, `(body, 504, headers)` with status `timeout`
+        once the request deadline is spent (see `common.breaker`).
     """
     try:
         data = json.loads(req)
+
+        if "credentials" in data:
+            error = batch_error(data["credentials"])
+            if error:
+                return json.dumps({"status": "error", "message": error})
+            return json.dumps({"results": authenticate_users(data["credentials"])})
+
         username = data.get("username")
         password = data.get("password")
         otp_code = data.get("otp_code")
 
         if not username or not password or not otp_code:
-            return json.dumps({"status": "error", "message": "Missing parameters"})
+            return json.dumps(MISSING_PARAMS_RESULT)
 
         result = authenticate_user(username, password, otp_code)
         return json.dumps(result)
 
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"status": status, "message": message}), code, headers
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)})
+
+
+# -------------------- ASYNCIO VARIANT --------------------
+#
+# Same flow on a non-blocking MySQL client (`common.aiopool`): a coroutine
+# waiting on MariaDB does not hold a worker thread. TOTP verification and
+# base64 decoding stay on the event loop: they take tens of microseconds,
+# less than a hand-off to an executor would cost. Password hashes are
+# awaited from the `common.hashing` pool.
+
+
+async def fetch_user_async(username):
+    """Same as `fetch_user`, on the asyncio pools."""
+    async with aiopool.read_connection((username,)) as connection:
+        with metrics.phase("db_query"):
+            async with connection.cursor() as cursor:
+                await cursor.execute(FETCH_USER_SQL, (username,))
+                return await cursor.fetchone()
+
+
+async def fetch_users_async(usernames):
+    """Same as `fetch_users`, on the asyncio pools."""
+    found = {}
+    for group in pool.group(usernames).values():
+        async with aiopool.read_connection(group) as connection:
+            with metrics.phase("db_query"):
+                async with connection.cursor() as cursor:
+                    await cursor.execute(fetch_users_sql(len(group)), tuple(group))
+                    found.update((row[0], row[1:]) for row in await cursor.fetchall())
+    return found
+
+
+async def upgrade_passwords_async(upgrades):
+    """Same as `upgrade_passwords`, on the asyncio pool."""
+    if not upgrades:
+        return
+    try:
+        new_hashes = await hashing.hash_passwords_async([password for _, password, _ in upgrades])
+        rows = {username: (new_hash, username, stored_password(verifier))
+                for new_hash, (username, _, verifier) in zip(new_hashes, upgrades)}
+        for group in pool.group(rows).values():
+            async with aiopool.connection(group) as connection:
+                with metrics.phase("db_write"):
+                    await connection.begin()
+                    async with connection.cursor() as cursor:
+                        await cursor.executemany(UPGRADE_PASSWORD_SQL, [rows[username] for username in group])
+                        await credcache.publish_invalidations_async(cursor, group)
+                    await connection.commit()
+    except Exception:
+        log.warning("could not upgrade the password hashes of %s", [u for u, _, _ in upgrades], exc_info=True)
+
+
+async def load_credentials_async(username):
+    """Same as `load_credentials`, on the asyncio pool."""
+    cache = credcache.get_cache()
+    await cache.sync_async(aiopool.partitions())
+    creds = cache.get(username)
+    if creds is None:
+        known = userfilter.get_known_users()
+        if known is not None and not known.might_exist(username):
+            return None
+        user = await fetch_user_async(username)
+        if not user:
+            if known is not None:
+                known.record_missing(username)
+            return None
+        creds = build_credentials(user)
+        cache.put(username, creds)
+    return creds
+
+
+async def load_credentials_many_async(usernames):
+    """Same as `load_credentials_many`, on the asyncio pool."""
+    cache = credcache.get_cache()
+    await cache.sync_async(aiopool.partitions())
+    found = {}
+    missing = []
+    for username in usernames:
+        creds = cache.get(username)
+        if creds is None:
+            missing.append(username)
+        else:
+            found[username] = creds
+    missing = filter_unknown(missing)
+    rows = await fetch_users_async(missing)
+    record_missing(missing, rows)
+    for username, row in rows.items():
+        found[username] = build_credentials(row)
+        cache.put(username, found[username])
+    return found
+
+
+async def authenticate_user_async(username, password, otp_code):
+    """Same as `authenticate_user`, on the asyncio pool."""
+    creds = await load_credentials_async(username)
+    if creds is None:
+        return dict(NOT_FOUND_RESULT)
+    if check_expiry(username, creds):
+        return dict(EXPIRED_RESULT)
+    if not await hashing.verify_async(password, creds.password):
+        return dict(INVALID_PASSWORD_RESULT)
+    result = check_otp(creds, otp_code)
+    if should_rehash(result, creds):
+        await upgrade_passwords_async([(username, password, creds.password)])
+    return result
+
+
+async def authenticate_users_async(entries):
+    """Same as `authenticate_users`, on the asyncio pool."""
+    triples = parse_batch(entries)
+    creds_by_user = await load_credentials_many_async({t[0] for t in triples if all(t)})
+    results, pending = check_batch(triples, creds_by_user)
+    verified = await hashing.verify_many_async([(password, creds.password) for _, _, creds, password, _ in pending])
+    await upgrade_passwords_async(complete_batch(results, pending, verified))
+    return results
+
+
+@metrics.instrumented("authenticate-user")
+async def handle_async(req, method="POST", query=None, headers=None):
+    """
+    Asyncio entry point, with the same request and response bodies as `handle`.
+
+    Served through `app` by an ASGI server (see `common.asgi`); `method`,
+    `query` and `headers` are accepted for the adapter's calling convention
+    and unused.
+    """
+    try:
+        data = json.loads(req)
+
+        if "credentials" in data:
+            error = batch_error(data["credentials"])
+            if error:
+                return json.dumps({"status": "error", "message": error})
+            return json.dumps({"results": await authenticate_users_async(data["credentials"])})
+
+        username = data.get("username")
+        password = data.get("password")
+        otp_code = data.get("otp_code")
+
+        if not username or not password or not otp_code:
+            return json.dumps(MISSING_PARAMS_RESULT)
+
+        return json.dumps(await authenticate_user_async(username, password, otp_code))
+
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"status": status, "message": message}), code, headers
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
+
+
+app = asgi.app_for(handle_async)
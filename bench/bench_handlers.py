@@ -0,0 +1,251 @@
+"""
+Per-function microbenchmarks of the COFRAP handlers.
+
+Every `handle()` is driven against a seeded local stand-in database
+(`bench/standin.py`), and the phases inside the handlers are timed on their
+own: connect, query, base64 decode, password verify, TOTP verify, password generation, QR
+render, PNG encode and JSON serialize.
+
+Results are written as JSON (`--output`, default `bench/results/<git sha>.json`)
+and can be compared with a previous run through `--compare`.
+
+Usage
+-----
+    python bench/bench_handlers.py [--users 10000] [--iterations 500] [--seed 42]
+                                   [--output FILE] [--compare BASELINE.json]
+"""
+import argparse
+import base64
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("ARTIFACT_STORE", "none")
+
+import pymysql.cursors  # noqa: E402
+import pyotp  # noqa: E402
+import qrcode  # noqa: E402
+from flask import Flask  # noqa: E402
+
+from common import hashing, pool, qr, userfilter  # noqa: E402
+from standin import StandInDatabase  # noqa: E402
+from stats import measure  # noqa: E402
+
+HANDLERS = {
+    "authenticate-user": "authenticate_user",
+    "generate-password": "generate_password",
+    "generate-2fa": "generate_2fa",
+    "onboard-user": "onboard_user",
+    "get-users": "get_users",
+}
+
+
+def load_handler(directory):
+    path = os.path.join(ROOT, directory, "handler.py")
+    spec = importlib.util.spec_from_file_location(HANDLERS[directory], path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[HANDLERS[directory]] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_phases(db, modules, iterations):
+    """Time each phase of the handlers in isolation."""
+    auth = modules["authenticate-user"]
+    accounts = db.accounts
+    username, password, secret = accounts[0]
+    encoded = base64.b64encode(password.encode()).decode()
+    verifier = hashing.PasswordHash.parse(hashing.hash_password(password))
+    totp = pyotp.TOTP(secret)
+    code = totp.now()
+    uri = totp.provisioning_uri(name=username, issuer_name="Cofrap")
+    renderer = qr.QRRenderer()
+
+    matrix = qrcode.QRCode()
+    matrix.add_data(uri)
+    matrix.make(fit=True)
+
+    with pool.get_pool().connection() as conn:
+        with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT * FROM users ORDER BY id LIMIT 100")
+            page = cursor.fetchall()
+
+    def pool_acquire(_):
+        with pool.get_pool().connection():
+            pass
+
+    def query(i):
+        auth.fetch_user(accounts[(i * 7919) % len(accounts)][0])
+
+    def qr_matrix(_):
+        code = qrcode.QRCode()
+        code.add_data(uri)
+        code.make(fit=True)
+
+    def png_encode(_):
+        matrix.make_image().save(io.BytesIO(), format="PNG")
+
+    return {
+        "connect": measure(lambda _: db.connect().close(), iterations),
+        "pool_acquire": measure(pool_acquire, iterations),
+        "query": measure(query, iterations),
+        "base64_decode": measure(lambda _: auth.decode_b64(encoded), iterations),
+        "password_verify": measure(lambda _: hashing.verify(password, verifier), iterations),
+        "totp_verify": measure(lambda _: totp.verify(code, valid_window=1), iterations),
+        "password_generation": measure(lambda _: modules["generate-password"].generate_strong_password(), iterations),
+        "qr_matrix": measure(qr_matrix, iterations),
+        "png_encode": measure(png_encode, iterations),
+        "qr_render": measure(lambda _: renderer.render(uri), iterations),
+        "json_serialize": measure(lambda _: json.dumps(page, default=str), iterations),
+    }
+
+
+def bench_handlers(db, modules, iterations):
+    """Time every `handle()` end to end against the stand-in database."""
+    accounts = db.accounts
+    app = Flask(__name__)
+
+    def login(i):
+        username, password, secret = accounts[(i * 7919) % len(accounts)]
+        result = modules["authenticate-user"].handle(json.dumps({
+            "username": username, "password": password, "otp_code": pyotp.TOTP(secret).now()
+        }))
+        assert json.loads(result)["status"] == "success", result
+
+    def login_unknown(i):
+        result = modules["authenticate-user"].handle(json.dumps({
+            "username": f"stuffing-{i}", "password": "hunter2", "otp_code": "000000"
+        }))
+        assert json.loads(result)["status"] == "auth_failed", result
+
+    def generate_password(i):
+        with app.test_request_context(method="POST"):
+            resp = modules["generate-password"].handle(json.dumps({"username": f"bench-pwd-{i}"}))
+            assert resp.status_code == 200, resp.get_data(as_text=True)
+
+    def generate_2fa(i):
+        with app.test_request_context(method="POST"):
+            resp = modules["generate-2fa"].handle(json.dumps({"username": accounts[i % len(accounts)][0]}))
+            assert resp.status_code == 200, resp.get_data(as_text=True)
+
+    def onboard_user(i):
+        with app.test_request_context(method="POST"):
+            resp = modules["onboard-user"].handle(json.dumps({"username": f"bench-onboard-{i}"}))
+            assert resp.status_code == 200, resp.get_data(as_text=True)
+
+    def get_users_page(i):
+        with app.test_request_context(f"/?limit=100&after={(i * 100) % len(accounts)}"):
+            assert "next_cursor" in modules["get-users"].handle(None).get_data(as_text=True)
+
+    def get_users_cached(_):
+        with app.test_request_context("/"):
+            assert modules["get-users"].handle(None).status_code == 200
+
+    def get_users_not_modified(_):
+        with app.test_request_context("/", headers={"If-None-Match": current_etag}):
+            assert modules["get-users"].handle(None).status_code == 304
+
+    os.environ["REQUEST_METHOD"] = "POST"
+    qr_iterations = max(1, iterations // 5)
+    results = {
+        "authenticate-user": measure(login, iterations),
+        "authenticate-user.unknown": measure(login_unknown, iterations),
+        "generate-password": measure(generate_password, qr_iterations),
+        "generate-2fa": measure(generate_2fa, qr_iterations),
+        "onboard-user": measure(onboard_user, qr_iterations),
+        "get-users.page": measure(get_users_page, iterations),
+        "get-users.cached": measure(get_users_cached, iterations),
+    }
+    # Logins above may have rehashed passwords: revalidate against the current version
+    with app.test_request_context("/"):
+        current_etag = modules["get-users"].handle(None).headers["ETag"]
+    results["get-users.not_modified"] = measure(get_users_not_modified, iterations)
+    return results
+
+
+def compare(current, baseline):
+    """Print the p50/p99 change of every benchmark present in both runs."""
+    print(f"\n{'benchmark':<34} {'p50 ms':>9} {'Δ p50':>8} {'p99 ms':>9} {'Δ p99':>8}")
+    for section in ("phases", "handlers"):
+        for name, result in current[section].items():
+            before = baseline.get(section, {}).get(name)
+            if not before:
+                continue
+
+            def delta(key):
+                return (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+
+            print(f"{section + '.' + name:<34} {result['p50_ms']:>9.3f} {delta('p50_ms'):>+7.1f}% "
+                  f"{result['p99_ms']:>9.3f} {delta('p99_ms'):>+7.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-function microbenchmarks against a local stand-in database.")
+    parser.add_argument("--users", type=int, default=10000, help="number of seeded users (10k to 1M)")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="result file (default: bench/results/<git sha>.json)")
+    parser.add_argument("--compare", help="previous result file to compare against")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    db = StandInDatabase(users=args.users, seed=args.seed)
+    seed_seconds = time.perf_counter() - started
+    db.install()
+    modules = {directory: load_handler(directory) for directory in HANDLERS}
+    known = userfilter.get_known_users()
+    if known is not None:
+        known.rebuild()
+
+    revision = git_revision()
+    results = {
+        "revision": revision,
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "users": args.users,
+        "seed": args.seed,
+        "iterations": args.iterations,
+        "seed_seconds": round(seed_seconds, 3),
+        "phases": bench_phases(db, modules, args.iterations),
+        "handlers": bench_handlers(db, modules, args.iterations),
+        "pool": pool.get_pool().stats(),
+    }
+
+    print(f"{'benchmark':<34} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>10}")
+    for section in ("phases", "handlers"):
+        for name, result in results[section].items():
+            print(f"{section + '.' + name:<34} {result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} "
+                  f"{result['p99_ms']:>9.3f} {result['throughput_ops']:>10.1f}")
+
+    output = args.output or os.path.join(ROOT, "bench", "results", f"{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Cost of password verification under load.
+
+Calibrates the scrypt cost to `--target-ms` (or uses `--ln`), then has
+`--concurrency` threads verify passwords through `common.hashing` for each
+executor, reporting latency percentiles, verifications per second and the
+requests rejected as busy once the pool is saturated.
+
+Usage
+-----
+    python bench/bench_hashing.py [--target-ms 50] [--ln N] [--workers 4]
+                                  [--concurrency 1,4,16,64] [--requests 200]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import hashing  # noqa: E402
+from stats import summarize  # noqa: E402
+
+
+def run_load(verifier, concurrency, requests):
+    samples = []
+    rejected = []
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def client():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                assert hashing.verify("bench-password", verifier)
+            except hashing.HashingBusy:
+                with lock:
+                    rejected.append(1)
+                continue
+            with lock:
+                samples.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, time.perf_counter() - started), len(rejected)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--target-ms", type=float, default=50, help="calibration target")
+    parser.add_argument("--ln", type=int, help="pin the cost instead of calibrating")
+    parser.add_argument("--workers", type=int, default=min(os.cpu_count() or 1, 4))
+    parser.add_argument("--concurrency", default="1,4,16,64", help="comma-separated client counts")
+    parser.add_argument("--requests", type=int, default=200, help="verifications per run")
+    args = parser.parse_args(argv)
+
+    os.environ["HASH_WORKERS"] = str(args.workers)
+    if args.ln:
+        os.environ["PASSWORD_HASH_LN"] = str(args.ln)
+    else:
+        os.environ.pop("PASSWORD_HASH_LN", None)
+        os.environ["PASSWORD_HASH_TARGET_MS"] = str(args.target_ms)
+
+    start = time.perf_counter()
+    params = hashing.current_params()
+    print(f"cost {params} chosen in {(time.perf_counter() - start) * 1000:.0f} ms, {args.workers} workers")
+    # Keep the calibrated cost across the pool resets below
+    os.environ["PASSWORD_HASH_LN"] = str(params.ln)
+
+    print(f"{'executor':<10} {'clients':>8} {'p50 ms':>10} {'p99 ms':>10} {'verify/s':>10} {'busy':>6}")
+    for executor in ("process", "thread"):
+        os.environ["HASH_EXECUTOR"] = executor
+        hashing.reset_pool()
+        verifier = hashing.PasswordHash.parse(hashing.hash_password("bench-password"))
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            result, busy = run_load(verifier, concurrency, args.requests)
+            print(f"{executor:<10} {concurrency:>8} {result['p50_ms']:>10.1f} {result['p99_ms']:>10.1f} "
+                  f"{result.get('throughput_ops', 0):>10.1f} {busy:>6}")
+    hashing.reset_pool()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+Throughput of password generation.
+
+Compares the legacy `generate_strong_password()` (one `SystemRandom` object
+and one `os.urandom` call per character) with `common.passwords`, which
+draws entropy in blocks and maps it to the alphabet by rejection sampling,
+one password per call and in bulk.
+
+Usage
+-----
+    python bench/bench_passwords.py [--iterations 10000] [--bulk 5000] [--bulk-iterations 10]
+"""
+import argparse
+import os
+import random
+import string
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.passwords import PasswordGenerator  # noqa: E402
+from stats import measure  # noqa: E402
+
+
+def legacy_password(length=24):
+    chars = string.ascii_letters + string.digits + string.punctuation
+    return ''.join(random.SystemRandom().choice(chars) for _ in range(length))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=10000, help="single-password calls")
+    parser.add_argument("--bulk", type=int, default=5000, help="passwords per bulk call")
+    parser.add_argument("--bulk-iterations", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    generator = PasswordGenerator()
+    cases = [
+        ("legacy, 1 password", 1, lambda _: legacy_password()),
+        ("engine, 1 password", 1, lambda _: generator.generate(1)),
+        (f"legacy, {args.bulk} passwords", args.bulk, lambda _: [legacy_password() for _ in range(args.bulk)]),
+        (f"engine, {args.bulk} passwords", args.bulk, lambda _: generator.generate(args.bulk)),
+    ]
+
+    print(f"{'case':<28} {'p50 ms':>10} {'p99 ms':>10} {'passwords/s':>14}")
+    for name, per_call, func in cases:
+        result = measure(func, args.iterations if per_call == 1 else args.bulk_iterations)
+        print(f"{name:<28} {result['p50_ms']:>10.4f} {result['p99_ms']:>10.4f} "
+              f"{result['throughput_ops'] * per_call:>14.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
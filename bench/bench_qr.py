@@ -0,0 +1,61 @@
+"""
+Render cost of a QR code per output format.
+
+Compares the legacy path (`qrcode.make()` then two PNG encodes, as the
+handlers used to do) with `common.qr.QRRenderer` in PNG at several
+compression levels, with a fixed mask pattern, and in SVG.
+
+Usage
+-----
+    python bench/bench_qr.py [--iterations 200]
+"""
+import argparse
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qrcode  # noqa: E402
+
+from common.qr import QRRenderer  # noqa: E402
+from stats import measure  # noqa: E402
+
+PAYLOAD = "otpauth://totp/Cofrap:alice.martin?secret=JBSWY3DPEHPK3PXPJBSWY3DP&issuer=Cofrap"
+
+
+def legacy_render(content):
+    img = qrcode.make(content)
+    img.save(io.BytesIO(), format="PNG")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    cases = [("legacy qrcode.make + 2x PNG", lambda: legacy_render(PAYLOAD))]
+    for level in (1, 6, 9):
+        renderer = QRRenderer(compress_level=level)
+        cases.append((f"png compress_level={level}", lambda r=renderer: r.render(PAYLOAD)))
+    fixed_mask = QRRenderer(mask_pattern=0)
+    cases.append(("png mask_pattern=0", lambda: fixed_mask.render(PAYLOAD)))
+    svg = QRRenderer(fmt="svg")
+    cases.append(("svg", lambda: svg.render(PAYLOAD)))
+    svg_fixed_mask = QRRenderer(fmt="svg", mask_pattern=0)
+    cases.append(("svg mask_pattern=0", lambda: svg_fixed_mask.render(PAYLOAD)))
+
+    print(f"{'case':<30} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'bytes':>7}")
+    for name, func in cases:
+        result = measure(lambda _: func(), args.iterations)
+        out = func()
+        size = len(out if isinstance(out, bytes) else out.data)
+        print(f"{name:<30} {result['mean_ms']:>9.3f} {result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} {size:>7}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Cold-start measurements of the COFRAP handlers.
+
+Every sample runs in a fresh interpreter, as a replica scaled from zero
+would: Flask is imported first (the python3-flask template does it before
+loading the handler), then the handler module, then two requests are served
+against a seeded local stand-in database (`bench/standin.py`). With
+`--warmup`, the handler's `/_/warmup` entry point is called between the
+import and the first request, and its duration is reported separately.
+
+Results are written as JSON (`--output`, default
+`bench/results/startup-<git sha>.json`).
+
+Usage
+-----
+    python bench/bench_startup.py [--samples 10] [--warmup] [--output FILE]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import pyotp
+
+from bench_handlers import HANDLERS, ROOT, git_revision
+from standin import StandInDatabase
+from stats import percentile
+
+SEED = 7
+
+# Executed in a child interpreter; prints one JSON sample on stdout
+CHILD = r"""
+import importlib.util, json, os, sys, time
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+os.environ["ARTIFACT_STORE"] = "none"
+os.environ["REQUEST_METHOD"] = "POST"
+
+t0 = time.perf_counter()
+from flask import Flask
+t1 = time.perf_counter()
+spec = importlib.util.spec_from_file_location(MODULE, os.path.join(ROOT, DIRECTORY, "handler.py"))
+handler = importlib.util.module_from_spec(spec)
+sys.modules[MODULE] = handler
+spec.loader.exec_module(handler)
+t2 = time.perf_counter()
+
+from standin import StandInDatabase
+db = StandInDatabase(users=100, seed=SEED)
+db.install()
+app = Flask(__name__)
+username, password, secret = db.accounts[0]
+
+def call():
+    if DIRECTORY == "authenticate-user":
+        body, path = json.dumps({"username": username, "password": password, "otp_code": OTP_CODE}), "/"
+    elif DIRECTORY == "get-users":
+        body, path = None, "/?limit=100"
+    else:
+        body, path = json.dumps({"username": username}), "/"
+    with app.test_request_context(path, method="POST" if body else "GET", data=body):
+        start = time.perf_counter()
+        resp = handler.handle(body)
+        elapsed = time.perf_counter() - start
+        assert resp.status_code == 200, resp.get_data(as_text=True)
+    return elapsed
+
+warmup = None
+if WARMUP:
+    with app.test_request_context("/_/warmup"):
+        start = time.perf_counter()
+        resp = handler.handle(None)
+        warmup = time.perf_counter() - start
+        assert resp.status_code == 200, resp.get_data(as_text=True)
+
+first = call()
+second = call()
+print(json.dumps({
+    "flask_import_ms": (t1 - t0) * 1000,
+    "handler_import_ms": (t2 - t1) * 1000,
+    "warmup_ms": warmup * 1000 if warmup is not None else None,
+    "first_request_ms": first * 1000,
+    "second_request_ms": second * 1000,
+}))
+"""
+
+METRICS = ("flask_import_ms", "handler_import_ms", "warmup_ms", "first_request_ms", "second_request_ms")
+
+
+def sample(directory, warmup):
+    # The OTP is computed here so that the child only imports pyotp through the handler
+    secret = StandInDatabase(users=1, seed=SEED).accounts[0][2]
+    prelude = (f"ROOT = {ROOT!r}\nDIRECTORY = {directory!r}\nMODULE = {HANDLERS[directory]!r}\n"
+               f"WARMUP = {warmup!r}\nSEED = {SEED!r}\nOTP_CODE = {pyotp.TOTP(secret).now()!r}\n")
+    out = subprocess.run([sys.executable, "-c", prelude + CHILD], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(directory, samples, warmup):
+    """Collect `samples` cold starts of one function and return p50/max per metric."""
+    runs = [sample(directory, warmup) for _ in range(samples)]
+    summary = {}
+    for metric in METRICS:
+        values = sorted(r[metric] for r in runs if r[metric] is not None)
+        if values:
+            summary[metric] = {"p50": round(percentile(values, 50), 3), "max": round(values[-1], 3)}
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start import and first-request latency of every handler.")
+    parser.add_argument("--samples", type=int, default=10, help="fresh interpreters per function")
+    parser.add_argument("--warmup", action="store_true", help="call /_/warmup before the first request")
+    parser.add_argument("--output", help="result file (default: bench/results/startup-<git sha>.json)")
+    args = parser.parse_args(argv)
+
+    revision = git_revision()
+    results = {
+        "revision": revision,
+        "samples": args.samples,
+        "warmup": args.warmup,
+        "functions": {directory: run(directory, args.samples, args.warmup) for directory in HANDLERS},
+    }
+
+    print(f"{'function':<20} " + " ".join(f"{m[:-3]:>18}" for m in METRICS))
+    for directory, summary in results["functions"].items():
+        cells = [f"{summary[m]['p50']:>18.2f}" if m in summary else f"{'-':>18}" for m in METRICS]
+        print(f"{directory:<20} " + " ".join(cells))
+
+    output = args.output or os.path.join(ROOT, "bench", "results", f"startup-{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {output} (p50 in ms)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,702 @@
+"""
+End-to-end load generator and saturation test of the COFRAP functions.
+
+A child process serves the handlers the way the OpenFaaS `python3-flask`
+template does: one Flask app per function, mounted under `/function/<name>`,
+each `handle()` receiving the raw request body, behind a WSGI server with a
+bounded pool of worker threads (`--threads`, waitress' default of 4) and an
+optional `max_inflight` limit answered with 429s like the watchdog does. The
+functions share a seeded stand-in database (`bench/standin.py`).
+
+The client then drives a weighted mix of traffic (`--mix`, kinds below)
+either closed loop, `--concurrency` clients each waiting for its answer, or
+open loop, Poisson arrivals at `--rates` requests per second, whose latency
+is counted from the scheduled send time so a saturated server cannot hide
+its queueing delay. Every step reports throughput, latency percentiles,
+error rate and the database connections the pool held; the summary gives
+the throughput ceiling under `--slo-p99-ms`, the `max_inflight` it implies
+(Little's law) and the replicas needed for `--target-rps`.
+
+Kinds: `login` (valid credentials), `stuffing` (unknown users),
+`provision` (generate-password), `enroll` (generate-2fa), `onboard`
+(onboard-user, not in the default mix), `list` (full get-users listing)
+and `page` (get-users page of 100).
+
+`--record FILE` writes the generated requests as newline-delimited JSON
+(`at`, `function`, `method`, `path`, `body`, `headers`); `--replay FILE`
+sends such a log at its recorded offsets (`--speed` to scale them). A
+`"$totp"` OTP code in a logged body is replaced by the current code of the
+seeded user, so a log replays against the same `--users`/`--seed`.
+
+Results are written to `bench/results/load-<git sha>.json`.
+
+Usage
+-----
+    python bench/load.py [--users 10000] [--seed 42] [--mix login=70,page=10,...]
+                         [--concurrency 1,2,4,8,16 | --rates 50,100,200]
+                         [--duration 10] [--threads 4] [--max-inflight N]
+                         [--pool-size 4] [--slo-p99-ms 250] [--target-rps N]
+                         [--record FILE | --replay FILE [--speed 1.0]]
+                         [--output FILE]
+"""
+import argparse
+import http.client
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stats import summarize  # noqa: E402
+
+DEFAULT_MIX = "login=70,stuffing=5,provision=5,enroll=5,list=5,page=10"
+TOTP_PLACEHOLDER = "$totp"
+PROVISIONED_USERS = 1000
+METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+
+
+# -------------------- SERVER (child process) --------------------
+
+
+def template_app(module):
+    """A Flask app calling `module.handle()` the way the `python3-flask` template's `index.py` does."""
+    from flask import Flask, request
+
+    app = Flask(module.__name__)
+
+    @app.route("/", defaults={"path": ""}, methods=METHODS)
+    @app.route("/<path:path>", methods=METHODS)
+    def call_handler(path):
+        return module.handle(request.get_data(as_text=True))
+
+    return app
+
+
+class MaxInflight:
+    """
+    WSGI middleware refusing requests past `limit` concurrent ones with a 429.
+
+    Mirrors the `max_inflight` setting of the OpenFaaS watchdog, and counts
+    the peak concurrency and the refusals for the report.
+    """
+
+    def __init__(self, app, limit=0):
+        self.app = app
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.peak = 0
+        self.rejected = 0
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            if self.limit and self.inflight >= self.limit:
+                self.rejected += 1
+                refused = True
+            else:
+                refused = False
+                self.inflight += 1
+                self.peak = max(self.peak, self.inflight)
+        if refused:
+            start_response("429 Too Many Requests", [("Content-Type", "text/plain")])
+            return [b"Concurrent request limit exceeded.\n"]
+        try:
+            # Consumed here so that a streamed body keeps its slot until sent
+            return list(self.app(environ, start_response))
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+    def take_counters(self):
+        with self._lock:
+            counters = {"peak_inflight": self.peak, "rejected": self.rejected}
+            self.peak = self.inflight
+            self.rejected = 0
+        return counters
+
+
+def make_server(app, threads, backlog):
+    """A werkzeug server handing each connection to one of `threads` workers, like waitress."""
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    class PooledWSGIServer(BaseWSGIServer):
+        request_queue_size = backlog
+
+        def __init__(self):
+            super().__init__("127.0.0.1", 0, app, handler=QuietHandler)
+            self._workers = ThreadPoolExecutor(threads, thread_name_prefix="wsgi")
+
+        def process_request(self, request, client_address):
+            self._workers.submit(self._process, request, client_address)
+
+        def _process(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        def server_close(self):
+            super().server_close()
+            self._workers.shutdown(wait=False, cancel_futures=True)
+
+    return PooledWSGIServer()
+
+
+def not_found(environ, start_response):
+    start_response("404 Not Found", [("Content-Type", "text/plain")])
+    return [b"Not found\n"]
+
+
+def serve(options, control):
+    """
+    Child process entry point: seed the stand-in, serve the functions and answer `control` commands.
+
+    Sends `{"port", "accounts", "enroll"}` once listening, then answers
+    `"stats"` with the pool and server counters since the previous call,
+    until `"stop"`.
+    """
+    from bench_handlers import HANDLERS, load_handler
+    from standin import StandInDatabase
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+    from common import breaker, hashing, pool, userfilter
+
+    db = StandInDatabase(users=options["users"], seed=options["seed"])
+    # Logins verify scrypt hashes, as on an upgraded table, not legacy rows
+    login_accounts = db.accounts[:options["login_users"]]
+    verifiers = hashing.hash_passwords([password for _, password, _ in login_accounts])
+    db._anchor.executemany(
+        "UPDATE users SET password = ? WHERE username = ?",
+        [(verifier, username) for (username, _, _), verifier in zip(login_accounts, verifiers)],
+    )
+    db._anchor.commit()
+    db.install(max_size=options["pool_size"], breaker=breaker.get_breaker())
+
+    modules = {directory: load_handler(directory) for directory in HANDLERS}
+    known = userfilter.get_known_users()
+    if known is not None:
+        known.rebuild()
+    apps = {f"/function/{directory}": template_app(module) for directory, module in modules.items()}
+    limiter = MaxInflight(DispatcherMiddleware(not_found, apps), options["max_inflight"])
+    server = make_server(limiter, options["threads"], options["backlog"])
+    threading.Thread(target=server.serve_forever, name="server", daemon=True).start()
+
+    peak_in_use = [0]
+    stop = threading.Event()
+
+    def sample_pool():
+        while not stop.wait(0.01):
+            peak_in_use[0] = max(peak_in_use[0], pool.get_pool().stats()["in_use"])
+
+    threading.Thread(target=sample_pool, name="pool-sampler", daemon=True).start()
+    control.send({
+        "port": server.server_port,
+        "accounts": login_accounts,
+        "enroll": [username for username, _, _ in db.accounts[options["login_users"]:][:PROVISIONED_USERS]],
+    })
+
+    while True:
+        command = control.recv()
+        if command == "stop":
+            break
+        stats = pool.get_pool().stats()
+        stats.update(limiter.take_counters())
+        stats.update(peak_in_use=peak_in_use[0], opened=db.opened, closed=db.closed)
+        peak_in_use[0] = stats["in_use"]
+        control.send(stats)
+
+    stop.set()
+    server.shutdown()
+    server.server_close()
+    # The hashing workers are children of this process: stop them so it can exit
+    hashing.reset_pool()
+    pool.reset_pool()
+    db.close()
+
+
+# -------------------- TRAFFIC --------------------
+
+
+def parse_mix(text):
+    """Parse `login=70,page=10` into normalised `{kind: weight}`."""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUESTS:
+            raise ValueError(f"unknown kind {kind!r}, expected one of {', '.join(REQUESTS)}")
+        mix[kind] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError("the mix needs a positive weight")
+    return {kind: weight / total for kind, weight in mix.items()}
+
+
+def login_request(i, target):
+    username, password, _ = target.accounts[i % len(target.accounts)]
+    body = {"username": username, "password": password, "otp_code": TOTP_PLACEHOLDER}
+    return "authenticate-user", "POST", "/", body
+
+
+def stuffing_request(i, target):
+    return "authenticate-user", "POST", "/", {"username": f"stuffing-{i}", "password": "hunter2", "otp_code": "000000"}
+
+
+def provision_request(i, target):
+    return "generate-password", "POST", "/", {"username": f"load-{i % PROVISIONED_USERS:04d}"}
+
+
+def enroll_request(i, target):
+    return "generate-2fa", "POST", "/", {"username": target.enroll[i % len(target.enroll)]}
+
+
+def onboard_request(i, target):
+    return "onboard-user", "POST", "/", {"username": f"onboard-{i % PROVISIONED_USERS:04d}"}
+
+
+def list_request(i, target):
+    return "get-users", "GET", "/", None
+
+
+def page_request(i, target):
+    return "get-users", "GET", f"/?limit=100&after={(i * 100) % target.users}", None
+
+
+REQUESTS = {
+    "login": login_request,
+    "stuffing": stuffing_request,
+    "provision": provision_request,
+    "enroll": enroll_request,
+    "onboard": onboard_request,
+    "list": list_request,
+    "page": page_request,
+}
+
+# Logins must succeed; any other kind only needs a non-error answer
+EXPECTED_STATUS = {"login": "success"}
+
+
+class Target:
+    """
+    The server under load: builds, sends and checks requests.
+
+    Parameters
+    ----------
+    port : int
+        Port of the template server.
+    accounts : list of tuple
+        `(username, password, totp_secret)` of the users logins are drawn from.
+    enroll : list of str
+        Usernames that `enroll` requests rotate the TOTP secret of.
+    users : int
+        Number of seeded users, bounds the page cursors.
+    timeout : float
+        Socket timeout of a request, in seconds.
+    """
+
+    def __init__(self, port, accounts, enroll, users, timeout=30.0):
+        import pyotp
+
+        self.port = port
+        self.accounts = accounts
+        self.enroll = enroll or [username for username, _, _ in accounts]
+        self.users = users
+        self.timeout = timeout
+        self._totp = {username: pyotp.TOTP(secret) for username, _, secret in accounts}
+
+    def generate(self, kind, i):
+        """Return the log entry (without `at`) of the `i`-th request of `kind`."""
+        function, method, path, body = REQUESTS[kind](i, self)
+        return {
+            "kind": kind,
+            "function": function,
+            "method": method,
+            "path": path,
+            "body": json.dumps(body) if body is not None else None,
+            "headers": {"Content-Type": "application/json"} if body is not None else {},
+        }
+
+    def render_body(self, body):
+        if body is None or TOTP_PLACEHOLDER not in body:
+            return body
+        data = json.loads(body)
+        totp = self._totp.get(data.get("username"))
+        if totp is not None and data.get("otp_code") == TOTP_PLACEHOLDER:
+            data["otp_code"] = totp.now()
+        return json.dumps(data)
+
+    def send(self, entry):
+        """
+        Send one request and classify its answer.
+
+        Returns
+        -------
+        str
+            `ok`, `failed` (an answer reporting an error or, for a login, no
+            success), `rejected` (429), `server_error` (5xx) or `connection`.
+        """
+        body = self.render_body(entry.get("body"))
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+        try:
+            conn.request(entry.get("method", "POST"), f"/function/{entry['function']}{entry.get('path', '/')}",
+                         body=body.encode() if body is not None else None, headers=entry.get("headers") or {})
+            response = conn.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException):
+            return "connection"
+        finally:
+            conn.close()
+        return classify(entry.get("kind"), response.status, payload)
+
+
+def classify(kind, status, payload):
+    """Tell whether an answer counts as served; see `Target.send`."""
+    if status == 429:
+        return "rejected"
+    if status >= 500:
+        return "server_error"
+    if status >= 300 and status != 304:
+        return "failed"
+    if payload[:1] != b"{":
+        return "ok"
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return "failed"
+    if "error" in data or data.get("status") == "error":
+        return "failed"
+    expected = EXPECTED_STATUS.get(kind)
+    if expected is not None and data.get("status") != expected:
+        return "failed"
+    return "ok"
+
+
+class Traffic:
+    """Thread-safe source of generated requests following a mix."""
+
+    def __init__(self, target, mix, seed):
+        self.target = target
+        self._kinds = list(mix)
+        self._weights = [mix[kind] for kind in self._kinds]
+        self._rng = random.Random(seed)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            i = next(self._counter)
+            kind = self._rng.choices(self._kinds, self._weights)[0]
+        return self.target.generate(kind, i)
+
+
+class Recorder:
+    """Appends sent requests to a newline-delimited JSON log, or does nothing without a path."""
+
+    def __init__(self, path=None):
+        self._file = open(path, "w") if path else None
+        self._lock = threading.Lock()
+        self._offset = 0.0
+
+    def next_step(self, elapsed):
+        # Steps follow each other in the log, as they did on the wire
+        self._offset += elapsed
+
+    def write(self, at, entry):
+        if self._file is None:
+            return
+        line = json.dumps({"at": round(self._offset + at, 6), **entry})
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def load_log(path):
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda entry: entry.get("at", 0.0))
+    for entry in entries:
+        entry.setdefault("kind", entry["function"])
+    return entries
+
+
+# -------------------- LOAD LOOPS --------------------
+
+
+def run_closed(target, traffic, recorder, concurrency, duration):
+    """`concurrency` clients sending back to back for `duration` seconds."""
+    samples = []
+    started = time.perf_counter()
+    deadline = started + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            entry = traffic.next()
+            sent = time.perf_counter()
+            outcome = target.send(entry)
+            samples.append((entry["kind"], outcome, (time.perf_counter() - sent) * 1000))
+            recorder.write(sent - started, entry)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def run_open(target, entries, offsets, recorder, clients):
+    """
+    Send `entries[i]` at `offsets[i]` seconds from now, from up to `clients` senders.
+
+    Latency counts from the scheduled time: a request that waited for a free
+    sender, because the server is too slow, is charged that wait.
+    """
+    samples = []
+    counter = itertools.count()
+    started = time.perf_counter()
+
+    def sender():
+        while True:
+            i = next(counter)
+            if i >= len(entries):
+                return
+            scheduled = started + offsets[i]
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            outcome = target.send(entries[i])
+            samples.append((entries[i]["kind"], outcome, (time.perf_counter() - scheduled) * 1000))
+            recorder.write(offsets[i], entries[i])
+
+    threads = [threading.Thread(target=sender) for _ in range(min(clients, len(entries)) or 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, max(time.perf_counter() - started, offsets[-1] if offsets else 0.0)
+
+
+def poisson_offsets(rate, duration, rng):
+    offsets = []
+    at = rng.expovariate(rate)
+    while at < duration:
+        offsets.append(at)
+        at += rng.expovariate(rate)
+    return offsets
+
+
+# -------------------- REPORT --------------------
+
+
+def report_step(samples, elapsed, server):
+    outcomes = {}
+    by_kind = {}
+    for kind, outcome, latency in samples:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        by_kind.setdefault(kind, []).append((outcome, latency))
+    total = len(samples)
+    ok = outcomes.get("ok", 0)
+    step = {
+        "requests": total,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "goodput_rps": ok / elapsed if elapsed else 0.0,
+        "error_rate": (total - ok) / total if total else 0.0,
+        "outcomes": outcomes,
+        "latency": summarize([latency for _, _, latency in samples]),
+        "kinds": {},
+        "server": server,
+    }
+    for kind, results in sorted(by_kind.items()):
+        summary = summarize([latency for _, latency in results], elapsed)
+        summary["errors"] = sum(outcome != "ok" for outcome, _ in results)
+        step["kinds"][kind] = summary
+    return step
+
+
+def sizing(steps, slo_p99_ms, max_error_rate, target_rps=None):
+    """
+    Derive the deployment settings from the throughput-latency curve.
+
+    The ceiling is the best goodput of the steps meeting the p99 objective
+    and error budget; `max_inflight` is the concurrency it takes at that
+    point by Little's law (throughput × mean latency), rounded up.
+    """
+    within = [s for s in steps if s["latency"]["p99_ms"] <= slo_p99_ms and s["error_rate"] <= max_error_rate]
+    if not within:
+        return {"ceiling_rps": 0.0, "max_inflight": None, "replicas": None, "slo_p99_ms": slo_p99_ms,
+                "note": "no step met the latency objective and error budget"}
+    best = max(within, key=lambda s: s["goodput_rps"])
+    inflight = max(1, math.ceil(best["throughput_rps"] * best["latency"]["mean_ms"] / 1000))
+    result = {
+        "ceiling_rps": round(best["goodput_rps"], 1),
+        "at_step": best["label"],
+        "p99_ms": round(best["latency"]["p99_ms"], 3),
+        "max_inflight": inflight,
+        "db_connections": best["server"]["peak_in_use"],
+        "slo_p99_ms": slo_p99_ms,
+        "replicas": None,
+    }
+    if target_rps:
+        result["replicas"] = max(1, math.ceil(target_rps / best["goodput_rps"]))
+        result["target_rps"] = target_rps
+    return result
+
+
+def print_step(step):
+    latency = step["latency"]
+    server = step["server"]
+    print(f"{step['label']:<14} {step['throughput_rps']:>9.1f} {step['goodput_rps']:>9.1f} "
+          f"{latency['p50_ms']:>8.2f} {latency['p95_ms']:>8.2f} {latency['p99_ms']:>8.2f} "
+          f"{step['error_rate'] * 100:>6.2f}% {server['peak_inflight']:>8} {server['rejected']:>6} "
+          f"{server['peak_in_use']:>4}/{server['max_size']:<3} {server['opened']:>6}")
+
+
+# -------------------- MAIN --------------------
+
+
+def run_plan(args, mix, ready, control):
+    """Warm the functions up, then run every step of the load plan; return their reports."""
+    target = Target(ready["port"], ready["accounts"], ready["enroll"], args.users)
+    traffic = Traffic(target, mix, args.seed)
+    recorder = Recorder(args.record)
+    rng = random.Random(args.seed)
+
+    # Warm every kind up (imports, caches, pool) outside of the measurements
+    for kind in mix:
+        for i in range(3):
+            target.send(target.generate(kind, i))
+    control.send("stats")
+    control.recv()
+
+    if args.replay:
+        entries = load_log(args.replay)
+        offsets = [entry.get("at", 0.0) / args.speed for entry in entries]
+        plan = [("replay", lambda: run_open(target, entries, offsets, recorder, args.clients))]
+    elif args.rates:
+        def open_step(rate):
+            offsets = poisson_offsets(rate, args.duration, rng)
+            return run_open(target, [traffic.next() for _ in offsets], offsets, recorder, args.clients)
+        plan = [(f"{rate:g} rps", lambda rate=rate: open_step(rate)) for rate in map(float, args.rates.split(","))]
+    else:
+        counts = [int(n) for n in (args.concurrency or "1,2,4,8,16").split(",")]
+        plan = [(f"{n} clients", lambda n=n: run_closed(target, traffic, recorder, n, args.duration)) for n in counts]
+
+    print(f"\n{'step':<14} {'req/s':>9} {'ok/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} "
+          f"{'inflight':>8} {'429':>6} {'db':>8} {'opened':>6}")
+    steps = []
+    for label, run in plan:
+        samples, elapsed = run()
+        recorder.next_step(elapsed)
+        control.send("stats")
+        step = report_step(samples, elapsed, control.recv())
+        step["label"] = label
+        steps.append(step)
+        print_step(step)
+    recorder.close()
+    return steps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load the functions behind a local template server until they saturate.")
+    parser.add_argument("--users", type=int, default=10000, help="number of seeded users")
+    parser.add_argument("--login-users", type=int, default=200, help="users whose credentials logins use")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weighted kinds (default: {DEFAULT_MIX})")
+    loop = parser.add_mutually_exclusive_group()
+    loop.add_argument("--concurrency", default=None, help="closed loop: comma-separated client counts (default: 1,2,4,8,16)")
+    loop.add_argument("--rates", help="open loop: comma-separated arrival rates, requests per second")
+    loop.add_argument("--replay", help="replay a request log recorded with --record")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per step")
+    parser.add_argument("--clients", type=int, default=256, help="open loop: maximum concurrent senders")
+    parser.add_argument("--threads", type=int, default=4, help="server worker threads (waitress default: 4)")
+    parser.add_argument("--max-inflight", type=int, default=0, help="concurrent requests past which the server answers 429")
+    parser.add_argument("--backlog", type=int, default=1024, help="listen backlog of the server")
+    parser.add_argument("--pool-size", type=int, default=int(os.environ.get("DB_POOL_SIZE", 4)))
+    parser.add_argument("--slo-p99-ms", type=float, default=250.0, help="p99 latency objective of the sizing")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="error budget of the sizing")
+    parser.add_argument("--target-rps", type=float, help="expected peak load, to size the replica count")
+    parser.add_argument("--record", help="write the generated requests to this log")
+    parser.add_argument("--output", help="result file (default: bench/results/load-<git sha>.json)")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    from bench_handlers import ROOT, git_revision
+
+    context = multiprocessing.get_context("spawn")
+    control, child_end = context.Pipe()
+    options = {
+        "users": args.users, "seed": args.seed, "login_users": min(args.login_users, args.users),
+        "pool_size": args.pool_size, "threads": args.threads, "max_inflight": args.max_inflight,
+        "backlog": args.backlog,
+    }
+    server = context.Process(target=serve, args=(options, child_end))
+    started = time.perf_counter()
+    server.start()
+    child_end.close()
+    try:
+        ready = control.recv()
+    except EOFError:
+        server.join()
+        print("the server process exited before it was ready", file=sys.stderr)
+        return 1
+    print(f"server ready on port {ready['port']} in {time.perf_counter() - started:.1f}s "
+          f"({args.users} users, {args.threads} threads, max_inflight {args.max_inflight or 'unlimited'})")
+
+    try:
+        steps = run_plan(args, mix, ready, control)
+    finally:
+        if server.is_alive():
+            control.send("stop")
+            server.join(timeout=10)
+        if server.is_alive():
+            server.terminate()
+
+    summary = sizing(steps, args.slo_p99_ms, args.max_error_rate, args.target_rps)
+    print(f"\nceiling: {summary['ceiling_rps']} req/s with p99 <= {args.slo_p99_ms:g} ms "
+          f"and errors <= {args.max_error_rate * 100:g}%")
+    if summary["max_inflight"] is not None:
+        print(f"suggested max_inflight: {summary['max_inflight']} "
+              f"(db connections in use at the ceiling: {summary['db_connections']})")
+    if summary["replicas"] is not None:
+        print(f"replicas for {args.target_rps:g} req/s: {summary['replicas']}")
+
+    revision = git_revision()
+    results = {
+        "revision": revision,
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": {**options, "mix": mix, "duration": args.duration, "replay": args.replay},
+        "steps": steps,
+        "sizing": summary,
+    }
+    output = args.output or os.path.join(ROOT, "bench", "results", f"load-{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
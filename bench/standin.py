@@ -0,0 +1,88 @@
+"""
+Local, seedable stand-in for the COFRAP MariaDB database.
+
+A private in-memory database of the embedded SQLite backend
+(`common/sqlite.py`, the schema of `sql/init.sql` plus migrations),
+seeded with synthetic users. Its connections expose the subset of the
+pymysql API used by the handlers and rewrite the handful of MySQL-only
+constructs they emit.
+
+It is a benchmarking and load-testing tool: numbers measured against it show
+the cost of the Python side of each handler, not MariaDB's.
+"""
+import base64
+import random
+import string
+import time
+
+from common import sqlite
+
+
+class StandInDatabase(sqlite.Database):
+    """
+    A shared in-memory SQLite database seeded with synthetic users.
+
+    Parameters
+    ----------
+    users : int
+        Number of users to seed.
+    seed : int
+        Seed of the generator, so runs are reproducible.
+    expired_ratio : float
+        Fraction of users whose `gendate` is older than six months.
+
+    Attributes
+    ----------
+    accounts : list of tuple
+        `(username, password, totp_secret)` of every seeded user, in clear,
+        so that benchmarks can produce valid logins.
+    opened, closed : int
+        Number of connections opened and closed so far.
+    """
+
+    def __init__(self, users=10000, seed=42, expired_ratio=0.0):
+        super().__init__(sqlite.MEMORY)
+        self.accounts = []
+        self.seed(users, seed, expired_ratio)
+
+    def seed(self, users, seed=42, expired_ratio=0.0):
+        rng = random.Random(seed)
+        now = int(time.time())
+        alphabet = string.ascii_letters + string.digits
+        base32 = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
+        rows = []
+        start = len(self.accounts)
+        for i in range(start, start + users):
+            username = f"user{i:07d}"
+            password = "".join(rng.choice(alphabet) for _ in range(24))
+            secret = "".join(rng.choice(base32) for _ in range(32))
+            age = 200 * 24 * 3600 if rng.random() < expired_ratio else rng.randrange(0, 150 * 24 * 3600)
+            self.accounts.append((username, password, secret))
+            rows.append((
+                username,
+                base64.b64encode(password.encode()).decode(),
+                base64.b64encode(secret.encode()).decode(),
+                now - age,
+                0,
+            ))
+        with self.write_lock:
+            self._anchor.execute("BEGIN")
+            self._anchor.executemany(
+                "INSERT INTO users (username, password, mfa, gendate, expired) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._anchor.execute("COMMIT")
+
+    def install(self, **pool_options):
+        """
+        Route the handlers' shared connection pool to this database.
+
+        Returns
+        -------
+        common.pool.ConnectionPool
+            The newly installed pool.
+        """
+        from common import pool
+
+        new_pool = pool.ConnectionPool(self.connect, **pool_options)
+        pool.set_pool(new_pool)
+        return new_pool
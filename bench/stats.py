@@ -0,0 +1,57 @@
+"""Timing helpers shared by the benchmark scripts."""
+import statistics
+import time
+
+
+def percentile(sorted_samples, q):
+    """Nearest-rank percentile of already sorted samples, `q` in [0, 100]."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(0, min(len(sorted_samples) - 1, int(round(q / 100 * len(sorted_samples))) - 1))
+    return sorted_samples[rank]
+
+
+def summarize(samples_ms, elapsed_s=None):
+    """
+    Summarise latency samples in milliseconds.
+
+    Returns
+    -------
+    dict
+        `count`, `mean_ms`, `p50_ms`, `p95_ms`, `p99_ms`, `max_ms` and, when
+        `elapsed_s` is given, `throughput_ops` (operations per second).
+    """
+    ordered = sorted(samples_ms)
+    summary = {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) if ordered else 0.0,
+        "p50_ms": percentile(ordered, 50),
+        "p95_ms": percentile(ordered, 95),
+        "p99_ms": percentile(ordered, 99),
+        "max_ms": ordered[-1] if ordered else 0.0,
+    }
+    if elapsed_s:
+        summary["throughput_ops"] = len(ordered) / elapsed_s
+    return summary
+
+
+def measure(func, iterations, warmup=1):
+    """
+    Time `iterations` sequential calls of `func`.
+
+    `func` receives the iteration index, so it can vary its input.
+
+    Returns
+    -------
+    dict
+        The `summarize()` output, including throughput.
+    """
+    for i in range(warmup):
+        func(i)
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples, time.perf_counter() - started)
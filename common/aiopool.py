@@ -0,0 +1,292 @@
+import asyncio
+import functools
+import os
+import weakref
+from contextlib import asynccontextmanager, nullcontext
+
+from . import breaker, deadline, lazy, metrics, replicas, shards, sqlite
+from .pool import PoolExhausted, backend, socket_timeouts
+
+aiomysql = lazy.module("aiomysql")
+
+# aiomysql pools are bound to the event loop that created them
+_pools = weakref.WeakKeyDictionary()
+# loop -> {replica name: pool creation}
+_replica_pools = weakref.WeakKeyDictionary()
+# loop -> {shard name: pool creation}
+_shard_pools = weakref.WeakKeyDictionary()
+
+
+async def create_pool_from_env(host=None, port=3306):
+    """
+    Open a non-blocking MariaDB pool from the `DB_*` environment variables.
+
+    Connections run in autocommit mode like the synchronous pool's
+    (see `pool.connect_from_env`). Sizing is read from `DB_ASYNC_POOL_SIZE`
+    (default 20: waiting on MariaDB no longer ties up a worker thread, so
+    one replica keeps many more queries in flight) and `DB_POOL_MAX_LIFETIME`.
+    aiomysql has no read or write timeouts: the request deadline bounds
+    each borrow instead (see `connection`).
+
+    Parameters
+    ----------
+    host : str, optional
+        Server to connect to instead of the primary (`DB_HOST`), e.g. a read replica.
+    port : int
+        Port of `host`.
+
+    Returns
+    -------
+    aiomysql.Pool
+        A pool bound to the running event loop.
+    """
+    connect_timeout, _, _ = socket_timeouts()
+    return await aiomysql.create_pool(
+        minsize=0,
+        connect_timeout=connect_timeout,
+        maxsize=int(os.environ.get("DB_ASYNC_POOL_SIZE", 20)),
+        pool_recycle=int(float(os.environ.get("DB_POOL_MAX_LIFETIME", 1800))),
+        host=host or os.environ['DB_HOST'],
+        port=port,
+        user=os.environ['DB_USER'],
+        password=os.environ['DB_PASSWORD'],
+        db=os.environ['DB_NAME'],
+        autocommit=True
+    )
+
+
+async def _created(creations, key, factory):
+    # Coroutines racing on the first call share a single creation
+    creation = creations.get(key)
+    if creation is None:
+        creation = creations[key] = asyncio.get_running_loop().create_task(factory())
+    try:
+        return await creation
+    except Exception:
+        if creations.get(key) is creation:
+            del creations[key]
+        raise
+
+
+async def get_pool():
+    """
+    Return the pool of the running event loop, creating it on first use.
+
+    Coroutines racing on the first call share a single creation. With
+    `DB_BACKEND=sqlite` the pool is a `sqlite.AsyncPool` on the embedded database.
+    """
+    factory = sqlite.create_pool_from_env if backend() == "sqlite" else create_pool_from_env
+    return await _created(_pools, asyncio.get_running_loop(), factory)
+
+
+async def get_replica_pool(replica):
+    """Same as `get_pool` for a read replica (see `pool.get_replica_pool`)."""
+    creations = _replica_pools.setdefault(asyncio.get_running_loop(), {})
+    return await _created(creations, replica.name, lambda: create_pool_from_env(replica.host, replica.port))
+
+
+async def get_shard_pool(shard):
+    """Same as `get_pool` for a shard (see `pool.get_shard_pool`)."""
+    creations = _shard_pools.setdefault(asyncio.get_running_loop(), {})
+    if backend() == "sqlite":
+        factory = functools.partial(sqlite.create_pool_from_env, shard.location)
+    else:
+        factory = functools.partial(create_pool_from_env, shard.host, shard.port)
+    return await _created(creations, shard.name, factory)
+
+
+def set_pool(new_pool):
+    """
+    Use `new_pool` for the running event loop, e.g. a pool of a local stand-in database.
+
+    Must be called from a coroutine; any pool created before is left to the caller.
+    """
+    loop = asyncio.get_running_loop()
+    creation = loop.create_future()
+    creation.set_result(new_pool)
+    _pools[loop] = creation
+
+
+@asynccontextmanager
+async def connection(keys=()):
+    """
+    Borrow a connection for the duration of an `async with` block.
+
+    Waits at most `DB_POOL_TIMEOUT` seconds for a free connection; on error
+    the current transaction is rolled back, and a connection that cannot
+    roll back is closed instead of being reused. The block is cancelled
+    with `DeadlineExceeded` once the current request runs out of time (see
+    `common.deadline`), and goes through the same circuit breaker as the
+    synchronous pool's. With `DB_SHARDS`, the connection is one of the
+    shard owning the usernames `keys`, as `pool.connection` does.
+
+    Yields
+    ------
+    aiomysql.Connection
+        A live connection owned by the caller until the block exits.
+
+    Raises
+    ------
+    breaker.CircuitOpen
+        While the breaker refuses calls.
+    ValueError
+        With `DB_SHARDS`, if `keys` is empty or spans several shards.
+    """
+    shard_map = shards.get_shards()
+    if shard_map is None:
+        borrowed = _borrow(get_pool)
+    else:
+        borrowed = _borrow(functools.partial(get_shard_pool, shard_map.owner_of(keys)))
+    async with borrowed as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def _borrow(get):
+    deadline.check("borrowing a database connection")
+    db_breaker = breaker.get_breaker()
+    with db_breaker.guard() if db_breaker is not None else nullcontext():
+        db_pool = await get()
+        conn = await _acquire(db_pool)
+        async with _lease(db_pool, conn):
+            yield conn
+
+
+async def _acquire(db_pool):
+    timeout = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+    wait = deadline.bound(timeout, "acquiring a database connection")
+    try:
+        return await asyncio.wait_for(db_pool.acquire(), wait)
+    except asyncio.TimeoutError:
+        if wait < timeout:
+            raise deadline.DeadlineExceeded("deadline exceeded waiting for a database connection") from None
+        raise PoolExhausted(f"no database connection available after {timeout}s") from None
+
+
+@asynccontextmanager
+async def _lease(db_pool, conn):
+    timeout = asyncio.timeout(deadline.remaining())
+    try:
+        async with timeout:
+            yield conn
+    except BaseException as exc:
+        if timeout.expired():
+            # Cancelled in the middle of a query: the protocol state is unknown
+            conn.close()
+            raise deadline.DeadlineExceeded("deadline exceeded during a database call") from exc
+        try:
+            await conn.rollback()
+        except Exception:
+            conn.close()
+        raise
+    finally:
+        db_pool.release(conn)
+
+
+async def _borrow_replica(replica_set, replica):
+    """Same as `pool._borrow_replica`, on the asyncio pools."""
+    try:
+        db_pool = await get_replica_pool(replica)
+        conn = await _acquire(db_pool)
+    except PoolExhausted:
+        return None
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        replica_set.report_failure(replica)
+        return None
+    if replica_set.needs_check(replica):
+        try:
+            with metrics.phase("db_replica_check"):
+                async with conn.cursor(aiomysql.DictCursor) as cursor:
+                    await cursor.execute(replicas.LAG_SQL)
+                    lag = replicas.lag_from_status(await cursor.fetchone())
+        except Exception:
+            conn.close()
+            db_pool.release(conn)
+            replica_set.report_failure(replica)
+            return None
+        if not replica_set.report_lag(replica, lag):
+            db_pool.release(conn)
+            return None
+    return db_pool, conn
+
+
+@asynccontextmanager
+async def read_connection(keys=()):
+    """Same as `pool.read_connection`, on the asyncio pools."""
+    if shards.get_shards() is not None:
+        async with connection(keys) as conn:
+            yield conn
+        return
+    replica_set = replicas.get_replicas() if backend() == "mariadb" else None
+    if replica_set is not None:
+        for replica in replica_set.candidates(keys):
+            borrowed = await _borrow_replica(replica_set, replica)
+            if borrowed is None:
+                continue
+            replica_set.report_read()
+            async with _lease(*borrowed) as conn:
+                yield conn
+            return
+    async with connection() as conn:
+        yield conn
+
+
+def _shard_connection(shard):
+    return _borrow(functools.partial(get_shard_pool, shard))
+
+
+def partitions(read=False):
+    """Same as `pool.partitions`, with factories of `async with` blocks."""
+    shard_map = shards.get_shards()
+    if shard_map is None:
+        return {None: read_connection if read else connection}
+    return {shard.name: functools.partial(_shard_connection, shard) for shard in shard_map.shards}
+
+
+async def _call(fn, name, factory):
+    async with factory() as conn:
+        return await fn(name, conn)
+
+
+async def scatter(fn, read=True):
+    """
+    Same as `pool.scatter`, awaiting `fn(name, connection)` on every partition at once.
+
+    The calls run as tasks of the running event loop.
+    """
+    parts = partitions(read)
+    results = await asyncio.gather(*(_call(fn, name, factory) for name, factory in parts.items()))
+    return dict(zip(parts, results))
+
+
+async def close_pool():
+    """Close the pools of the running event loop; the next `get_pool()` builds a fresh one."""
+    loop = asyncio.get_running_loop()
+    creations = [_pools.pop(loop, None), *_replica_pools.pop(loop, {}).values(), *_shard_pools.pop(loop, {}).values()]
+    for creation in creations:
+        if creation is not None and creation.done() and not creation.exception():
+            db_pool = creation.result()
+            db_pool.close()
+            await db_pool.wait_closed()
+
+
+def _collect_metrics():
+    samples = []
+    creations = [*_pools.values(), *(creation for per_loop in _shard_pools.values() for creation in per_loop.values())]
+    for creation in list(creations):
+        if creation.done() and not creation.exception():
+            db_pool = creation.result()
+            samples.append((db_pool.freesize, db_pool.size - db_pool.freesize, db_pool.maxsize))
+    if not samples:
+        return []
+    return [
+        ("cofrap_db_async_pool_connections", "gauge", "Connections held by the asyncio pools.",
+         [((("state", "idle"),), sum(s[0] for s in samples)), ((("state", "in_use"),), sum(s[1] for s in samples))]),
+        ("cofrap_db_async_pool_max_size", "gauge", "Maximum number of connections of the asyncio pools.",
+         [((), sum(s[2] for s in samples))]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,288 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+
+from . import metrics, shutdown
+
+
+class ArtifactStore:
+    """Destination of the QR code artifacts produced by the provisioning functions."""
+
+    def put(self, name, data):
+        raise NotImplementedError
+
+    def cleanup(self):
+        """Remove artifacts past their retention; returns how many were removed."""
+        return 0
+
+
+class NullStore(ArtifactStore):
+    """Discard every artifact (responses already carry the QR code)."""
+
+    def put(self, name, data):
+        pass
+
+
+class LocalDirStore(ArtifactStore):
+    """
+    Write each artifact to `<directory>/<name>`, overwriting the previous one.
+
+    The directory is created on the first write, not at import time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._ready = False
+
+    def put(self, name, data):
+        if not self._ready:
+            os.makedirs(self.directory, exist_ok=True)
+            self._ready = True
+        path = os.path.join(self.directory, name)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+class ContentAddressedStore(ArtifactStore):
+    """
+    Store artifacts by SHA-256 under `<directory>/objects/` with name refs.
+
+    Identical payloads are written once. `<directory>/refs/<name>` holds the
+    digest of the latest payload stored under that name. `cleanup()` removes
+    objects and refs older than `retention` seconds.
+    """
+
+    def __init__(self, directory, retention=7 * 24 * 60 * 60):
+        self.directory = directory
+        self.retention = retention
+        self._objects = os.path.join(directory, "objects")
+        self._refs = os.path.join(directory, "refs")
+        self._ready = False
+
+    def object_path(self, digest, name):
+        extension = os.path.splitext(name)[1]
+        return os.path.join(self._objects, digest[:2], digest + extension)
+
+    def put(self, name, data):
+        if not self._ready:
+            os.makedirs(self._objects, exist_ok=True)
+            os.makedirs(self._refs, exist_ok=True)
+            self._ready = True
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest, name)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        ref = os.path.join(self._refs, name)
+        with open(f"{ref}.tmp", "w") as f:
+            f.write(digest)
+        os.replace(f"{ref}.tmp", ref)
+
+    def cleanup(self):
+        cutoff = time.time() - self.retention
+        removed = 0
+        for root in (self._objects, self._refs):
+            if not os.path.isdir(root):
+                continue
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+
+class BackgroundWriter:
+    """
+    Persist artifacts from a bounded queue on a daemon thread.
+
+    `submit()` never blocks the request: when the queue is full the artifact
+    is dropped and counted. `flush()` waits until everything queued so far
+    has been written.
+
+    Parameters
+    ----------
+    store : ArtifactStore
+        Backend the artifacts are written to.
+    max_queue : int
+        Maximum number of artifacts waiting to be written.
+    cleanup_interval : float
+        Seconds between two `store.cleanup()` runs on the writer thread.
+    """
+
+    def __init__(self, store, max_queue=256, cleanup_interval=3600):
+        self.store = store
+        self.max_queue = max_queue
+        self.cleanup_interval = cleanup_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._counters = {"submitted": 0, "written": 0, "dropped": 0, "failed": 0, "bytes_written": 0}
+        self._next_cleanup = time.monotonic() + cleanup_interval
+        self._thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, name, data):
+        """
+        Queue `data` to be stored as `name`.
+
+        Returns
+        -------
+        bool
+            False if the queue was full and the artifact was dropped.
+        """
+        try:
+            self._queue.put_nowait((name, data))
+        except queue.Full:
+            self._count(dropped=1)
+            return False
+        self._count(submitted=1)
+        return True
+
+    def _count(self, **increments):
+        # Request threads and the writer thread both update the counters
+        with self._lock:
+            for event, amount in increments.items():
+                self._counters[event] += amount
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.cleanup_interval)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                name, data = item
+                try:
+                    self.store.put(name, data)
+                    self._count(written=1, bytes_written=len(data))
+                except Exception:
+                    self._count(failed=1)
+                finally:
+                    self._queue.task_done()
+            if time.monotonic() >= self._next_cleanup:
+                self._next_cleanup = time.monotonic() + self.cleanup_interval
+                try:
+                    self.store.cleanup()
+                except Exception:
+                    pass
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued artifact has been written.
+
+        Parameters
+        ----------
+        timeout : float or None
+            Maximum seconds to wait; None waits indefinitely.
+
+        Returns
+        -------
+        bool
+            True if the queue was fully drained.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self):
+        """
+        Return the queue depth and the writer counters.
+
+        Returns
+        -------
+        dict
+            `queue_depth`, `max_queue`, `submitted`, `written`, `dropped`,
+            `failed` and `bytes_written`.
+        """
+        snapshot = {"queue_depth": self._queue.qsize(), "max_queue": self.max_queue}
+        with self._lock:
+            snapshot.update(self._counters)
+        return snapshot
+
+
+def store_from_env():
+    """
+    Build the artifact store selected by `ARTIFACT_STORE`.
+
+    `local` (default) writes to `ARTIFACT_DIR`, `cas` keeps content-addressed
+    objects there for `ARTIFACT_RETENTION` seconds, `none` discards them.
+    """
+    kind = os.environ.get("ARTIFACT_STORE", "local").lower()
+    directory = os.environ.get("ARTIFACT_DIR", "/home/app/qrcodes")
+    if kind == "none":
+        return NullStore()
+    if kind == "local":
+        return LocalDirStore(directory)
+    if kind == "cas":
+        return ContentAddressedStore(directory, retention=float(os.environ.get("ARTIFACT_RETENTION", 7 * 24 * 60 * 60)))
+    raise ValueError(f"unsupported ARTIFACT_STORE: {kind}")
+
+
+SHUTDOWN_FLUSH_TIMEOUT = float(os.environ.get("ARTIFACT_SHUTDOWN_TIMEOUT", 10))
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the worker-wide background writer, creating it on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BackgroundWriter(
+                    store_from_env(),
+                    max_queue=int(os.environ.get("ARTIFACT_QUEUE_SIZE", 256)),
+                )
+    return _writer
+
+
+def _collect_metrics():
+    current = _writer
+    if current is None:
+        return []
+    stats = current.stats()
+    return [
+        ("cofrap_artifact_queue_depth", "gauge", "Artifacts waiting to be written.", [((), stats["queue_depth"])]),
+        ("cofrap_artifact_queue_max_size", "gauge", "Capacity of the artifact queue.", [((), stats["max_queue"])]),
+        ("cofrap_artifact_events_total", "counter", "Artifact writer outcomes.",
+         [((("event", key),), stats[key]) for key in ("submitted", "written", "dropped", "failed")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def reset_writer():
+    """Flush and drop the worker-wide writer; the next `get_writer()` builds a fresh one."""
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.flush(SHUTDOWN_FLUSH_TIMEOUT)
+        _writer = None
+
+
+def flush_on_shutdown():
+    if _writer is not None:
+        _writer.flush(SHUTDOWN_FLUSH_TIMEOUT)
+
+
+shutdown.on_shutdown(flush_on_shutdown)
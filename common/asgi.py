@@ -0,0 +1,75 @@
+from urllib.parse import parse_qsl
+
+from . import aiopool, metrics
+
+
+def app_for(handle_async):
+    """
+    Build an ASGI application around `handle_async(req, method=..., query=..., headers=...)`.
+
+    The python3-flask template calls the synchronous `handle()` from a pool
+    of worker threads, so a replica holds as many in-flight requests as it
+    has workers. Served by an ASGI server instead (e.g. `uvicorn handler:app`),
+    every request is a coroutine on one event loop and a replica can keep
+    hundreds of requests waiting on MariaDB at once.
+
+    - `GET /metrics` returns the Prometheus exposition of this replica.
+    - Any other request passes its body (str), method, query parameters
+      (dict) and headers (dict, lower-case names) to the handler; the result
+      may be a body, `(body, status)` or `(body, status, headers)`, where the
+      body is a str, bytes or an async iterator of str chunks (streamed).
+    - The asyncio database pool is closed on lifespan shutdown.
+    """
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await _lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        method = scope["method"]
+        if method == "GET" and scope["path"] == metrics.METRICS_PATH:
+            await _send(send, metrics.REGISTRY.render(), 200, {"Content-Type": metrics.PROMETHEUS_CONTENT_TYPE})
+            return
+
+        chunks = []
+        more = True
+        while more:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more = message.get("more_body", False)
+        query = dict(parse_qsl(scope.get("query_string", b"").decode()))
+        request_headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+
+        body, status, headers = metrics.as_triple(
+            await handle_async(b"".join(chunks).decode(), method=method, query=query, headers=request_headers)
+        )
+        await _send(send, body, status, headers)
+
+    return app
+
+
+async def _send(send, body, status, headers):
+    headers = {"Content-Type": "application/json", **headers}
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode(), str(v).encode()) for k, v in headers.items()],
+    })
+    if isinstance(body, (str, bytes)):
+        await send({"type": "http.response.body", "body": body.encode() if isinstance(body, str) else body})
+        return
+    async for chunk in body:
+        await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await aiopool.close_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,262 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from . import lazy, metrics
+from .deadline import DeadlineExceeded
+
+pymysql = lazy.module("pymysql")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the database while the breaker is open."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"database unavailable, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class Saturated(Exception):
+    """
+    Base of the errors refusing a call because a local resource is full.
+
+    A saturated pool on this side says nothing about the health of the
+    database: the breaker does not record these calls. `retry_after` is
+    the `Retry-After` hint, in seconds.
+    """
+
+    retry_after = 1
+
+
+def is_failure(exc):
+    """
+    Tell whether `exc` says the database is unhealthy.
+
+    Connection losses, socket timeouts and spent deadlines count; a bad
+    query or a constraint violation is an answer from a working database.
+    """
+    if isinstance(exc, (OSError, DeadlineExceeded)):
+        return True
+    return isinstance(exc, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the database keeps failing, instead of queueing on it.
+
+    The outcomes of the calls of the last `window` seconds are counted;
+    once there are at least `min_calls` of them and the share of failures
+    (see `is_failure`) reaches `failure_ratio`, the breaker opens and calls
+    are refused with `CircuitOpen` for `open_seconds`. It is then half open:
+    up to `half_open_calls` probes go through, and closes it once they all
+    succeed; one failed probe opens it again.
+
+    Parameters
+    ----------
+    failure_ratio : float
+        Share of failed calls that opens the breaker.
+    min_calls : int
+        Calls needed in the window before the ratio is considered.
+    window : float
+        Seconds of outcomes taken into account.
+    open_seconds : float
+        Seconds calls are refused once the breaker opened.
+    half_open_calls : int
+        Concurrent probes allowed, and successes needed to close again.
+    """
+
+    def __init__(self, failure_ratio=0.5, min_calls=20, window=10, open_seconds=5, half_open_calls=1,
+                 clock=time.monotonic):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._outcomes = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._counters = {"opened": 0, "rejected": 0}
+
+    @contextmanager
+    def guard(self):
+        """
+        Run a `with` block as one call through the breaker.
+
+        Raises
+        ------
+        CircuitOpen
+            Without running the block, while the breaker is open.
+        """
+        probe = self._admit()
+        try:
+            yield
+        except Saturated:
+            self._forget(probe)
+            raise
+        except BaseException as exc:
+            self._record(is_failure(exc), probe)
+            raise
+        else:
+            self._record(False, probe)
+
+    def _admit(self):
+        with self._lock:
+            now = self._clock()
+            if self.state == OPEN:
+                waited = now - self._opened_at
+                if waited < self.open_seconds:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpen(self.open_seconds - waited)
+                self.state = HALF_OPEN
+                self._probes = self._probe_successes = 0
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpen(min(self.open_seconds, 1.0))
+                self._probes += 1
+                return True
+            return False
+
+    def _forget(self, probe):
+        # A call without outcome: give its probe slot back
+        if probe:
+            with self._lock:
+                if self.state == HALF_OPEN:
+                    self._probes -= 1
+
+    def _record(self, failed, probe):
+        with self._lock:
+            now = self._clock()
+            if probe:
+                if self.state != HALF_OPEN:
+                    return
+                if failed:
+                    self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self.state = CLOSED
+                return
+            if self.state != CLOSED:
+                # Outcome of a call admitted before the breaker opened
+                return
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            horizon = now - self.window
+            while self._outcomes and self._outcomes[0][0] < horizon:
+                self._failures -= self._outcomes.popleft()[1]
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures >= self.failure_ratio * calls:
+                self._open(now)
+
+    def _open(self, now):
+        # Caller holds the lock
+        self.state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+        self._counters["opened"] += 1
+
+    def stats(self):
+        """
+        Return the breaker state and counters.
+
+        Returns
+        -------
+        dict
+            `state` (`closed`, `open` or `half_open`), `calls` and `failures`
+            in the current window, and the `opened` and `rejected` counters.
+        """
+        with self._lock:
+            snapshot = {"state": self.state, "calls": len(self._outcomes), "failures": self._failures}
+            snapshot.update(self._counters)
+        return snapshot
+
+
+# Errors meaning "try again later" rather than "this request is wrong"
+UNAVAILABLE_ERRORS = (CircuitOpen, DeadlineExceeded, Saturated)
+
+
+def unavailable(exc):
+    """
+    Describe a request refused by the breaker, by a saturated pool or out of time.
+
+    Parameters
+    ----------
+    exc : CircuitOpen, Saturated or DeadlineExceeded
+        The error caught by the handler.
+
+    Returns
+    -------
+    tuple
+        `(status, message, http_status, headers)`: `"unavailable"` with 503
+        and a `Retry-After` header for an open breaker or a saturated pool,
+        `"timeout"` with 504 for a spent deadline.
+    """
+    if isinstance(exc, CircuitOpen):
+        return "unavailable", "Database unavailable, retry later", 503, {"Retry-After": str(math.ceil(exc.retry_after))}
+    if isinstance(exc, Saturated):
+        return "unavailable", "Server busy, retry later", 503, {"Retry-After": str(math.ceil(exc.retry_after))}
+    return "timeout", "Request deadline exceeded", 504, {}
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_breaker():
+    """
+    Return the worker-wide breaker of the primary database, or None when `DB_BREAKER=0`.
+
+    Configured from `DB_BREAKER_FAILURE_RATIO` (default 0.5),
+    `DB_BREAKER_MIN_CALLS` (default 20), `DB_BREAKER_WINDOW` (default 10 s),
+    `DB_BREAKER_OPEN_SECONDS` (default 5 s) and `DB_BREAKER_HALF_OPEN_CALLS`
+    (default 1).
+    """
+    global _breaker
+    if os.environ.get("DB_BREAKER", "1") == "0":
+        return None
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    failure_ratio=float(os.environ.get("DB_BREAKER_FAILURE_RATIO", 0.5)),
+                    min_calls=int(os.environ.get("DB_BREAKER_MIN_CALLS", 20)),
+                    window=float(os.environ.get("DB_BREAKER_WINDOW", 10)),
+                    open_seconds=float(os.environ.get("DB_BREAKER_OPEN_SECONDS", 5)),
+                    half_open_calls=int(os.environ.get("DB_BREAKER_HALF_OPEN_CALLS", 1)),
+                )
+    return _breaker
+
+
+def _collect_metrics():
+    current = _breaker
+    if current is None:
+        return []
+    stats = current.stats()
+    return [
+        ("cofrap_db_breaker_state", "gauge", "Circuit breaker of the primary database (1 for the current state).",
+         [((("state", state),), int(stats["state"] == state)) for state in (CLOSED, OPEN, HALF_OPEN)]),
+        ("cofrap_db_breaker_events_total", "counter", "Circuit breaker openings and refused calls.",
+         [((("event", key),), stats[key]) for key in ("opened", "rejected")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def reset_breaker():
+    """Drop the worker-wide breaker; the next `get_breaker()` starts closed."""
+    global _breaker
+    with _breaker_lock:
+        _breaker = None
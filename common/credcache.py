@@ -0,0 +1,330 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics, versions
+
+# Must stay well above the cache TTL so no replica can miss an invalidation
+CHANGE_RETENTION = 24 * 60 * 60
+
+# AUTO_INCREMENT ids are taken at INSERT time, not at commit: a missing id may
+# still show up once its transaction commits. It is read again for this long,
+# well above any write transaction (bounded by REQUEST_DEADLINE)
+CHANGE_GAP_TIMEOUT = 60
+MAX_CHANGE_GAPS = 10000
+
+LAST_CHANGE_SQL = "SELECT COALESCE(MAX(id), 0) FROM credential_changes"
+CHANGES_SQL = "SELECT id, username FROM credential_changes WHERE id > %s ORDER BY id"
+PUBLISH_CHANGE_SQL = "INSERT INTO credential_changes (username, changed_at) VALUES (%s, %s)"
+PRUNE_CHANGES_SQL = "DELETE FROM credential_changes WHERE changed_at < UNIX_TIMESTAMP() - %s"
+
+
+class Credentials:
+    """
+    Decoded credential material of one user, ready for verification.
+
+    `password` is a `hashing.PasswordHash`, or the plaintext of a legacy
+    base64 row.
+    """
+
+    __slots__ = ("password", "totp", "gendate", "expired")
+
+    def __init__(self, password, totp, gendate, expired):
+        self.password = password
+        self.totp = totp
+        self.gendate = gendate
+        self.expired = expired
+
+
+class CredentialCache:
+    """
+    Bounded LRU cache of `Credentials` keyed by username, with a TTL.
+
+    Rotations done by other functions are picked up through the
+    `credential_changes` table, polled by `sync()` at most once every
+    `sync_interval` seconds.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of cached users; least recently used are evicted first.
+    ttl : float
+        Seconds an entry may be served before it is read from the database again.
+    sync_interval : float
+        Minimum delay in seconds between two polls of `credential_changes`.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, sync_interval=5, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._positions = {}
+        self._next_sync = 0
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, username):
+        """Return the cached `Credentials` for `username`, or None on a miss."""
+        with self._lock:
+            item = self._entries.get(username)
+            if item is None:
+                self._counters["misses"] += 1
+                return None
+            creds, stored_at = item
+            if self._clock() - stored_at > self.ttl:
+                del self._entries[username]
+                self._counters["expirations"] += 1
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(username)
+            self._counters["hits"] += 1
+            return creds
+
+    def put(self, username, creds):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[username] = (creds, self._clock())
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def invalidate(self, username):
+        with self._lock:
+            if self._entries.pop(username, None) is not None:
+                self._counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def sync(self, connection):
+        """
+        Drop entries rotated by other replicas since the previous poll.
+
+        Parameters
+        ----------
+        connection : callable or dict
+            Factory returning a context manager that yields a DB connection,
+            e.g. `pool.get_pool().connection`, or a dict of factories such as
+            `pool.partitions()`: each shard has its own feed. Only called when
+            a poll is due.
+
+        Notes
+        -----
+        If a feed cannot be read, the whole cache is cleared and the poll
+        stays due: stale credentials are never served on a failed sync.
+        Ids can commit out of order across writers: an id skipped by a poll
+        is picked up by a later one if it commits within `CHANGE_GAP_TIMEOUT`
+        seconds, and each change is applied once.
+        """
+        if self._clock() < self._next_sync:
+            return
+        feeds = connection if isinstance(connection, dict) else {None: connection}
+        positions = {}
+        try:
+            for name, factory in feeds.items():
+                position = self._positions.get(name)
+                with factory() as conn:
+                    with conn.cursor() as cursor:
+                        if position is None:
+                            cursor.execute(LAST_CHANGE_SQL)
+                            positions[name] = self._start_feed(cursor.fetchone()[0])
+                        else:
+                            cursor.execute(CHANGES_SQL, (_read_after(position),))
+                            positions[name] = self._apply_changes(cursor.fetchall(), position)
+        except Exception:
+            self.clear()
+            return
+        self._positions = positions
+        self._next_sync = self._clock() + self.sync_interval
+
+    async def sync_async(self, connection):
+        """
+        Same as `sync`, for async connection factories such as `aiopool.connection`.
+
+        The poll is claimed before the first await, so the coroutines of a
+        burst of logins do not all query the feed at once.
+        """
+        if self._clock() < self._next_sync:
+            return
+        self._next_sync = self._clock() + self.sync_interval
+        feeds = connection if isinstance(connection, dict) else {None: connection}
+        positions = {}
+        try:
+            for name, factory in feeds.items():
+                position = self._positions.get(name)
+                async with factory() as conn:
+                    async with conn.cursor() as cursor:
+                        if position is None:
+                            await cursor.execute(LAST_CHANGE_SQL)
+                            positions[name] = self._start_feed((await cursor.fetchone())[0])
+                        else:
+                            await cursor.execute(CHANGES_SQL, (_read_after(position),))
+                            positions[name] = self._apply_changes(await cursor.fetchall(), position)
+        except Exception:
+            self.clear()
+            self._next_sync = 0.0
+            return
+        self._positions = positions
+
+    def _start_feed(self, last_id):
+        # Nothing cached before the first poll can be trusted
+        self.clear()
+        return last_id, {}
+
+    def _apply_changes(self, rows, position):
+        """
+        Invalidate the users of `rows` not applied yet; return the new position of the feed.
+
+        A position is `(last_id, gaps)`: the highest id read, and the ids
+        below it not seen yet, mapped to when they stop being waited for.
+        """
+        last_id, gaps = position
+        now = self._clock()
+        gaps = {change_id: until for change_id, until in gaps.items() if until > now}
+        for change_id, username in rows:
+            if change_id <= last_id:
+                if gaps.pop(change_id, None) is None:
+                    # Re-read while waiting for an older id: already applied
+                    continue
+            else:
+                for missing in range(max(last_id + 1, change_id - MAX_CHANGE_GAPS), change_id):
+                    gaps[missing] = now + CHANGE_GAP_TIMEOUT
+                last_id = change_id
+            self.invalidate(username)
+            _notify(username)
+        if len(gaps) > MAX_CHANGE_GAPS:
+            gaps = dict(sorted(gaps.items())[-MAX_CHANGE_GAPS:])
+        return last_id, gaps
+
+    def stats(self):
+        """
+        Return the cache size and its hit/miss/eviction counters.
+
+        Returns
+        -------
+        dict
+            `size`, `max_size`, `hits`, `misses`, `evictions`, `expirations`
+            and `invalidations`.
+        """
+        with self._lock:
+            snapshot = {"size": len(self._entries), "max_size": self.max_size}
+            snapshot.update(self._counters)
+        return snapshot
+
+
+def _read_after(position):
+    # Read again from the oldest id that may still commit
+    last_id, gaps = position
+    return min(gaps) - 1 if gaps else last_id
+
+
+def publish_invalidation(cursor, username):
+    """
+    Announce that the credentials of `username` were rotated.
+
+    Call it with the cursor that performed the rotation. The in-process cache
+    is invalidated immediately; other authenticate-user replicas drop their
+    copy at their next `CredentialCache.sync()`. The version of the `users`
+    table is bumped as well (see `common.versions`).
+
+    Parameters
+    ----------
+    cursor : pymysql.cursors.Cursor
+        Cursor of the connection that wrote the new credentials.
+    username : str
+        The user whose password or MFA secret changed.
+    """
+    publish_invalidations(cursor, [username])
+
+
+def publish_invalidations(cursor, usernames):
+    """Same as `publish_invalidation` for several users, with one multi-row INSERT."""
+    cursor.executemany(PUBLISH_CHANGE_SQL, [(username, int(time.time())) for username in usernames])
+    cursor.execute(PRUNE_CHANGES_SQL, (CHANGE_RETENTION,))
+    versions.bump(cursor)
+    _invalidate_local(usernames)
+
+
+async def publish_invalidations_async(cursor, usernames):
+    """Same as `publish_invalidations` with an `aiomysql` cursor."""
+    await cursor.executemany(PUBLISH_CHANGE_SQL, [(username, int(time.time())) for username in usernames])
+    await cursor.execute(PRUNE_CHANGES_SQL, (CHANGE_RETENTION,))
+    await versions.bump_async(cursor)
+    _invalidate_local(usernames)
+
+
+def _invalidate_local(usernames):
+    cache = get_cache()
+    for username in usernames:
+        cache.invalidate(username)
+        _notify(username)
+
+
+_listeners = []
+
+
+def register_listener(listener):
+    """
+    Call `listener(username)` for every credential change seen by this replica.
+
+    Changes published locally and changes read from the `credential_changes`
+    feed by `CredentialCache.sync()` are both reported; a creation is a
+    change like any other.
+    """
+    _listeners.append(listener)
+
+
+def _notify(username):
+    for listener in _listeners:
+        listener(username)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Return the worker-wide credential cache, creating it on first use.
+
+    Sizing is read from `CREDENTIAL_CACHE_SIZE` (0 disables caching),
+    `CREDENTIAL_CACHE_TTL` and `CREDENTIAL_CACHE_SYNC_INTERVAL`.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CredentialCache(
+                    max_size=int(os.environ.get("CREDENTIAL_CACHE_SIZE", 10000)),
+                    ttl=float(os.environ.get("CREDENTIAL_CACHE_TTL", 60)),
+                    sync_interval=float(os.environ.get("CREDENTIAL_CACHE_SYNC_INTERVAL", 5)),
+                )
+    return _cache
+
+
+def _collect_metrics():
+    current = _cache
+    if current is None:
+        return []
+    stats = current.stats()
+    return [
+        ("cofrap_credential_cache_entries", "gauge", "Users held by the credential cache.", [((), stats["size"])]),
+        ("cofrap_credential_cache_events_total", "counter", "Credential cache lookups and evictions.",
+         [((("event", key),), stats[key]) for key in ("hits", "misses", "evictions", "expirations", "invalidations")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def reset_cache():
+    """Drop the worker-wide cache; the next `get_cache()` builds a fresh one."""
+    global _cache
+    with _cache_lock:
+        _cache = None
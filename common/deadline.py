@@ -0,0 +1,77 @@
+import contextvars
+import os
+import time
+
+# Monotonic time by which the current request must be answered, None outside of one
+_deadline = contextvars.ContextVar("cofrap_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the time budget of the current request is spent."""
+
+
+def request_budget():
+    """
+    Return the time budget of a request in seconds, 0 for none.
+
+    Read from `REQUEST_DEADLINE` (default 10, the exec timeout of the
+    OpenFaaS watchdog: past it the gateway has given up on the answer).
+    """
+    return float(os.environ.get("REQUEST_DEADLINE", 10))
+
+
+def start(budget=None):
+    """
+    Give the current context `budget` seconds (default: `request_budget()`).
+
+    A nested call never extends the deadline already set.
+
+    Returns
+    -------
+    contextvars.Token
+        To pass to `reset()` when the request is answered.
+    """
+    budget = request_budget() if budget is None else budget
+    at = time.monotonic() + budget if budget > 0 else None
+    current = _deadline.get()
+    if current is not None and (at is None or current < at):
+        at = current
+    return _deadline.set(at)
+
+
+def reset(token):
+    _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left to the current request, None without a deadline (may be negative)."""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check(operation="the next step"):
+    """Raise `DeadlineExceeded` if the current request has no time left for `operation`."""
+    if expired():
+        raise DeadlineExceeded(f"deadline exceeded before {operation}")
+
+
+def bound(timeout, operation="the next step"):
+    """
+    Cap `timeout` (seconds, None for unbounded) by the time left to the current request.
+
+    Raises
+    ------
+    DeadlineExceeded
+        If no time is left.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded(f"deadline exceeded before {operation}")
+    return left if timeout is None else min(timeout, left)
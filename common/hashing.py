@@ -0,0 +1,416 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import breaker, deadline, metrics
+
+PREFIX = "$scrypt$"
+SALT_BYTES = 16
+DIGEST_BYTES = 32
+# Highest cost the calibration may pick: 2**16 * 128 * r bytes = 64 MiB at r=8
+MAX_LN = 16
+
+
+class HashingBusy(breaker.Saturated):
+    """Raised when the hashing pool is saturated for longer than `HASH_QUEUE_TIMEOUT`."""
+
+
+class ScryptParams:
+    """
+    scrypt cost parameters: `n = 2 ** ln` rounds, block size `r`, parallelism `p`.
+    """
+
+    __slots__ = ("ln", "r", "p")
+
+    def __init__(self, ln, r=8, p=1):
+        self.ln = ln
+        self.r = r
+        self.p = p
+
+    @property
+    def n(self):
+        return 1 << self.ln
+
+    @property
+    def maxmem(self):
+        # OpenSSL refuses to allocate more than `maxmem`; leave room for its overhead
+        return 256 * self.r * self.n * self.p + (1 << 20)
+
+    def __eq__(self, other):
+        return isinstance(other, ScryptParams) and (self.ln, self.r, self.p) == (other.ln, other.r, other.p)
+
+    def __repr__(self):
+        return f"ScryptParams(ln={self.ln}, r={self.r}, p={self.p})"
+
+
+class PasswordHash:
+    """
+    A parsed `$scrypt$ln=<ln>,r=<r>,p=<p>$<salt>$<digest>` value of `users.password`.
+
+    The cost parameters travel with every row, so rows hashed with different
+    costs verify side by side.
+    """
+
+    __slots__ = ("params", "salt", "digest")
+
+    def __init__(self, params, salt, digest):
+        self.params = params
+        self.salt = salt
+        self.digest = digest
+
+    @classmethod
+    def parse(cls, encoded):
+        try:
+            settings, salt, digest = encoded[len(PREFIX):].split("$")
+            values = dict(item.split("=") for item in settings.split(","))
+            params = ScryptParams(int(values["ln"]), int(values["r"]), int(values["p"]))
+            return cls(params, _b64decode(salt), _b64decode(digest))
+        except (ValueError, KeyError) as e:
+            raise ValueError("malformed password hash") from e
+
+    @property
+    def encoded(self):
+        p = self.params
+        return f"{PREFIX}ln={p.ln},r={p.r},p={p.p}${_b64encode(self.salt)}${_b64encode(self.digest)}"
+
+
+def _b64encode(raw):
+    return base64.b64encode(raw).decode().rstrip("=")
+
+
+def _b64decode(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+def is_hash(stored):
+    """Return True if a `users.password` value is a KDF hash rather than legacy base64."""
+    return stored.startswith(PREFIX)
+
+
+def scrypt(password, salt, ln, r, p):
+    """Derive the digest of `password`; runs in the hashing pool's workers."""
+    params = ScryptParams(ln, r, p)
+    return hashlib.scrypt(password.encode(), salt=salt, n=params.n, r=r, p=p, maxmem=params.maxmem,
+                          dklen=DIGEST_BYTES)
+
+
+def calibrate(target_ms, r=8, p=1, max_ln=MAX_LN):
+    """
+    Pick the smallest `ln` whose hash takes at least `target_ms` on this host.
+
+    Returns
+    -------
+    ScryptParams
+    """
+    salt = os.urandom(SALT_BYTES)
+    ln = 10
+    while ln < max_ln:
+        start = time.perf_counter()
+        scrypt("calibration", salt, ln, r, p)
+        if (time.perf_counter() - start) * 1000 >= target_ms:
+            break
+        ln += 1
+    return ScryptParams(ln, r, p)
+
+
+_params = None
+_params_lock = threading.Lock()
+
+
+def current_params():
+    """
+    Return the cost used for new hashes.
+
+    `PASSWORD_HASH_LN` (with `PASSWORD_HASH_R`, `PASSWORD_HASH_P`) pins it,
+    which keeps every replica on the same cost; otherwise it is calibrated
+    once per worker to `PASSWORD_HASH_TARGET_MS` (default 50 ms).
+    """
+    global _params
+    if _params is None:
+        with _params_lock:
+            if _params is None:
+                r = int(os.environ.get("PASSWORD_HASH_R", 8))
+                p = int(os.environ.get("PASSWORD_HASH_P", 1))
+                ln = os.environ.get("PASSWORD_HASH_LN")
+                if ln:
+                    _params = ScryptParams(int(ln), r, p)
+                else:
+                    _params = calibrate(float(os.environ.get("PASSWORD_HASH_TARGET_MS", 50)), r, p)
+    return _params
+
+
+def needs_rehash(verifier):
+    """
+    Tell whether a stored password should be hashed again at the next login.
+
+    Legacy plaintext verifiers always are; hashes only when weaker than the
+    current cost, so replicas calibrated differently never undo each other.
+    """
+    if not isinstance(verifier, PasswordHash):
+        return True
+    current = current_params()
+    return (verifier.params.ln, verifier.params.r, verifier.params.p) < (current.ln, current.r, current.p)
+
+
+class HashingPool:
+    """
+    Bounded executor running the KDF out of the request thread.
+
+    At most `max_pending` hashes are queued or running; a caller that cannot
+    get a slot within `queue_timeout` seconds gets `HashingBusy` instead of
+    piling up behind an overloaded host. Hashes submitted as part of a
+    batch (bulk provisioning, batch logins) hold at most `max_batch_pending`
+    of those slots together, so single logins always find room; a batch
+    waits for its own earlier hashes, within the request deadline.
+
+    Parameters
+    ----------
+    executor : concurrent.futures.Executor
+        Where `scrypt` runs: a process pool by default (`HASH_EXECUTOR=process`).
+    max_pending : int
+        Hashes admitted at once.
+    queue_timeout : float
+        Seconds to wait for a slot.
+    max_batch_pending : int, optional
+        Slots batches may hold at once; half of `max_pending` by default.
+    """
+
+    def __init__(self, executor, max_pending, queue_timeout=1.0, max_batch_pending=None):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.max_batch_pending = max(1, max_pending // 2) if max_batch_pending is None else max_batch_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._batch_slots = threading.BoundedSemaphore(self.max_batch_pending)
+        self._lock = threading.Lock()
+        self._counters = {"submitted": 0, "rejected": 0}
+        self._in_flight = 0
+
+    def submit(self, password, salt, params, batch=False):
+        """
+        Start hashing `password`; returns a `concurrent.futures.Future` of the digest.
+
+        With `batch`, the hash first waits for one of the batch slots.
+        """
+        if batch:
+            self._hold_batch_slot(self._batch_slots.acquire(timeout=deadline.bound(None, "waiting for a password hashing slot")))
+        return self._start(self._slots.acquire(timeout=self.queue_timeout), password, salt, params, batch)
+
+    async def submit_async(self, password, salt, params, batch=False):
+        """Same as `submit`, waiting for a slot without blocking the event loop."""
+        if batch:
+            acquired = self._batch_slots.acquire(blocking=False)
+            if not acquired:
+                acquired = await asyncio.to_thread(
+                    self._batch_slots.acquire, timeout=deadline.bound(None, "waiting for a password hashing slot")
+                )
+            self._hold_batch_slot(acquired)
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            acquired = await asyncio.to_thread(self._slots.acquire, timeout=self.queue_timeout)
+        return self._start(acquired, password, salt, params, batch)
+
+    def _hold_batch_slot(self, acquired):
+        if not acquired:
+            raise deadline.DeadlineExceeded("deadline exceeded waiting for a password hashing slot")
+
+    def _start(self, acquired, password, salt, params, batch):
+        if not acquired:
+            if batch:
+                self._batch_slots.release()
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise HashingBusy(f"password hashing saturated ({self.max_pending} pending)")
+        with self._lock:
+            self._counters["submitted"] += 1
+            self._in_flight += 1
+        release = functools.partial(self._release, batch)
+        try:
+            future = self.executor.submit(scrypt, password, salt, params.ln, params.r, params.p)
+        except BaseException:
+            release()
+            raise
+        future.add_done_callback(release)
+        return future
+
+    def _release(self, batch, _future=None):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+        if batch:
+            self._batch_slots.release()
+
+    def stats(self):
+        with self._lock:
+            snapshot = {"in_flight": self._in_flight, "max_pending": self.max_pending, "max_batch_pending": self.max_batch_pending}
+            snapshot.update(self._counters)
+        return snapshot
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the worker-wide hashing pool.
+
+    Configured from `HASH_EXECUTOR` (`process`, or `thread`: `hashlib.scrypt`
+    releases the GIL), `HASH_WORKERS` (default: CPU count, at most 4),
+    `HASH_MAX_PENDING` (default 4 per worker), `HASH_BATCH_MAX_PENDING`
+    (default half of it) and `HASH_QUEUE_TIMEOUT`.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = int(os.environ.get("HASH_WORKERS", min(os.cpu_count() or 1, 4)))
+                max_pending = int(os.environ.get("HASH_MAX_PENDING", workers * 4))
+                if os.environ.get("HASH_EXECUTOR", "process") == "thread":
+                    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cofrap-hash")
+                else:
+                    # Forking a threaded server is unsafe: start clean interpreters
+                    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                _pool = HashingPool(
+                    executor,
+                    max_pending=max_pending,
+                    queue_timeout=float(os.environ.get("HASH_QUEUE_TIMEOUT", 1)),
+                    max_batch_pending=int(os.environ.get("HASH_BATCH_MAX_PENDING", max(1, max_pending // 2))),
+                )
+    return _pool
+
+
+def reset_pool():
+    """Shut the worker-wide pool down and forget the current cost; both are rebuilt on next use."""
+    global _params, _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = None
+    with _params_lock:
+        _params = None
+
+
+def hash_password(password):
+    """
+    Hash `password` with a fresh salt at the current cost.
+
+    Returns
+    -------
+    str
+        The value to store in `users.password`.
+    """
+    return hash_passwords([password])[0]
+
+
+def hash_passwords(passwords):
+    """
+    Same as `hash_password` for several passwords, hashed in parallel by the pool.
+
+    A batch of `n` passwords takes about `n / HASH_WORKERS` times the target
+    cost; it holds at most `HASH_BATCH_MAX_PENDING` pool slots, the rest
+    staying free for concurrent logins.
+    """
+    params = current_params()
+    salts = [os.urandom(SALT_BYTES) for _ in passwords]
+    with metrics.phase("password_hash"):
+        batch = len(passwords) > 1
+        futures = [get_pool().submit(password, salt, params, batch) for password, salt in zip(passwords, salts)]
+        return [PasswordHash(params, salt, future.result()).encoded for salt, future in zip(salts, futures)]
+
+
+async def hash_passwords_async(passwords):
+    """Same as `hash_passwords`, awaiting the pool instead of blocking."""
+    params = current_params()
+    salts = [os.urandom(SALT_BYTES) for _ in passwords]
+    with metrics.phase("password_hash"):
+        batch = len(passwords) > 1
+        futures = [await get_pool().submit_async(password, salt, params, batch) for password, salt in zip(passwords, salts)]
+        digests = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+    return [PasswordHash(params, salt, digest).encoded for salt, digest in zip(salts, digests)]
+
+
+def _check(password, verifier, digest):
+    if not isinstance(verifier, PasswordHash):
+        return hmac.compare_digest(password.encode(), verifier.encode())
+    return hmac.compare_digest(digest, verifier.digest)
+
+
+def verify(password, verifier):
+    """
+    Check `password` against a stored verifier.
+
+    Parameters
+    ----------
+    password : str
+        The password typed by the user.
+    verifier : PasswordHash or str
+        A parsed hash, or the decoded plaintext of a legacy base64 row.
+
+    Returns
+    -------
+    bool
+    """
+    return verify_many([(password, verifier)])[0]
+
+
+def verify_many(pairs):
+    """
+    Same as `verify` for several `(password, verifier)` pairs, checked in parallel by the pool.
+
+    Returns
+    -------
+    list of bool
+    """
+    with metrics.phase("password_verify"):
+        batch = len(pairs) > 1
+        futures = [
+            get_pool().submit(password, verifier.salt, verifier.params, batch) if isinstance(verifier, PasswordHash) else None
+            for password, verifier in pairs
+        ]
+        digests = [future.result() if future is not None else None for future in futures]
+    return [_check(password, verifier, digest) for (password, verifier), digest in zip(pairs, digests)]
+
+
+async def verify_async(password, verifier):
+    """Same as `verify`, awaiting the pool instead of blocking."""
+    return (await verify_many_async([(password, verifier)]))[0]
+
+
+async def verify_many_async(pairs):
+    """Same as `verify_many`, awaiting the pool instead of blocking."""
+    with metrics.phase("password_verify"):
+        batch = len(pairs) > 1
+        futures = [
+            await get_pool().submit_async(password, verifier.salt, verifier.params, batch)
+            if isinstance(verifier, PasswordHash) else None
+            for password, verifier in pairs
+        ]
+        digests = [await asyncio.wrap_future(future) if future is not None else None for future in futures]
+    return [_check(password, verifier, digest) for (password, verifier), digest in zip(pairs, digests)]
+
+
+def _collect_metrics():
+    current = _pool
+    if current is None:
+        return []
+    stats = current.stats()
+    return [
+        ("cofrap_password_hash_in_flight", "gauge", "Password hashes queued or running.", [((), stats["in_flight"])]),
+        ("cofrap_password_hash_max_pending", "gauge", "Password hashes admitted at once.", [((), stats["max_pending"])]),
+        ("cofrap_password_hash_events_total", "counter", "Password hashes submitted or rejected as busy.",
+         [((("event", key),), stats[key]) for key in ("submitted", "rejected")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
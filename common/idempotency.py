@@ -0,0 +1,355 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import deadline, metrics
+
+KEY_HEADER = "Idempotency-Key"
+KEY_FIELD = "idempotency_key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyError(Exception):
+    """A request whose idempotency key cannot be honoured; `status` is the HTTP status to answer with."""
+
+    status = 422
+
+
+class InvalidKey(IdempotencyError):
+    """Raised for an idempotency key that is not a string of 1 to `MAX_KEY_LENGTH` characters."""
+
+    status = 400
+
+
+class KeyConflict(IdempotencyError):
+    """Raised when a key already used, or in use, comes with a different request body."""
+
+    status = 422
+
+
+def request_key(payload, headers):
+    """
+    Return the idempotency key of a request, or None if it has none.
+
+    Read from the `Idempotency-Key` header, else from the `idempotency_key`
+    field of the JSON body.
+
+    Parameters
+    ----------
+    payload : dict
+        The decoded request body.
+    headers : mapping
+        Request headers: a Flask `request.headers`, or the lower-cased dict
+        given to the asyncio handlers.
+
+    Raises
+    ------
+    InvalidKey
+        If the key is not a non-empty string of at most `MAX_KEY_LENGTH` characters.
+    """
+    key = headers.get(KEY_HEADER.lower())
+    if key is None and isinstance(payload, dict):
+        key = payload.get(KEY_FIELD)
+    if key is None:
+        return None
+    if not isinstance(key, str) or not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise InvalidKey(f"idempotency key must be a string of 1 to {MAX_KEY_LENGTH} characters")
+    return key
+
+
+def fingerprint(payload):
+    """Return a digest of the request body, its idempotency key left out."""
+    if isinstance(payload, dict):
+        payload = {name: value for name, value in payload.items() if name != KEY_FIELD}
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def is_success(response):
+    """Default `cacheable` test: only `(body, status)` responses with a 2xx status are kept."""
+    return 200 <= response[1] < 300
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Flight:
+    """One execution in progress, awaited by the duplicates that arrive meanwhile."""
+
+    __slots__ = ("fingerprint", "done", "response", "futures")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.response = None
+        self.futures = []
+
+
+class IdempotencyStore:
+    """
+    Bounded LRU store of `(body, status)` responses keyed by idempotency key, with a TTL.
+
+    A request carrying a key already answered within `ttl` seconds gets the
+    stored response back without running again. Duplicates arriving while
+    the first one runs wait for it and share its response, whatever its
+    status: a single execution serves them all. Only responses passing
+    `cacheable` are stored, so a request that failed can be retried with the
+    same key. If the execution raises, the waiting duplicates run again,
+    one at a time.
+
+    Threads and event loops of the same process share the store; a worker
+    only sees its own keys.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of stored responses; least recently used are evicted
+        first. 0 stores nothing but still coalesces concurrent duplicates.
+    max_bytes : int
+        Maximum total length of the stored bodies: a bulk response can weigh
+        megabytes. A larger body is never stored.
+    ttl : float
+        Seconds a response can be replayed.
+    """
+
+    def __init__(self, max_size=1000, max_bytes=64 * 1024 * 1024, ttl=600, clock=time.monotonic):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counters = {"executions": 0, "replays": 0, "coalesced": 0, "conflicts": 0, "evictions": 0, "expirations": 0}
+
+    def _lookup(self, key, fingerprint):
+        # Caller holds the lock
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        stored_fingerprint, response, stored_at = item
+        if self._clock() - stored_at > self.ttl:
+            self._drop(key)
+            self._counters["expirations"] += 1
+            return None
+        if stored_fingerprint != fingerprint:
+            self._counters["conflicts"] += 1
+            raise KeyConflict("idempotency key already used with a different request")
+        self._entries.move_to_end(key)
+        self._counters["replays"] += 1
+        return response
+
+    def _drop(self, key):
+        # Caller holds the lock
+        _, response, _ = self._entries.pop(key)
+        self._bytes -= len(response[0])
+
+    def _store(self, key, fingerprint, response):
+        # Caller holds the lock
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (fingerprint, response, self._clock())
+        self._bytes += len(response[0])
+        while len(self._entries) > self.max_size or self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def _claim(self, key, fingerprint, loop=None):
+        """
+        Return `(response, flight, leader, future)` for a request of `key`.
+
+        Either a stored `response`, or the `flight` of `key`: the caller runs
+        it if `leader`, else waits for it, on `future` when it is on the
+        event loop `loop`.
+        """
+        with self._lock:
+            response = self._lookup(key, fingerprint)
+            if response is not None:
+                return response, None, False, None
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(fingerprint)
+                self._counters["executions"] += 1
+                return None, flight, True, None
+            if flight.fingerprint != fingerprint:
+                self._counters["conflicts"] += 1
+                raise KeyConflict("idempotency key in use by a different request")
+            self._counters["coalesced"] += 1
+            future = None
+            if loop is not None:
+                future = loop.create_future()
+                flight.futures.append((loop, future))
+            return None, flight, False, future
+
+    def _finish(self, key, flight, response, cacheable):
+        with self._lock:
+            del self._flights[key]
+            flight.response = response
+            if response is not None and self.max_size > 0 and len(response[0]) <= self.max_bytes and cacheable(response):
+                self._store(key, flight.fingerprint, response)
+            futures, flight.futures = flight.futures, []
+        flight.done.set()
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def run(self, key, fingerprint, execute, cacheable=is_success):
+        """
+        Return the response of `execute()` for `key`, running it at most once.
+
+        Parameters
+        ----------
+        key : hashable
+            The idempotency key, e.g. `(function name, client key)`.
+        fingerprint : str
+            Digest of the request (see `fingerprint`); a key reused with
+            another request is refused.
+        execute : callable
+            Produces the response, e.g. a `(body, status)` tuple.
+        cacheable : callable
+            Tells whether a response may be replayed later.
+
+        Returns
+        -------
+        tuple
+            `(response, replayed)`: `replayed` is False only for the call
+            that ran `execute`.
+
+        Raises
+        ------
+        KeyConflict
+            If `key` is stored or running with another fingerprint.
+        deadline.DeadlineExceeded
+            If the request runs out of time waiting for a duplicate.
+        """
+        while True:
+            response, flight, leader, _ = self._claim(key, fingerprint)
+            if response is not None:
+                return response, True
+            if leader:
+                break
+            if not flight.done.wait(deadline.bound(None, "waiting for a duplicate request")):
+                raise deadline.DeadlineExceeded("deadline exceeded waiting for a duplicate request")
+            if flight.response is not None:
+                return flight.response, True
+        response = None
+        try:
+            response = execute()
+        finally:
+            self._finish(key, flight, response, cacheable)
+        return response, False
+
+    async def run_async(self, key, fingerprint, execute, cacheable=is_success):
+        """Same as `run`, awaiting `execute()`; duplicates wait without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        while True:
+            response, flight, leader, future = self._claim(key, fingerprint, loop)
+            if response is not None:
+                return response, True
+            if leader:
+                break
+            try:
+                await asyncio.wait_for(future, deadline.bound(None, "waiting for a duplicate request"))
+            except asyncio.TimeoutError:
+                raise deadline.DeadlineExceeded("deadline exceeded waiting for a duplicate request") from None
+            if flight.response is not None:
+                return flight.response, True
+        response = None
+        try:
+            response = await execute()
+        finally:
+            self._finish(key, flight, response, cacheable)
+        return response, False
+
+    def stats(self):
+        """
+        Return the number of stored responses and the store counters.
+
+        Returns
+        -------
+        dict
+            `size`, `max_size`, `bytes`, `in_flight`, and the `executions`, `replays`,
+            `coalesced`, `conflicts`, `evictions` and `expirations` counters.
+        """
+        with self._lock:
+            snapshot = {"size": len(self._entries), "max_size": self.max_size, "bytes": self._bytes, "in_flight": len(self._flights)}
+            snapshot.update(self._counters)
+        return snapshot
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Return the worker-wide store, creating it on first use.
+
+    Sized by `IDEMPOTENCY_CACHE_SIZE` (default 1000, 0 only coalesces
+    concurrent duplicates), `IDEMPOTENCY_CACHE_BYTES` (default 64 MiB) and
+    `IDEMPOTENCY_TTL` (default 600 s).
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = IdempotencyStore(
+                    max_size=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 1000)),
+                    max_bytes=int(os.environ.get("IDEMPOTENCY_CACHE_BYTES", 64 * 1024 * 1024)),
+                    ttl=float(os.environ.get("IDEMPOTENCY_TTL", 600)),
+                )
+    return _store
+
+
+def call(scope, key, payload, execute):
+    """
+    Run `execute()` for a request once per idempotency key.
+
+    Requests without a key just run. Keys are namespaced by `scope`, the
+    function name, so functions sharing a worker never see each other's.
+
+    Returns
+    -------
+    tuple
+        `(response, replayed)`, see `IdempotencyStore.run`.
+    """
+    if key is None:
+        return execute(), False
+    return get_store().run((scope, key), fingerprint(payload), execute)
+
+
+async def call_async(scope, key, payload, execute):
+    """Same as `call`, awaiting `execute()`."""
+    if key is None:
+        return await execute(), False
+    return await get_store().run_async((scope, key), fingerprint(payload), execute)
+
+
+def _collect_metrics():
+    current = _store
+    if current is None:
+        return []
+    stats = current.stats()
+    return [
+        ("cofrap_idempotency_entries", "gauge", "Responses held by the idempotency store.", [((), stats["size"])]),
+        ("cofrap_idempotency_bytes", "gauge", "Total length of the bodies held by the idempotency store.", [((), stats["bytes"])]),
+        ("cofrap_idempotency_events_total", "counter", "Idempotent requests by outcome.",
+         [((("event", key),), stats[key]) for key in ("executions", "replays", "coalesced", "conflicts", "evictions", "expirations")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def reset_store():
+    """Drop the worker-wide store; the next `get_store()` builds a fresh one."""
+    global _store
+    with _store_lock:
+        _store = None
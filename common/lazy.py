@@ -0,0 +1,47 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access.
+
+    Used for the heavy dependencies (pymysql, pyotp, qrcode, PIL) so that a
+    replica scaled from zero does not pay for them before it needs them.
+    Attribute assignment is forwarded too, so `mock.patch` works unchanged.
+    """
+
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = object.__getattribute__(self, "_module")
+        if module is None:
+            module = importlib.import_module(object.__getattribute__(self, "_name"))
+            object.__setattr__(self, "_module", module)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if object.__getattribute__(self, "_module") is not None else "not loaded"
+        return f"<lazy module {object.__getattribute__(self, '_name')!r} ({state})>"
+
+
+def module(name):
+    """Return a `LazyModule` importing `name` on first use."""
+    return LazyModule(name)
+
+
+def load(*modules):
+    """Force the import of lazy modules, e.g. while warming a replica up."""
+    for mod in modules:
+        if isinstance(mod, LazyModule):
+            mod._load()
@@ -0,0 +1,262 @@
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import has_request_context, make_response, request
+
+from . import deadline
+
+# Upper bounds in seconds, from sub-millisecond cache hits to DB timeouts
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_PATH = "/metrics"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DESCRIPTIONS = {
+    "cofrap_phase_duration_seconds": ("histogram", "Duration of the phases of a function invocation."),
+    "cofrap_request_duration_seconds": ("histogram", "Duration of function invocations."),
+    "cofrap_requests_total": ("counter", "Function invocations by HTTP status code."),
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram; `observe()` is one bisect and three additions."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    In-process store of counters and histograms, rendered in Prometheus text format.
+
+    Gauges describing other components (pool, caches, queues) are produced at
+    scrape time by collectors registered with `register_collector()`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    def register_collector(self, collector):
+        """
+        Add a scrape-time source of samples.
+
+        Parameters
+        ----------
+        collector : callable
+            Returns a list of `(name, type, help, [(labels, value), ...])`,
+            where `labels` is a tuple of `(key, value)` pairs.
+        """
+        self._collectors.append(collector)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        families = {}
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                families.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), h in sorted(self._histograms.items()):
+                lines = families.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {h.count}")
+
+        descriptions = dict(DESCRIPTIONS)
+        for collector in self._collectors:
+            try:
+                collected = collector()
+            except Exception:
+                continue
+            for name, kind, help_text, samples in collected:
+                descriptions[name] = (kind, help_text)
+                families.setdefault(name, []).extend(f"{name}{_labels(labels)} {value}" for labels, value in samples)
+
+        out = []
+        for name, lines in families.items():
+            kind, help_text = descriptions.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+REGISTRY = Registry()
+register_collector = REGISTRY.register_collector
+
+_function = contextvars.ContextVar("cofrap_function", default=os.environ.get("FUNCTION_NAME", "unknown"))
+_timings = contextvars.ContextVar("cofrap_timings", default=None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a block as phase `name` of the current invocation.
+
+    The duration feeds `cofrap_phase_duration_seconds` and, inside a request
+    tracked by `instrumented`, the `Server-Timing` response header.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        REGISTRY.observe("cofrap_phase_duration_seconds", (("function", _function.get()), ("phase", name)), elapsed)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def server_timing(timings, total):
+    """
+    Format phase durations as a `Server-Timing` header value.
+
+    Repeated phases are summed; durations are in milliseconds.
+    """
+    merged = {}
+    for name, elapsed in timings:
+        merged[name] = merged.get(name, 0.0) + elapsed
+    parts = [f"{name};dur={elapsed * 1000:.3f}" for name, elapsed in merged.items()]
+    parts.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(parts)
+
+
+def is_metrics_request():
+    return has_request_context() and request.method == "GET" and request.path == METRICS_PATH
+
+
+def metrics_response():
+    resp = make_response(REGISTRY.render(), 200)
+    resp.headers["Content-Type"] = PROMETHEUS_CONTENT_TYPE
+    return resp
+
+
+def instrumented(function_name):
+    """
+    Decorate an OpenFaaS `handle()` with timing and a metrics endpoint.
+
+    - `GET /metrics` returns the Prometheus exposition of this replica.
+    - Every other call is timed as a whole and per `phase()`; when serving an
+      HTTP request the result is returned as a response carrying a
+      `Server-Timing` header (string bodies are kept as-is).
+    - Coroutine handlers (`handle_async`) are timed the same way; their
+      result is normalised to a `(body, status, headers)` tuple that carries
+      the `Server-Timing` header (`/metrics` is served by `common.asgi`).
+    - Each call runs under a deadline (`common.deadline`) that bounds its
+      database calls.
+
+    Parameters
+    ----------
+    function_name : str
+        Value of the `function` label of every metric recorded by the call.
+    """
+    def decorator(handle):
+        if inspect.iscoroutinefunction(handle):
+            @functools.wraps(handle)
+            async def async_wrapper(req, *args, **kwargs):
+                timings, tokens = _begin(function_name)
+                start = time.perf_counter()
+                status = 500
+                try:
+                    body, status, headers = as_triple(await handle(req, *args, **kwargs))
+                    headers["Server-Timing"] = server_timing(timings, time.perf_counter() - start)
+                    return body, status, headers
+                finally:
+                    _end(function_name, tokens, start, status)
+            return async_wrapper
+
+        @functools.wraps(handle)
+        def wrapper(req):
+            if is_metrics_request():
+                return metrics_response()
+
+            timings, tokens = _begin(function_name)
+            start = time.perf_counter()
+            status = 500
+            try:
+                result = handle(req)
+                if has_request_context():
+                    if not hasattr(result, "headers"):
+                        result = make_response(result)
+                    status = result.status_code
+                    result.headers["Server-Timing"] = server_timing(timings, time.perf_counter() - start)
+                else:
+                    status = getattr(result, "status_code", 200)
+                return result
+            finally:
+                _end(function_name, tokens, start, status)
+        return wrapper
+    return decorator
+
+
+def as_triple(result):
+    """
+    Normalise a handler result to `(body, status, headers)`, as Flask does for views.
+
+    Accepts a bare body, `(body, status)` or `(body, status, headers)`.
+    """
+    if not isinstance(result, tuple):
+        return result, 200, {}
+    if len(result) == 2:
+        return result[0], result[1], {}
+    body, status, headers = result
+    return body, status, dict(headers)
+
+
+def _begin(function_name):
+    timings = []
+    return timings, (_function.set(function_name), _timings.set(timings), deadline.start())
+
+
+def _end(function_name, tokens, start, status):
+    elapsed = time.perf_counter() - start
+    REGISTRY.observe("cofrap_request_duration_seconds", (("function", function_name),), elapsed)
+    REGISTRY.inc("cofrap_requests_total", (("function", function_name), ("code", str(status))))
+    function_token, timings_token, deadline_token = tokens
+    deadline.reset(deadline_token)
+    _timings.reset(timings_token)
+    _function.reset(function_token)
@@ -0,0 +1,152 @@
+import os
+import string
+import threading
+
+CHARACTER_CLASSES = {
+    "lower": string.ascii_lowercase,
+    "upper": string.ascii_uppercase,
+    "digits": string.digits,
+    "punctuation": string.punctuation,
+}
+
+# Characters easily confused when a password is read or typed by hand
+AMBIGUOUS = "Il1|O0o`'\""
+
+
+class PasswordPolicy:
+    """
+    Shape of the generated passwords.
+
+    Parameters
+    ----------
+    length : int
+        Number of characters.
+    classes : iterable of str
+        Character classes of the alphabet (keys of `CHARACTER_CLASSES`).
+    required : iterable of str
+        Classes that must each appear at least once; defaults to `classes`.
+    exclude_ambiguous : bool
+        Remove `AMBIGUOUS` characters from the alphabet.
+    """
+
+    def __init__(self, length=24, classes=("lower", "upper", "digits", "punctuation"), required=None,
+                 exclude_ambiguous=False):
+        classes = tuple(classes)
+        required = classes if required is None else tuple(required)
+        unknown = set(classes) - set(CHARACTER_CLASSES)
+        if not classes or unknown:
+            raise ValueError(f"unsupported character classes: {sorted(unknown) or classes}")
+        if not set(required) <= set(classes):
+            raise ValueError("required classes must be part of the alphabet")
+        if length < len(required):
+            raise ValueError(f"a {length}-character password cannot hold {len(required)} required classes")
+
+        excluded = AMBIGUOUS if exclude_ambiguous else ""
+        self.length = length
+        self.classes = classes
+        self.required = required
+        self.exclude_ambiguous = exclude_ambiguous
+        self.class_chars = {
+            name: "".join(c for c in CHARACTER_CLASSES[name] if c not in excluded) for name in classes
+        }
+        self.alphabet = "".join(self.class_chars[name] for name in classes)
+        if len(self.alphabet) > 256:
+            raise ValueError("alphabet is limited to 256 characters")
+
+
+class PasswordGenerator:
+    """
+    Draw passwords from the OS CSPRNG in large blocks.
+
+    Random bytes are read `block_size` at a time and mapped to the alphabet
+    by rejection sampling: a byte is kept only if it is below the largest
+    multiple of the alphabet size, so every character is equally likely.
+    The mapping runs in C through `bytes.translate`. Passwords missing a
+    required class are discarded and drawn again, which keeps the draw
+    uniform over the passwords that satisfy the policy.
+
+    Parameters
+    ----------
+    policy : PasswordPolicy
+        Length and alphabet of the passwords.
+    block_size : int
+        Bytes requested from `os.urandom` per refill.
+    """
+
+    def __init__(self, policy=None, block_size=4096, urandom=os.urandom):
+        self.policy = policy or PasswordPolicy()
+        self.block_size = block_size
+        self._urandom = urandom
+        alphabet = self.policy.alphabet
+        limit = 256 - 256 % len(alphabet)
+        self._table = bytes(ord(alphabet[b % len(alphabet)]) if b < limit else 0 for b in range(256))
+        self._rejected = bytes(range(limit, 256))
+        self._required = [frozenset(self.policy.class_chars[name]) for name in self.policy.required]
+        self._buffer = ""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _take(self, n):
+        # Caller holds the lock
+        if self._pid != os.getpid():
+            # Never share buffered randomness with a forked child
+            self._buffer = ""
+            self._pid = os.getpid()
+        while len(self._buffer) < n:
+            block = self._urandom(max(self.block_size, n * 2))
+            self._buffer += block.translate(self._table, self._rejected).decode("ascii")
+        chars, self._buffer = self._buffer[:n], self._buffer[n:]
+        return chars
+
+    def generate(self, count=1):
+        """
+        Return `count` passwords following the policy.
+
+        Returns
+        -------
+        list of str
+        """
+        length = self.policy.length
+        passwords = []
+        with self._lock:
+            while len(passwords) < count:
+                missing = count - len(passwords)
+                chars = self._take(missing * length)
+                for i in range(0, len(chars), length):
+                    candidate = chars[i:i + length]
+                    if all(not required.isdisjoint(candidate) for required in self._required):
+                        passwords.append(candidate)
+        return passwords
+
+
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def get_generator():
+    """
+    Return the worker-wide generator configured from the environment.
+
+    Reads `PASSWORD_LENGTH` (default 24), `PASSWORD_CLASSES` (comma-separated,
+    default `lower,upper,digits,punctuation`), `PASSWORD_REQUIRED_CLASSES`
+    (default: every class of the alphabet) and `PASSWORD_EXCLUDE_AMBIGUOUS`.
+    """
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                classes = os.environ.get("PASSWORD_CLASSES", "lower,upper,digits,punctuation").split(",")
+                required = os.environ.get("PASSWORD_REQUIRED_CLASSES")
+                _generator = PasswordGenerator(PasswordPolicy(
+                    length=int(os.environ.get("PASSWORD_LENGTH", 24)),
+                    classes=[c.strip() for c in classes if c.strip()],
+                    required=None if required is None else [c.strip() for c in required.split(",") if c.strip()],
+                    exclude_ambiguous=os.environ.get("PASSWORD_EXCLUDE_AMBIGUOUS", "0") == "1",
+                ))
+    return _generator
+
+
+def reset_generator():
+    global _generator
+    with _generator_lock:
+        _generator = None
@@ -0,0 +1,682 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent import futures
+from contextlib import contextmanager, nullcontext
+
+from . import breaker, deadline, lazy, metrics, replicas, shards, sqlite
+
+pymysql = lazy.module("pymysql")
+
+
+class PoolExhausted(breaker.Saturated):
+    """Raised when no connection can be borrowed before the acquire timeout."""
+
+
+class _Entry:
+    __slots__ = ("conn", "created", "last_used")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class ConnectionPool:
+    """
+    Bounded pool of warm database connections shared by one function worker.
+
+    Idle connections are reused most-recently-used first, health-checked with
+    a ping when they have been idle for longer than `ping_interval`, and
+    recycled once older than `max_lifetime`.
+
+    Parameters
+    ----------
+    connect : callable
+        Zero-argument factory returning a new DB-API connection.
+    max_size : int
+        Maximum number of connections (idle + in use) held by the pool.
+    max_lifetime : float
+        Age in seconds after which a connection is closed instead of reused.
+    ping_interval : float
+        Idle time in seconds after which a connection is pinged before reuse.
+    acquire_timeout : float
+        Seconds to wait for a free connection before raising `PoolExhausted`,
+        capped by the deadline of the current request.
+    breaker : breaker.CircuitBreaker, optional
+        Every borrow goes through it, from the acquire to the end of the block.
+    """
+
+    def __init__(self, connect, max_size=4, max_lifetime=1800, ping_interval=30, acquire_timeout=5, breaker=None):
+        self._connect = connect
+        self.breaker = breaker
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._counters = {"created": 0, "reused": 0, "recycled": 0, "failed_checks": 0}
+
+    def _count(self, event):
+        with self._cond:
+            self._counters[event] += 1
+
+    def _healthy(self, entry):
+        now = time.monotonic()
+        if now - entry.created > self.max_lifetime:
+            self._count("recycled")
+            return False
+        if now - entry.last_used > self.ping_interval:
+            try:
+                entry.conn.ping(reconnect=False)
+            except Exception:
+                self._count("failed_checks")
+                return False
+        return True
+
+    def _close(self, entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        wait = deadline.bound(self.acquire_timeout, "acquiring a database connection")
+        give_up = time.monotonic() + wait
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = give_up - time.monotonic()
+                    if remaining <= 0:
+                        if wait < self.acquire_timeout:
+                            raise deadline.DeadlineExceeded("deadline exceeded waiting for a database connection")
+                        raise PoolExhausted(f"no database connection available after {self.acquire_timeout}s")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    entry = None
+                    self._size += 1
+
+            if entry is None:
+                entry = self._open()
+                apply_deadline(entry.conn)
+                return entry
+
+            # Before the health check: a ping must not outlive the request either
+            apply_deadline(entry.conn)
+            if self._healthy(entry):
+                self._count("reused")
+                return entry
+            self._close(entry)
+            self._forget()
+
+    def _open(self):
+        # The caller has already reserved a slot in `_size`
+        try:
+            with metrics.phase("db_connect"):
+                entry = _Entry(self._connect())
+        except Exception:
+            self._forget()
+            raise
+        self._count("created")
+        return entry
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _release(self, entry, discard=False):
+        if discard:
+            self._close(entry)
+            self._forget()
+            return
+        entry.last_used = time.monotonic()
+        with self._cond:
+            if not self._closed:
+                self._idle.append(entry)
+                self._cond.notify()
+                return
+        self._close(entry)
+        self._forget()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a `with` block.
+
+        On error the current transaction is rolled back; a connection that
+        cannot even roll back is considered broken and is discarded. Socket
+        timeouts are capped by the deadline of the current request (see
+        `common.deadline`), past which the block fails with `DeadlineExceeded`.
+
+        Yields
+        ------
+        pymysql.Connection
+            A live connection owned by the caller until the block exits.
+
+        Raises
+        ------
+        breaker.CircuitOpen
+            While the pool's breaker refuses calls.
+        """
+        deadline.check("borrowing a database connection")
+        with self.breaker.guard() if self.breaker is not None else nullcontext():
+            with self._lease(self._acquire()) as conn:
+                yield conn
+
+    @contextmanager
+    def _lease(self, entry):
+        try:
+            yield entry.conn
+        except BaseException as exc:
+            try:
+                entry.conn.rollback()
+            except Exception:
+                self._release(entry, discard=True)
+            else:
+                self._release(entry)
+            if deadline.expired() and not isinstance(exc, deadline.DeadlineExceeded):
+                raise deadline.DeadlineExceeded("deadline exceeded during a database call") from exc
+            raise
+        else:
+            self._release(entry)
+
+    def prefill(self, count):
+        """
+        Open connections ahead of demand until `count` are idle (bounded by `max_size`).
+
+        Used by the warm-up hook so that the first request does not pay for
+        the TCP and authentication handshake.
+
+        Returns
+        -------
+        int
+            Number of connections opened.
+        """
+        opened = 0
+        while True:
+            with self._cond:
+                if len(self._idle) >= count or self._size >= self.max_size:
+                    return opened
+                self._size += 1
+            self._release(self._open())
+            opened += 1
+
+    def close(self):
+        """Close every idle connection. Borrowed connections are closed on return."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close(entry)
+
+    def stats(self):
+        """
+        Return a snapshot of the pool occupancy and lifetime counters.
+
+        Returns
+        -------
+        dict
+            `size`, `idle`, `in_use`, `max_size` plus the `created`, `reused`,
+            `recycled` and `failed_checks` counters.
+        """
+        with self._cond:
+            snapshot = {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size,
+            }
+            snapshot.update(self._counters)
+        return snapshot
+
+
+def socket_timeouts():
+    """Return the `(connect, read, write)` timeouts of `DB_CONNECT_TIMEOUT`, `DB_READ_TIMEOUT` and `DB_WRITE_TIMEOUT`."""
+    return (
+        float(os.environ.get("DB_CONNECT_TIMEOUT", 3)),
+        float(os.environ.get("DB_READ_TIMEOUT", 10)),
+        float(os.environ.get("DB_WRITE_TIMEOUT", 10)),
+    )
+
+
+def apply_deadline(conn):
+    """
+    Cap the read and write timeouts of a pymysql connection by the time left to the current request.
+
+    Outside of a request the configured timeouts are restored.
+    """
+    if not hasattr(conn, "_read_timeout"):
+        # Not a pymysql connection: SQLite checks the deadline itself
+        return
+    _, read_timeout, write_timeout = socket_timeouts()
+    left = deadline.remaining()
+    if left is not None:
+        # Never 0: pymysql would switch the socket to non-blocking mode
+        left = max(left, 0.001)
+        read_timeout, write_timeout = min(read_timeout, left), min(write_timeout, left)
+    # pymysql applies these to the socket before every read and write
+    conn._read_timeout = read_timeout
+    conn._write_timeout = write_timeout
+
+
+def connect_from_env(host=None, port=3306):
+    """
+    Open a new MariaDB connection from the `DB_*` environment variables.
+
+    Connections run in autocommit mode so that a pooled connection never
+    carries a stale read snapshot into the next invocation; multi-statement
+    writes must call `conn.begin()` explicitly. Socket timeouts come from
+    `socket_timeouts()`, the connect timeout capped by the current deadline.
+
+    Parameters
+    ----------
+    host : str, optional
+        Server to connect to instead of the primary (`DB_HOST`), e.g. a read replica.
+    port : int
+        Port of `host`.
+
+    Returns
+    -------
+    pymysql.Connection
+        An active connection object to the MariaDB database.
+    """
+    connect_timeout, read_timeout, write_timeout = socket_timeouts()
+    return pymysql.connect(
+        host=host or os.environ['DB_HOST'],
+        port=port,
+        connect_timeout=deadline.bound(connect_timeout, "connecting to the database"),
+        read_timeout=read_timeout,
+        write_timeout=write_timeout,
+        user=os.environ['DB_USER'],
+        password=os.environ['DB_PASSWORD'],
+        database=os.environ['DB_NAME'],
+        autocommit=True
+    )
+
+
+BACKENDS = ("mariadb", "sqlite")
+
+
+def backend():
+    """
+    Return the storage backend selected by `DB_BACKEND`.
+
+    `mariadb` (default) connects to `DB_HOST`; `sqlite` opens the embedded
+    database file `DB_PATH` (see `common.sqlite`), for single-node and
+    edge installs without a database server.
+    """
+    kind = os.environ.get("DB_BACKEND", "mariadb").lower()
+    if kind not in BACKENDS:
+        raise ValueError(f"unsupported DB_BACKEND: {kind}")
+    return kind
+
+
+def connector():
+    """Return the zero-argument factory of new connections to the configured backend."""
+    return sqlite.connect_from_env if backend() == "sqlite" else connect_from_env
+
+
+_pool = None
+_replica_pools = {}
+_shard_pools = {}
+_scatter_executor = None
+_pool_lock = threading.Lock()
+
+
+def _pool_options():
+    return {
+        "max_size": int(os.environ.get("DB_POOL_SIZE", 4)),
+        "max_lifetime": float(os.environ.get("DB_POOL_MAX_LIFETIME", 1800)),
+        "ping_interval": float(os.environ.get("DB_POOL_PING_INTERVAL", 30)),
+        "acquire_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+    }
+
+
+def get_pool():
+    """
+    Return the worker-wide connection pool, creating it on first use.
+
+    Connections go to the backend selected by `DB_BACKEND` (see `backend()`).
+    Sizing is read from `DB_POOL_SIZE`, `DB_POOL_MAX_LIFETIME`,
+    `DB_POOL_PING_INTERVAL` and `DB_POOL_TIMEOUT`; borrows go through the
+    worker-wide circuit breaker (`breaker.get_breaker()`).
+
+    Returns
+    -------
+    ConnectionPool
+        The pool shared by every invocation served by this worker.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(connector(), breaker=breaker.get_breaker(), **_pool_options())
+    return _pool
+
+
+def get_replica_pool(replica):
+    """
+    Return the worker-wide pool of a read replica, sized like the primary's.
+
+    Parameters
+    ----------
+    replica : replicas.Replica
+        One of the replicas of `replicas.get_replicas()`.
+    """
+    current = _replica_pools.get(replica.name)
+    if current is None:
+        with _pool_lock:
+            current = _replica_pools.get(replica.name)
+            if current is None:
+                current = _replica_pools[replica.name] = ConnectionPool(
+                    functools.partial(connect_from_env, replica.host, replica.port), **_pool_options()
+                )
+    return current
+
+
+def get_shard_pool(shard):
+    """
+    Return the worker-wide pool of a shard, sized like the primary's.
+
+    Borrows go through the worker-wide circuit breaker, as the primary's do.
+
+    Parameters
+    ----------
+    shard : shards.Shard
+        One of the shards of `shards.get_shards()`.
+    """
+    current = _shard_pools.get(shard.name)
+    if current is None:
+        with _pool_lock:
+            current = _shard_pools.get(shard.name)
+            if current is None:
+                if backend() == "sqlite":
+                    connect = functools.partial(sqlite.connect_from_env, shard.location)
+                else:
+                    connect = functools.partial(connect_from_env, shard.host, shard.port)
+                current = _shard_pools[shard.name] = ConnectionPool(connect, breaker=breaker.get_breaker(), **_pool_options())
+    return current
+
+
+@contextmanager
+def connection(keys=()):
+    """
+    Borrow a connection of the primary database holding `keys`, e.g. for a write.
+
+    Without `DB_SHARDS` that is a connection of `get_pool()`; with it, one of
+    the shard owning the usernames `keys` (see `common.shards`).
+
+    Parameters
+    ----------
+    keys : iterable of str
+        Usernames the statements are about; with `DB_SHARDS`, all on one shard.
+
+    Yields
+    ------
+    pymysql.Connection
+        A live connection owned by the caller until the block exits.
+
+    Raises
+    ------
+    ValueError
+        With `DB_SHARDS`, if `keys` is empty or spans several shards.
+    """
+    shard_map = shards.get_shards()
+    current = get_pool() if shard_map is None else get_shard_pool(shard_map.owner_of(keys))
+    with current.connection() as conn:
+        yield conn
+
+
+def _shard_connection(shard):
+    return get_shard_pool(shard).connection()
+
+
+def partitions(read=False):
+    """
+    Return a connection factory per partition of the `users` table, by shard name.
+
+    Without `DB_SHARDS` there is one partition, named None: the primary, or
+    `read_connection` when `read`. The factories look their pool up on every
+    call, so they can be kept.
+
+    Returns
+    -------
+    dict
+        `{shard name: factory}`, in the order of `DB_SHARDS`.
+    """
+    shard_map = shards.get_shards()
+    if shard_map is None:
+        return {None: read_connection if read else connection}
+    return {shard.name: functools.partial(_shard_connection, shard) for shard in shard_map.shards}
+
+
+def group(keys):
+    """Split `keys` by partition, as `{shard name: [keys, in order]}`; `{None: [...]}` without `DB_SHARDS`."""
+    shard_map = shards.get_shards()
+    if shard_map is None:
+        keys = list(keys)
+        return {None: keys} if keys else {}
+    return shard_map.group(keys)
+
+
+def get_scatter_executor():
+    """Return the worker-wide thread pool of `scatter`, with room for every pooled shard connection."""
+    global _scatter_executor
+    if _scatter_executor is None:
+        with _pool_lock:
+            if _scatter_executor is None:
+                shard_map = shards.get_shards()
+                workers = (len(shard_map.shards) if shard_map is not None else 1) * _pool_options()["max_size"]
+                _scatter_executor = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cofrap-scatter")
+    return _scatter_executor
+
+
+def _call(fn, name, factory):
+    with factory() as conn:
+        return fn(name, conn)
+
+
+def scatter(fn, read=True):
+    """
+    Call `fn(name, connection)` on a connection of every partition, all at once.
+
+    Each call runs on the scatter thread pool in a copy of the caller's
+    context, so the request deadline still applies; a single partition is
+    served on the calling thread. If a call fails, its error is raised once
+    every call is over: no partial result is returned.
+
+    Parameters
+    ----------
+    fn : callable
+        Receives the shard name (None without `DB_SHARDS`) and a connection.
+    read : bool
+        Read-only calls, which may go to a read replica of an unsharded primary.
+
+    Returns
+    -------
+    dict
+        `{shard name: result of fn}`, in the order of `partitions()`.
+    """
+    parts = partitions(read)
+    if len(parts) == 1:
+        (name, factory), = parts.items()
+        return {name: _call(fn, name, factory)}
+    executor = get_scatter_executor()
+    calls = {
+        name: executor.submit(contextvars.copy_context().run, _call, fn, name, factory)
+        for name, factory in parts.items()
+    }
+    futures.wait(calls.values())
+    return {name: call.result() for name, call in calls.items()}
+
+
+def _borrow_replica(replica_set, replica):
+    """Borrow a connection of `replica` if it is reachable and fresh enough; None otherwise."""
+    replica_pool = get_replica_pool(replica)
+    try:
+        entry = replica_pool._acquire()
+    except PoolExhausted:
+        # Busy, not broken: the next replica or the primary serves this read
+        return None
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        replica_set.report_failure(replica)
+        return None
+    if replica_set.needs_check(replica):
+        try:
+            with metrics.phase("db_replica_check"), entry.conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(replicas.LAG_SQL)
+                lag = replicas.lag_from_status(cursor.fetchone())
+        except Exception:
+            replica_pool._release(entry, discard=True)
+            replica_set.report_failure(replica)
+            return None
+        if not replica_set.report_lag(replica, lag):
+            replica_pool._release(entry)
+            return None
+    return replica_pool, entry
+
+
+@contextmanager
+def read_connection(keys=()):
+    """
+    Borrow a connection for read-only queries, from a read replica when one is configured.
+
+    The embedded SQLite backend has no replicas: reads go to its pool. With
+    `DB_SHARDS`, reads go to the shard owning `keys`, like `connection()`.
+
+    Replicas are tried in round-robin order, skipping the unreachable and
+    lagging ones; reads about a key written within the staleness window,
+    and reads for which no replica is usable, go to the primary. Errors
+    raised inside the block are not retried on another server.
+
+    Parameters
+    ----------
+    keys : iterable of str
+        Usernames the read is about, for read-your-writes.
+
+    Yields
+    ------
+    pymysql.Connection
+        A live connection owned by the caller until the block exits.
+    """
+    shard_map = shards.get_shards()
+    if shard_map is not None:
+        with get_shard_pool(shard_map.owner_of(keys)).connection() as conn:
+            yield conn
+        return
+    replica_set = replicas.get_replicas() if backend() == "mariadb" else None
+    if replica_set is not None:
+        for replica in replica_set.candidates(keys):
+            borrowed = _borrow_replica(replica_set, replica)
+            if borrowed is None:
+                continue
+            replica_pool, entry = borrowed
+            replica_set.report_read()
+            with replica_pool._lease(entry) as conn:
+                yield conn
+            return
+    with get_pool().connection() as conn:
+        yield conn
+
+
+def prefill_replicas(count):
+    """
+    Open `count` idle connections to every replica, like `ConnectionPool.prefill`.
+
+    Unreachable replicas are reported as failed and skipped.
+
+    Returns
+    -------
+    int
+        Number of connections opened.
+    """
+    replica_set = replicas.get_replicas()
+    opened = 0
+    for replica in replica_set.replicas if replica_set is not None else ():
+        try:
+            opened += get_replica_pool(replica).prefill(count)
+        except Exception:
+            replica_set.report_failure(replica)
+    return opened
+
+
+def prefill_shards(count):
+    """
+    Open `count` idle connections to every shard, like `ConnectionPool.prefill`.
+
+    Returns
+    -------
+    int
+        Number of connections opened.
+    """
+    shard_map = shards.get_shards()
+    return sum(get_shard_pool(shard).prefill(count) for shard in shard_map.shards) if shard_map is not None else 0
+
+
+def set_pool(new_pool):
+    """
+    Replace the worker-wide pool, e.g. with one backed by a local stand-in database.
+
+    Parameters
+    ----------
+    new_pool : ConnectionPool
+        The pool returned by subsequent `get_pool()` calls.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = new_pool
+
+
+def _collect_metrics():
+    collected = []
+    current = _pool
+    if current is not None:
+        stats = current.stats()
+        collected += [
+            ("cofrap_db_pool_connections", "gauge", "Connections held by the pool.",
+             [((("state", "idle"),), stats["idle"]), ((("state", "in_use"),), stats["in_use"])]),
+            ("cofrap_db_pool_max_size", "gauge", "Maximum number of pooled connections.", [((), stats["max_size"])]),
+            ("cofrap_db_pool_events_total", "counter", "Pool connection lifecycle events.",
+             [((("event", key),), stats[key]) for key in ("created", "reused", "recycled", "failed_checks")]),
+        ]
+    shard_stats = {name: shard_pool.stats() for name, shard_pool in list(_shard_pools.items())}
+    if shard_stats:
+        collected.append(("cofrap_db_shard_pool_connections", "gauge", "Connections held by the pool of each shard.",
+                          [((("shard", name), ("state", state)), stats[state])
+                           for name, stats in shard_stats.items() for state in ("idle", "in_use")]))
+    return collected
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def reset_pool():
+    """Close and drop the worker-wide pools, replica and shard state; the next `get_pool()` builds a fresh one."""
+    global _pool, _scatter_executor
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = None
+        for other_pool in [*_replica_pools.values(), *_shard_pools.values()]:
+            other_pool.close()
+        _replica_pools.clear()
+        _shard_pools.clear()
+        if _scatter_executor is not None:
+            _scatter_executor.shutdown(wait=False)
+        _scatter_executor = None
+    replicas.reset_replicas()
+    shards.reset_shards()
@@ -0,0 +1,197 @@
+import base64
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from . import lazy, metrics
+
+# qrcode and Pillow account for most of a cold import of the QR functions:
+# they are only loaded by the first render (or by the warm-up hook)
+qrcode = lazy.module("qrcode")
+qrcode_svg = lazy.module("qrcode.image.svg")
+Image = lazy.module("PIL.Image")
+
+# Names of the `qrcode.constants` error-correction levels
+ERROR_CORRECTION_LEVELS = {
+    "L": "ERROR_CORRECT_L",
+    "M": "ERROR_CORRECT_M",
+    "Q": "ERROR_CORRECT_Q",
+    "H": "ERROR_CORRECT_H",
+}
+
+FORMATS = {
+    "png": ("image/png", "png"),
+    "svg": ("image/svg+xml", "svg"),
+}
+
+
+class RenderedQR:
+    """
+    An encoded QR code image, produced once and shared by every consumer.
+
+    Attributes
+    ----------
+    data : bytes
+        The encoded image (PNG or SVG document).
+    mimetype : str
+        MIME type of `data`.
+    extension : str
+        File extension matching the format, without the dot.
+    """
+
+    __slots__ = ("data", "mimetype", "extension")
+
+    def __init__(self, data, mimetype, extension):
+        self.data = data
+        self.mimetype = mimetype
+        self.extension = extension
+
+    def base64(self):
+        return base64.b64encode(self.data).decode()
+
+    def save(self, path_stem):
+        """
+        Write the encoded bytes to `<path_stem>.<extension>`.
+
+        Returns
+        -------
+        str
+            The path that was written.
+        """
+        path = f"{path_stem}.{self.extension}"
+        with open(path, "wb") as f:
+            f.write(self.data)
+        return path
+
+
+class QRRenderer:
+    """
+    Render QR codes in a single pass: one matrix build and one image encode.
+
+    Parameters
+    ----------
+    fmt : {"png", "svg"}
+        Output format. SVG skips rasterisation and compression entirely.
+    box_size : int
+        Pixels per QR module (PNG only meaningful).
+    border : int
+        Quiet-zone width in modules.
+    error_correction : {"L", "M", "Q", "H"}
+        QR error-correction level; lower levels give smaller symbols.
+    compress_level : int
+        zlib level used for PNG, from 0 (fastest) to 9 (smallest).
+    mask_pattern : int or None
+        Fixed QR mask (0-7). None lets `qrcode` score all eight masks, which is
+        the most expensive step of a render; any fixed mask stays scannable.
+    cache_size : int
+        Number of rendered payloads kept in a small LRU, keyed by content;
+        0 disables the cache.
+    """
+
+    def __init__(self, fmt="png", box_size=10, border=4, error_correction="M", compress_level=6, mask_pattern=None,
+                 cache_size=0):
+        if fmt not in FORMATS:
+            raise ValueError(f"unsupported QR format: {fmt}")
+        if error_correction not in ERROR_CORRECTION_LEVELS:
+            raise ValueError(f"unsupported QR error correction level: {error_correction}")
+        self.fmt = fmt
+        self.box_size = box_size
+        self.border = border
+        self.error_correction = error_correction
+        self.compress_level = compress_level
+        self.mask_pattern = mask_pattern
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _encode(self, content):
+        with metrics.phase("qr_matrix"):
+            code = qrcode.QRCode(
+                box_size=self.box_size,
+                border=self.border,
+                error_correction=getattr(qrcode.constants, ERROR_CORRECTION_LEVELS[self.error_correction]),
+                mask_pattern=self.mask_pattern,
+            )
+            code.add_data(content)
+            code.make(fit=True)
+
+        if self.fmt == "svg":
+            with metrics.phase("svg_encode"):
+                return code.make_image(image_factory=qrcode_svg.SvgPathImage).to_string()
+
+        with metrics.phase("png_encode"):
+            # Rasterise the module matrix directly instead of drawing one
+            # rectangle per module: same pixels as qrcode's PIL factory
+            matrix = code.get_matrix()
+            n = len(matrix)
+            modules = bytes(0 if dark else 255 for row in matrix for dark in row)
+            img = Image.frombytes("L", (n, n), modules)
+            img = img.resize((n * self.box_size, n * self.box_size), Image.NEAREST)
+            img = img.convert("1", dither=Image.Dither.NONE)
+
+            buf = io.BytesIO()
+            img.save(buf, format="PNG", compress_level=self.compress_level)
+            return buf.getvalue()
+
+    def render(self, content):
+        """
+        Render `content` as a QR code.
+
+        Parameters
+        ----------
+        content : str
+            The text to encode (password, provisioning URI...).
+
+        Returns
+        -------
+        RenderedQR
+            The encoded image, ready to be written to disk and/or base64-encoded.
+        """
+        mimetype, extension = FORMATS[self.fmt]
+        if self.cache_size <= 0:
+            return RenderedQR(self._encode(content), mimetype, extension)
+
+        with self._lock:
+            data = self._cache.get(content)
+            if data is not None:
+                self._cache.move_to_end(content)
+        if data is None:
+            data = self._encode(content)
+            with self._lock:
+                self._cache[content] = data
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return RenderedQR(data, mimetype, extension)
+
+
+_renderer = None
+
+
+def get_renderer():
+    """
+    Return the worker-wide renderer configured from the environment.
+
+    Reads `QR_FORMAT` (`png`/`svg`), `QR_BOX_SIZE`, `QR_BORDER`,
+    `QR_ERROR_CORRECTION` (`L`/`M`/`Q`/`H`), `QR_PNG_COMPRESS_LEVEL`,
+    `QR_MASK_PATTERN` (0-7, unset for automatic) and `QR_CACHE_SIZE`.
+    Defaults match the previous `qrcode.make()` output byte for byte.
+    """
+    global _renderer
+    if _renderer is None:
+        mask_pattern = os.environ.get("QR_MASK_PATTERN")
+        _renderer = QRRenderer(
+            fmt=os.environ.get("QR_FORMAT", "png").lower(),
+            box_size=int(os.environ.get("QR_BOX_SIZE", 10)),
+            border=int(os.environ.get("QR_BORDER", 4)),
+            error_correction=os.environ.get("QR_ERROR_CORRECTION", "M").upper(),
+            compress_level=int(os.environ.get("QR_PNG_COMPRESS_LEVEL", 6)),
+            mask_pattern=int(mask_pattern) if mask_pattern else None,
+            cache_size=int(os.environ.get("QR_CACHE_SIZE", 0)),
+        )
+    return _renderer
+
+
+def reset_renderer():
+    global _renderer
+    _renderer = None
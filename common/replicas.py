@@ -0,0 +1,248 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import credcache, metrics
+
+# MariaDB; an empty result means the server is not a replica (always current)
+LAG_SQL = "SHOW SLAVE STATUS"
+
+
+class Replica:
+    """Address and health of one read replica."""
+
+    __slots__ = ("host", "port", "down_until", "lag", "checked_at")
+
+    def __init__(self, host, port=3306):
+        self.host = host
+        self.port = port
+        self.down_until = 0.0
+        self.lag = None
+        self.checked_at = None
+
+    @classmethod
+    def parse(cls, address):
+        host, _, port = address.strip().partition(":")
+        return cls(host, int(port) if port else 3306)
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+
+class ReplicaSet:
+    """
+    Routing state of the read replicas: round robin over the healthy ones.
+
+    A replica is skipped for `retry_interval` seconds after it failed to
+    connect, and while its replication lag, measured every `check_interval`
+    seconds by the first read that borrows it, exceeds `max_lag`. Reads about
+    a key written less than `max_lag + check_interval` seconds ago go to the
+    primary, so a user always reads their own writes.
+
+    Parameters
+    ----------
+    replicas : list of Replica
+        The read replicas.
+    max_lag : float
+        Staleness bound in seconds.
+    check_interval : float
+        Seconds between two lag measurements of a replica.
+    retry_interval : float
+        Seconds a replica that failed to connect is left aside.
+    recent_size : int
+        Maximum number of recently written keys remembered.
+    """
+
+    def __init__(self, replicas, max_lag=5, check_interval=5, retry_interval=30, recent_size=10000,
+                 clock=time.monotonic):
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.recent_size = recent_size
+        self._clock = clock
+        self._next = 0
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"replica": 0, "primary_recent_write": 0, "primary_fallback": 0, "failures": 0, "lagging": 0}
+
+    @property
+    def staleness_window(self):
+        """Longest delay, in seconds, before a write is visible on every replica in use."""
+        return self.max_lag + self.check_interval
+
+    def candidates(self, keys=()):
+        """
+        Yield the replicas to try for a read, in round-robin order.
+
+        Yields nothing when one of `keys` was written recently, or when no
+        replica is usable; the caller then reads from the primary.
+        """
+        now = self._clock()
+        with self._lock:
+            if any(self._recently_written(key, now) for key in keys):
+                self._counters["primary_recent_write"] += 1
+                return
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.replicas), 1)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if self.usable(replica, now):
+                yield replica
+        with self._lock:
+            self._counters["primary_fallback"] += 1
+
+    def _recently_written(self, key, now):
+        # Caller holds the lock
+        written_at = self._recent.get(key)
+        if written_at is None:
+            return False
+        if now - written_at > self.staleness_window:
+            del self._recent[key]
+            return False
+        return True
+
+    def usable(self, replica, now=None):
+        now = self._clock() if now is None else now
+        if now < replica.down_until:
+            return False
+        # A lagging replica stays aside until its next measurement is due
+        return replica.lag is None or replica.lag <= self.max_lag or self.needs_check(replica, now)
+
+    def needs_check(self, replica, now=None):
+        now = self._clock() if now is None else now
+        return replica.checked_at is None or now - replica.checked_at >= self.check_interval
+
+    def report_lag(self, replica, lag):
+        """
+        Record a lag measurement; returns True if the replica may serve reads.
+
+        `lag` is None when replication is broken (`Seconds_Behind_Master` NULL).
+        """
+        replica.checked_at = self._clock()
+        replica.lag = float("inf") if lag is None else lag
+        if replica.lag > self.max_lag:
+            with self._lock:
+                self._counters["lagging"] += 1
+            return False
+        return True
+
+    def report_failure(self, replica):
+        replica.down_until = self._clock() + self.retry_interval
+        with self._lock:
+            self._counters["failures"] += 1
+
+    def report_read(self):
+        with self._lock:
+            self._counters["replica"] += 1
+
+    def mark_written(self, key):
+        """Send the reads of `key` to the primary for the next `staleness_window` seconds."""
+        if self.recent_size <= 0:
+            return
+        with self._lock:
+            self._recent[key] = self._clock()
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.recent_size:
+                self._recent.popitem(last=False)
+
+    def stats(self):
+        """
+        Return the state of every replica and the routing counters.
+
+        Returns
+        -------
+        dict
+            `replicas` maps each `host:port` to `{"usable": bool, "lag": float or None}`;
+            the `replica`, `primary_recent_write`, `primary_fallback`,
+            `failures` and `lagging` counters follow.
+        """
+        now = self._clock()
+        snapshot = {
+            "replicas": {r.name: {"usable": self.usable(r, now), "lag": r.lag} for r in self.replicas},
+        }
+        with self._lock:
+            snapshot.update(self._counters)
+        return snapshot
+
+
+def lag_from_status(row):
+    """Return the lag in seconds of a `SHOW SLAVE STATUS` row (dict), 0 for a server that is not a replica."""
+    if not row:
+        return 0.0
+    lag = row.get("Seconds_Behind_Master")
+    return None if lag is None else float(lag)
+
+
+_replicas = None
+_replicas_lock = threading.Lock()
+
+
+def get_replicas():
+    """
+    Return the worker-wide `ReplicaSet`, or None when `DB_READ_HOSTS` is not set.
+
+    `DB_READ_HOSTS` lists the replicas as comma-separated `host[:port]`;
+    they share the `DB_USER`, `DB_PASSWORD` and `DB_NAME` of the primary
+    (`DB_HOST`). Tuned by `DB_REPLICA_MAX_LAG` (default 5 s),
+    `DB_REPLICA_CHECK_INTERVAL` (default 5 s) and `DB_REPLICA_RETRY_INTERVAL`
+    (default 30 s).
+    """
+    global _replicas
+    hosts = os.environ.get("DB_READ_HOSTS", "").strip()
+    if not hosts:
+        return None
+    if _replicas is None:
+        with _replicas_lock:
+            if _replicas is None:
+                _replicas = ReplicaSet(
+                    [Replica.parse(address) for address in hosts.split(",") if address.strip()],
+                    max_lag=float(os.environ.get("DB_REPLICA_MAX_LAG", 5)),
+                    check_interval=float(os.environ.get("DB_REPLICA_CHECK_INTERVAL", 5)),
+                    retry_interval=float(os.environ.get("DB_REPLICA_RETRY_INTERVAL", 30)),
+                )
+    return _replicas
+
+
+def staleness_window():
+    """Seconds a write may take to reach the replicas in use; 0 without replicas."""
+    current = get_replicas()
+    return current.staleness_window if current is not None else 0.0
+
+
+def _on_credential_change(username):
+    current = _replicas
+    if current is not None:
+        current.mark_written(username)
+
+
+credcache.register_listener(_on_credential_change)
+
+
+def _collect_metrics():
+    current = _replicas
+    if current is None:
+        return []
+    stats = current.stats()
+    return [
+        ("cofrap_db_replica_usable", "gauge", "Whether a read replica currently serves reads.",
+         [((("replica", name),), int(state["usable"])) for name, state in stats["replicas"].items()]),
+        ("cofrap_db_replica_lag_seconds", "gauge", "Last measured replication lag.",
+         [((("replica", name),), state["lag"]) for name, state in stats["replicas"].items() if state["lag"] is not None]),
+        ("cofrap_db_reads_total", "counter", "Read-only borrows by destination.",
+         [((("route", key),), stats[key]) for key in ("replica", "primary_recent_write", "primary_fallback")]),
+        ("cofrap_db_replica_events_total", "counter", "Replica connection failures and lag rejections.",
+         [((("event", key),), stats[key]) for key in ("failures", "lagging")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def reset_replicas():
+    """Drop the worker-wide replica state; the next `get_replicas()` reads the environment again."""
+    global _replicas
+    with _replicas_lock:
+        _replicas = None
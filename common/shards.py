@@ -0,0 +1,127 @@
+import bisect
+import hashlib
+import os
+import threading
+
+
+class Shard:
+    """
+    One database holding a slice of the `users` table.
+
+    `location` is `host[:port]` for MariaDB, a file path for the embedded
+    SQLite backend. Keys are placed by `name`: a shard moved to another
+    server keeps its users.
+    """
+
+    __slots__ = ("name", "location")
+
+    def __init__(self, name, location):
+        self.name = name
+        self.location = location
+
+    @classmethod
+    def parse(cls, entry):
+        """Build a shard from a `name=location` entry of `DB_SHARDS` (a bare location is also its name)."""
+        name, sep, location = entry.strip().partition("=")
+        return cls(name.strip(), location.strip()) if sep else cls(name.strip(), name.strip())
+
+    @property
+    def host(self):
+        return self.location.partition(":")[0]
+
+    @property
+    def port(self):
+        port = self.location.partition(":")[2]
+        return int(port) if port else 3306
+
+
+def _point(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class ShardMap:
+    """
+    Consistent-hash ring placing every username on one shard.
+
+    Each shard owns `vnodes` points of a 64-bit ring, and a username belongs
+    to the shard of the first point at or after its hash. Adding a shard
+    only moves the keys falling just before its points, about `1 / n` of
+    them, all to the new shard; removing one only moves its own keys.
+
+    Parameters
+    ----------
+    shards : list of Shard
+        The shards, with distinct names.
+    vnodes : int
+        Points per shard: more points spread the keys more evenly.
+    """
+
+    def __init__(self, shards, vnodes=160):
+        self.shards = list(shards)
+        names = [shard.name for shard in self.shards]
+        if not names or len(set(names)) != len(names):
+            raise ValueError(f"shard names must be distinct and non-empty: {names}")
+        ring = sorted((_point(f"{shard.name}#{i}"), index) for index, shard in enumerate(self.shards) for i in range(vnodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [index for _, index in ring]
+
+    def owner(self, key):
+        """Return the `Shard` holding `key`."""
+        index = bisect.bisect_left(self._points, _point(key)) % len(self._points)
+        return self.shards[self._owners[index]]
+
+    def owner_of(self, keys):
+        """
+        Return the single `Shard` holding every one of `keys`.
+
+        Raises
+        ------
+        ValueError
+            If `keys` is empty or spans several shards.
+        """
+        owners = {}
+        for key in keys:
+            shard = self.owner(key)
+            owners[shard.name] = shard
+        if len(owners) != 1:
+            raise ValueError(f"keys {sorted(keys)} are not on a single shard")
+        return next(iter(owners.values()))
+
+    def group(self, keys):
+        """Split `keys` by owning shard, as `{shard name: [keys, in order]}`."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.owner(key).name, []).append(key)
+        return groups
+
+
+_shards = None
+_shards_lock = threading.Lock()
+
+
+def get_shards():
+    """
+    Return the worker-wide `ShardMap`, or None without `DB_SHARDS`.
+
+    `DB_SHARDS` lists `name=location` entries separated by commas;
+    `DB_SHARD_VNODES` (default 160) sets the points per shard.
+    """
+    global _shards
+    spec = os.environ.get("DB_SHARDS", "")
+    if not spec.strip():
+        return None
+    if _shards is None:
+        with _shards_lock:
+            if _shards is None:
+                _shards = ShardMap(
+                    [Shard.parse(entry) for entry in spec.split(",") if entry.strip()],
+                    vnodes=int(os.environ.get("DB_SHARD_VNODES", 160)),
+                )
+    return _shards
+
+
+def reset_shards():
+    """Drop the worker-wide shard map; the next `get_shards()` reads `DB_SHARDS` again."""
+    global _shards
+    with _shards_lock:
+        _shards = None
@@ -0,0 +1,35 @@
+import atexit
+import signal
+import threading
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def on_shutdown(callback):
+    """
+    Call `callback()` when the worker process exits, SIGTERM included.
+
+    The watchdog stops the function process with SIGTERM, which skips atexit
+    handlers unless it is turned into a regular interpreter exit: the first
+    call made from the main thread installs a handler doing so, unless the
+    server already set its own.
+    """
+    atexit.register(callback)
+    _install_sigterm_handler()
+
+
+def _on_sigterm(signum, frame):
+    raise SystemExit(0)
+
+
+def _install_sigterm_handler():
+    global _installed
+    if threading.current_thread() is not threading.main_thread():
+        return
+    with _install_lock:
+        if _installed:
+            return
+        _installed = True
+        if signal.getsignal(signal.SIGTERM) in (signal.SIG_DFL, None):
+            signal.signal(signal.SIGTERM, _on_sigterm)
@@ -0,0 +1,437 @@
+import asyncio
+import contextvars
+import functools
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import uuid
+from collections import deque
+from concurrent import futures
+from contextlib import contextmanager
+
+from . import deadline
+
+MEMORY = ":memory:"
+
+# `sql/init.sql` plus every migration of `sql/migrations/`, in SQLite's dialect
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  username VARCHAR(100) NOT NULL,
+  password TEXT NOT NULL,
+  mfa TEXT NOT NULL,
+  gendate BIGINT NOT NULL,
+  expired TINYINT(1) DEFAULT 0,
+  expires_at BIGINT GENERATED ALWAYS AS (gendate + 15552000) STORED
+);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_users_username ON users (username);
+CREATE INDEX IF NOT EXISTS ix_users_expired_gendate ON users (expired, gendate);
+CREATE INDEX IF NOT EXISTS ix_users_expired_expires_at ON users (expired, expires_at);
+CREATE TABLE IF NOT EXISTS credential_changes (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  username VARCHAR(100) NOT NULL,
+  changed_at BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_credential_changes_changed_at ON credential_changes (changed_at);
+CREATE TABLE IF NOT EXISTS table_versions (
+  name VARCHAR(64) PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at BIGINT NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO table_versions (name, version, updated_at)
+  VALUES ('users', 0, CAST(strftime('%s', 'now') AS INTEGER));
+"""
+
+BUSY_TIMEOUT_MS = 5000
+# Set on every connection to a database file. `synchronous = NORMAL` is
+# durable in WAL mode up to the last checkpoint: a power cut may lose the
+# last commits, never corrupt the file.
+FILE_PRAGMAS = (
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16384",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+)
+# In-memory databases share one cache, which locks whole tables: readers
+# read uncommitted data rather than wait for the writers
+MEMORY_PRAGMAS = ("PRAGMA read_uncommitted = 1",)
+
+# SQLite virtual machine instructions between two deadline checks
+PROGRESS_STEPS = 10000
+
+_ON_DUPLICATE = re.compile(r"ON\s+DUPLICATE\s+KEY\s+UPDATE", re.IGNORECASE)
+_VALUES_REF = re.compile(r"VALUES\((\w+)\)", re.IGNORECASE)
+_UNIX_TIMESTAMP = re.compile(r"UNIX_TIMESTAMP\(\)", re.IGNORECASE)
+_INSERT_IGNORE = re.compile(r"^\s*INSERT\s+IGNORE\b", re.IGNORECASE)
+_UPDATE_LIMIT = re.compile(r"^\s*UPDATE\s+(\w+)\s+SET\s+(.*?)\s+WHERE\s+(.*?)\s+LIMIT\s+(\S+)\s*$", re.IGNORECASE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=256)
+def translate(sql):
+    """
+    Rewrite the MySQL dialect used by the handlers into SQLite.
+
+    Covers `%s` placeholders, `UNIX_TIMESTAMP()`, `INSERT IGNORE`,
+    `ON DUPLICATE KEY UPDATE` on the `username` key and `UPDATE ... LIMIT`.
+    """
+    sql = sql.replace("%s", "?")
+    sql = _UNIX_TIMESTAMP.sub("CAST(strftime('%s', 'now') AS INTEGER)", sql)
+    sql = _INSERT_IGNORE.sub("INSERT OR IGNORE", sql)
+    if _ON_DUPLICATE.search(sql):
+        sql = _ON_DUPLICATE.sub("ON CONFLICT(username) DO UPDATE SET", sql)
+        sql = _VALUES_REF.sub(r"excluded.\1", sql)
+    # Without SQLITE_ENABLE_UPDATE_DELETE_LIMIT, which Python's build lacks
+    sql = _UPDATE_LIMIT.sub(r"UPDATE \1 SET \2 WHERE rowid IN (SELECT rowid FROM \1 WHERE \3 LIMIT \4)", sql)
+    return sql
+
+
+def is_dict_cursor(cursorclass):
+    """Tell whether `cursorclass` (pymysql's or aiomysql's) returns rows as dictionaries."""
+    return cursorclass is not None and cursorclass.__name__.endswith("DictCursor")
+
+
+class Cursor:
+    """pymysql-compatible cursor of a `Connection`."""
+
+    def __init__(self, conn, as_dict):
+        self._conn = conn
+        self._cursor = conn._db.cursor()
+        self._as_dict = as_dict
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _row(self, row):
+        if row is None or not self._as_dict:
+            return row
+        return dict(zip([d[0] for d in self._cursor.description], row))
+
+    def execute(self, sql, args=None):
+        self._conn.queries += 1
+        with self._conn.writing(sql):
+            self._cursor.execute(translate(sql), tuple(args or ()))
+        self.rowcount = self._cursor.rowcount
+        return max(self.rowcount, 0)
+
+    def executemany(self, sql, args):
+        self._conn.queries += 1
+        with self._conn.writing(sql):
+            self._cursor.executemany(translate(sql), [tuple(a) for a in args])
+        self.rowcount = self._cursor.rowcount
+        return max(self.rowcount, 0)
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchmany(self, size=1):
+        return [self._row(r) for r in self._cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._row(r) for r in self._cursor.fetchall()]
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    """
+    pymysql-compatible connection to a `Database`, in autocommit mode.
+
+    SQLite has a single writer: writes, autocommit statements or `begin()`
+    ... `commit()` transactions, take the database's write lock in turn
+    rather than fail or spin on a busy database. A statement still running
+    once the current request is out of time is interrupted (see
+    `common.deadline`).
+    """
+
+    def __init__(self, database):
+        self._database = database
+        self._db = sqlite3.connect(database.uri, uri=True, check_same_thread=False, isolation_level=None)
+        for pragma in database.pragmas:
+            self._db.execute(pragma)
+        self._db.set_progress_handler(deadline.expired, PROGRESS_STEPS)
+        self._in_transaction = False
+        self.queries = 0
+        self.open = True
+
+    @contextmanager
+    def writing(self, sql):
+        if self._in_transaction or sql.lstrip()[:6].upper() == "SELECT":
+            yield
+            return
+        with self._database.write_lock:
+            yield
+
+    def _end_transaction(self):
+        if self._in_transaction:
+            self._in_transaction = False
+            self._database.write_lock.release()
+
+    def cursor(self, cursorclass=None):
+        return Cursor(self, is_dict_cursor(cursorclass))
+
+    def begin(self):
+        if not self._in_transaction:
+            self._database.write_lock.acquire()
+            self._in_transaction = True
+        if not self._db.in_transaction:
+            self._db.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        try:
+            if self._db.in_transaction:
+                self._db.execute("COMMIT")
+        finally:
+            self._end_transaction()
+
+    def rollback(self):
+        try:
+            if self._db.in_transaction:
+                self._db.execute("ROLLBACK")
+        finally:
+            self._end_transaction()
+
+    def ping(self, reconnect=False):
+        self._db.execute("SELECT 1")
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self._database.closed += 1
+            self._db.close()
+            self._end_transaction()
+
+
+class Database:
+    """
+    An SQLite database with the COFRAP schema, created if missing.
+
+    A file is opened in WAL mode, so that readers never wait for the
+    writer, with the `FILE_PRAGMAS` on every connection. `MEMORY` opens a
+    private in-memory database instead, shared by the connections of this
+    `Database` and gone with it.
+
+    Parameters
+    ----------
+    path : str
+        Database file, or `MEMORY`.
+
+    Attributes
+    ----------
+    opened, closed : int
+        Number of connections opened and closed so far.
+    write_lock : threading.RLock
+        Held by the connection writing, see `Connection`.
+    """
+
+    def __init__(self, path=MEMORY):
+        self.path = path
+        if path == MEMORY:
+            self.uri = f"file:cofrap_{uuid.uuid4().hex}?mode=memory&cache=shared"
+            self.pragmas = MEMORY_PRAGMAS
+        else:
+            self.uri = pathlib.Path(path).absolute().as_uri()
+            self.pragmas = FILE_PRAGMAS
+        self.write_lock = threading.RLock()
+        self.opened = 0
+        self.closed = 0
+        # Keeps an in-memory database alive for the object's lifetime
+        self._anchor = sqlite3.connect(self.uri, uri=True, check_same_thread=False, isolation_level=None)
+        self._anchor.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        self._anchor.execute("PRAGMA journal_mode = " + ("MEMORY" if path == MEMORY else "WAL"))
+        with self.write_lock:
+            self._anchor.executescript(SCHEMA)
+
+    def connect(self):
+        self.opened += 1
+        return Connection(self)
+
+    def count(self, sql="SELECT COUNT(*) FROM users"):
+        return self._anchor.execute(sql).fetchone()[0]
+
+    def close(self):
+        self._anchor.close()
+
+
+# -------------------- ASYNCIO ADAPTER --------------------
+#
+# Same interface as the aiomysql pool `common.aiopool` expects. Every
+# connection runs its statements on a thread of its own: the event loop
+# never blocks on the write lock, and a transaction is begun and ended on
+# the thread that holds the lock.
+
+
+class AsyncCursor:
+    def __init__(self, conn, cursor):
+        self._conn = conn
+        self._cursor = cursor
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._cursor.close()
+
+    async def execute(self, sql, args=None):
+        return await self._conn._run(self._cursor.execute, sql, args)
+
+    async def executemany(self, sql, args):
+        return await self._conn._run(self._cursor.executemany, sql, args)
+
+    async def fetchone(self):
+        return await self._conn._run(self._cursor.fetchone)
+
+    async def fetchmany(self, size=1):
+        return await self._conn._run(self._cursor.fetchmany, size)
+
+    async def fetchall(self):
+        return await self._conn._run(self._cursor.fetchall)
+
+
+class AsyncConnection:
+    """aiomysql-compatible wrapper of a `Connection`."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.closed = False
+
+    async def _run(self, fn, *args):
+        # In a copy of the request context, for the deadline checks
+        return await asyncio.get_running_loop().run_in_executor(self._executor, contextvars.copy_context().run, fn, *args)
+
+    def cursor(self, cursorclass=None):
+        return AsyncCursor(self, self._conn.cursor(cursorclass))
+
+    async def begin(self):
+        await self._run(self._conn.begin)
+
+    async def commit(self):
+        await self._run(self._conn.commit)
+
+    async def rollback(self):
+        await self._run(self._conn.rollback)
+
+    def close(self):
+        # After the statement in flight, if any
+        if not self.closed:
+            self.closed = True
+            self._executor.submit(self._conn.close)
+            self._executor.shutdown(wait=False)
+
+
+class AsyncPool:
+    """
+    Bounded pool of `AsyncConnection`s to a `Database`, bound to one event loop.
+
+    Parameters
+    ----------
+    database : Database
+        The database the connections are opened to.
+    maxsize : int
+        Maximum number of connections (idle + in use).
+    """
+
+    def __init__(self, database, maxsize=20):
+        self._database = database
+        self.maxsize = maxsize
+        self.size = 0
+        self._idle = []
+        self._waiters = deque()
+
+    @property
+    def freesize(self):
+        return len(self._idle)
+
+    async def acquire(self):
+        while True:
+            if self._idle:
+                return self._idle.pop()
+            if self.size < self.maxsize:
+                self.size += 1
+                try:
+                    return AsyncConnection(await asyncio.to_thread(self._database.connect))
+                except BaseException:
+                    self.size -= 1
+                    self._wake()
+                    raise
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled():
+                    # Woken, then cancelled: pass the turn on
+                    self._wake()
+                else:
+                    self._waiters.remove(waiter)
+                raise
+
+    def _wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def release(self, conn):
+        if conn.closed:
+            self.size -= 1
+        else:
+            self._idle.append(conn)
+        self._wake()
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        self.size -= len(idle)
+        for conn in idle:
+            conn.close()
+
+    async def wait_closed(self):
+        pass
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path=None):
+    """
+    Return the worker-wide database at `path`, opened on first use.
+
+    `path` defaults to `DB_PATH` (default `cofrap.db`), `:memory:` for a
+    private in-memory database; shards pass their own (see `common.shards`).
+    """
+    path = path or os.environ.get("DB_PATH", "cofrap.db")
+    database = _databases.get(path)
+    if database is None:
+        with _databases_lock:
+            database = _databases.get(path)
+            if database is None:
+                database = _databases[path] = Database(path)
+    return database
+
+
+def connect_from_env(path=None):
+    """Open a new connection to `get_database(path)`, as `pool.connect_from_env` does for MariaDB."""
+    return get_database(path).connect()
+
+
+async def create_pool_from_env(path=None):
+    """Same as `aiopool.create_pool_from_env`, on `get_database(path)` and sized by `DB_ASYNC_POOL_SIZE`."""
+    return AsyncPool(get_database(path), maxsize=int(os.environ.get("DB_ASYNC_POOL_SIZE", 20)))
+
+
+def reset_database():
+    """Close and drop the worker-wide databases; the next `get_database()` opens them again."""
+    with _databases_lock:
+        for database in _databases.values():
+            database.close()
+        _databases.clear()
@@ -0,0 +1,351 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import credcache, metrics, pool, replicas
+
+REBUILD_BATCH_SIZE = 5000
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings.
+
+    Answers "definitely absent" or "possibly present"; the probability of a
+    false "possibly present" stays near `error_rate` up to `capacity` items.
+    Probes are derived from one blake2b digest by double hashing.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of items the filter is sized for.
+    error_rate : float
+        Target false-positive probability at `capacity` items.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(int(capacity), 1)
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _probes(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for bit in self._probes(item):
+            self._bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[bit >> 3] & (1 << (bit & 7)) for bit in self._probes(item))
+
+
+class NegativeCache:
+    """
+    Bounded set of usernames recently found missing, each kept for `ttl` seconds.
+
+    Catches repeated lookups of the same unknown name that the Bloom filter
+    lets through (false positives, or the filter not being built yet).
+    """
+
+    def __init__(self, max_size=10000, ttl=30, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, username):
+        with self._lock:
+            stored_at = self._entries.get(username)
+            if stored_at is None:
+                return False
+            if self._clock() - stored_at > self.ttl:
+                del self._entries[username]
+                return False
+            return True
+
+    def add(self, username):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[username] = self._clock()
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class KnownUsers:
+    """
+    Membership test over the usernames of the `users` table.
+
+    A Bloom filter answers "definitely unknown" without a query; it is
+    rebuilt from the table every `refresh_interval` seconds on a background
+    thread, and in between every username published on the
+    `credential_changes` feed (e.g. by generate-password) is added to it.
+    Until the first build completes every name is considered possibly known.
+
+    Notes
+    -----
+    A user created by another function becomes known at the next
+    `CredentialCache.sync()`, i.e. after at most `CREDENTIAL_CACHE_SYNC_INTERVAL`
+    seconds.
+
+    Parameters
+    ----------
+    connection : callable or dict
+        Factory returning a context manager that yields a DB connection, or
+        a dict of factories such as `pool.partitions()`, all scanned.
+    refresh_interval : float
+        Seconds between two rebuilds of the filter.
+    error_rate : float
+        False-positive target of the filter.
+    negative_cache : NegativeCache
+        Cache of names the database reported missing.
+    recent_window : float
+        Seconds during which an added name is carried over to the filters
+        rebuilt afterwards: a scan of a lagging read replica may not see it yet.
+    """
+
+    def __init__(self, connection, refresh_interval=600, error_rate=0.001, negative_cache=None, recent_window=0,
+                 clock=time.monotonic):
+        self.refresh_interval = refresh_interval
+        self.error_rate = error_rate
+        self.negative_cache = negative_cache if negative_cache is not None else NegativeCache()
+        self._connection = connection
+        self._clock = clock
+        self._filter = None
+        self._pending = None
+        self.recent_window = recent_window
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._next_refresh = 0.0
+        self._builder = None
+        self._counters = {"rejected": 0, "negative_hits": 0, "false_positives": 0, "rebuilds": 0, "rebuild_failures": 0}
+
+    @property
+    def ready(self):
+        return self._filter is not None
+
+    def _count(self, event):
+        with self._lock:
+            self._counters[event] += 1
+
+    def might_exist(self, username):
+        """
+        Return False only if `username` is certainly not a known user.
+
+        Also starts a background rebuild of the filter when one is due.
+        """
+        self._maybe_refresh()
+        if username in self.negative_cache:
+            self._count("negative_hits")
+            return False
+        current = self._filter
+        if current is not None and username not in current:
+            self._count("rejected")
+            return False
+        return True
+
+    def record_missing(self, username):
+        """Remember that the database has no `username` (a false positive if the filter let it through)."""
+        if self._filter is not None:
+            self._count("false_positives")
+        self.negative_cache.add(username)
+
+    def add(self, username):
+        """Make `username` known, e.g. right after it was created."""
+        self.negative_cache.discard(username)
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(username)
+            if self._pending is not None:
+                self._pending.add(username)
+            if self.recent_window > 0:
+                self._recent[username] = self._clock()
+                self._recent.move_to_end(username)
+                self._expire_recent()
+
+    def _expire_recent(self):
+        # Caller holds the lock
+        horizon = self._clock() - self.recent_window
+        while self._recent and next(iter(self._recent.values())) < horizon:
+            self._recent.popitem(last=False)
+
+    def _maybe_refresh(self):
+        if self._clock() < self._next_refresh:
+            return
+        with self._lock:
+            if self._clock() < self._next_refresh or self._builder is not None:
+                return
+            self._builder = threading.Thread(target=self._rebuild_in_background, name="cofrap-userfilter", daemon=True)
+            self._builder.start()
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        finally:
+            with self._lock:
+                self._builder = None
+
+    def rebuild(self):
+        """
+        Build a new filter from the `users` table and swap it in.
+
+        Names added while the table is scanned, or within `recent_window`
+        before, are carried over, so a user created during a rebuild is
+        never dropped.
+
+        Returns
+        -------
+        bool
+            False if the table could not be read; the previous filter is kept.
+        """
+        with self._rebuild_lock:
+            with self._lock:
+                self._pending = set()
+            try:
+                new_filter = self._scan()
+            except Exception:
+                with self._lock:
+                    self._counters["rebuild_failures"] += 1
+                    self._pending = None
+                    self._next_refresh = self._clock() + min(self.refresh_interval, 30)
+                return False
+
+            with self._lock:
+                self._expire_recent()
+                for username in self._pending.union(self._recent):
+                    new_filter.add(username)
+                self._filter = new_filter
+                self._pending = None
+                self._counters["rebuilds"] += 1
+                self._next_refresh = self._clock() + self.refresh_interval
+            return True
+
+    def _scan(self):
+        factories = self._connection if isinstance(self._connection, dict) else {None: self._connection}
+        count = 0
+        for factory in factories.values():
+            with factory() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT COUNT(*) FROM users")
+                    count += cursor.fetchone()[0]
+        # Head room for the users created before the next rebuild
+        new_filter = BloomFilter(max(count * 2, 1024), self.error_rate)
+        for factory in factories.values():
+            with factory() as conn:
+                with conn.cursor(pool.pymysql.cursors.SSCursor) as cursor:
+                    cursor.execute("SELECT username FROM users")
+                    while True:
+                        rows = cursor.fetchmany(REBUILD_BATCH_SIZE)
+                        if not rows:
+                            break
+                        for (username,) in rows:
+                            new_filter.add(username)
+        return new_filter
+
+    def stats(self):
+        """
+        Return the filter and negative-cache sizes and the rejection counters.
+
+        Returns
+        -------
+        dict
+            `ready`, `filter_items`, `filter_bits`, `negative_entries`, and
+            the `rejected`, `negative_hits`, `false_positives`, `rebuilds`
+            and `rebuild_failures` counters.
+        """
+        current = self._filter
+        snapshot = {
+            "ready": current is not None,
+            "filter_items": current.count if current is not None else 0,
+            "filter_bits": current.size if current is not None else 0,
+            "negative_entries": len(self.negative_cache),
+        }
+        with self._lock:
+            snapshot.update(self._counters)
+        return snapshot
+
+
+_known_users = None
+_known_users_lock = threading.Lock()
+
+
+def get_known_users():
+    """
+    Return the worker-wide `KnownUsers`, or None when `USER_FILTER=0`.
+
+    Configured from `USER_FILTER_REFRESH_INTERVAL`, `USER_FILTER_ERROR_RATE`,
+    `NEGATIVE_CACHE_SIZE` and `NEGATIVE_CACHE_TTL`. The table is scanned on
+    a read replica when `DB_READ_HOSTS` is set, on every shard with `DB_SHARDS`.
+    """
+    global _known_users
+    if os.environ.get("USER_FILTER", "1") == "0":
+        return None
+    if _known_users is None:
+        with _known_users_lock:
+            if _known_users is None:
+                _known_users = KnownUsers(
+                    pool.partitions(read=True),
+                    refresh_interval=float(os.environ.get("USER_FILTER_REFRESH_INTERVAL", 600)),
+                    error_rate=float(os.environ.get("USER_FILTER_ERROR_RATE", 0.001)),
+                    negative_cache=NegativeCache(
+                        max_size=int(os.environ.get("NEGATIVE_CACHE_SIZE", 10000)),
+                        ttl=float(os.environ.get("NEGATIVE_CACHE_TTL", 30)),
+                    ),
+                    recent_window=replicas.staleness_window(),
+                )
+    return _known_users
+
+
+def _on_credential_change(username):
+    current = _known_users
+    if current is not None:
+        current.add(username)
+
+
+credcache.register_listener(_on_credential_change)
+
+
+def _collect_metrics():
+    current = _known_users
+    if current is None:
+        return []
+    stats = current.stats()
+    return [
+        ("cofrap_user_filter_items", "gauge", "Usernames held by the known-users filter.",
+         [((), stats["filter_items"])]),
+        ("cofrap_user_filter_negative_entries", "gauge", "Usernames held by the negative cache.",
+         [((), stats["negative_entries"])]),
+        ("cofrap_user_filter_events_total", "counter", "Known-users filter lookups and rebuilds.",
+         [((("event", key),), stats[key])
+          for key in ("rejected", "negative_hits", "false_positives", "rebuilds", "rebuild_failures")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def reset_known_users():
+    """Drop the worker-wide filter; the next `get_known_users()` builds a fresh one."""
+    global _known_users
+    with _known_users_lock:
+        _known_users = None
@@ -0,0 +1,88 @@
+BUMP_SQL = "UPDATE table_versions SET version = version + 1, updated_at = UNIX_TIMESTAMP() WHERE name = %s"
+READ_SQL = "SELECT version, updated_at FROM table_versions WHERE name = %s"
+
+
+def bump(cursor, table="users"):
+    """
+    Record that `table` changed.
+
+    Call it with the cursor of the write, inside the same transaction, so
+    the new version becomes visible together with the rows it describes.
+    """
+    cursor.execute(BUMP_SQL, (table,))
+
+
+async def bump_async(cursor, table="users"):
+    """Same as `bump` with an `aiomysql` cursor."""
+    await cursor.execute(BUMP_SQL, (table,))
+
+
+def read(cursor, table="users"):
+    """
+    Return the entity tag of the current version of `table`.
+
+    Returns
+    -------
+    str or None
+        A quoted ETag, or None if the counter row does not exist (migration
+        005 not applied).
+    """
+    cursor.execute(READ_SQL, (table,))
+    return etag(table, cursor.fetchone())
+
+
+async def read_async(cursor, table="users"):
+    """Same as `read` with an `aiomysql` cursor."""
+    await cursor.execute(READ_SQL, (table,))
+    return etag(table, await cursor.fetchone())
+
+
+def etag(table, row):
+    if not row:
+        return None
+    version, updated_at = row
+    # `updated_at` keeps tags unique if the counter row is ever recreated
+    return f'"{table}-{version}-{updated_at}"'
+
+
+def combine(tags, table="users"):
+    """
+    Return one entity tag standing for the tags of several databases, e.g. every shard.
+
+    Its version is the sum of theirs and its `updated_at` the latest, so it
+    changes, and compares as newer, as soon as any of them moves.
+
+    Returns
+    -------
+    str or None
+        None if `tags` is empty or holds a None.
+    """
+    tags = list(tags)
+    if not tags or None in tags:
+        return None
+    if len(tags) == 1:
+        return tags[0]
+    orders = [_order(tag) for tag in tags]
+    return f'"{table}-{sum(version for _, version in orders)}-{max(updated_at for updated_at, _ in orders)}"'
+
+
+def if_none_match(header, tag):
+    """Tell whether an `If-None-Match` header value matches the entity tag `tag`."""
+    if not header or not tag:
+        return False
+    candidates = [c.strip() for c in header.split(",")]
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return "*" in candidates or any(c.removeprefix("W/") == tag for c in candidates)
+
+
+def _order(tag):
+    _, version, updated_at = tag.strip('"').rsplit("-", 2)
+    # `updated_at` first: a recreated counter row restarts at a lower version
+    return int(updated_at), int(version)
+
+
+def is_newer(tag, other):
+    """Tell whether the entity tag `tag` describes a later version than `other` (None is oldest)."""
+    if tag is None:
+        return False
+    return other is None or _order(tag) > _order(other)
@@ -0,0 +1,147 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import has_request_context, make_response, request
+
+from . import credcache, hashing, lazy, metrics, pool, qr, shards, userfilter
+
+pyotp = lazy.module("pyotp")
+
+log = logging.getLogger(__name__)
+
+WARMUP_PATH = "/_/warmup"
+
+
+def _warm_db():
+    lazy.load(pool.pymysql)
+    count = int(os.environ.get("WARMUP_DB_CONNECTIONS", 1))
+    if shards.get_shards() is None:
+        pool.get_pool().prefill(count)
+    pool.prefill_shards(count)
+    # An unreachable replica is left aside; reads fall back to the primary
+    pool.prefill_replicas(count)
+
+
+def _warm_credcache():
+    # The first sync only reads the current change id; doing it here keeps
+    # that round trip off the first login
+    credcache.get_cache().sync(pool.partitions())
+
+
+def _warm_userfilter():
+    known = userfilter.get_known_users()
+    if known is not None and not known.ready and not known.rebuild():
+        raise RuntimeError("could not build the known-users filter")
+
+
+def _warm_hashing():
+    # Calibrates the cost and starts the pool's worker processes
+    hashing.verify("warm-up", hashing.PasswordHash.parse(hashing.hash_password("warm-up")))
+
+
+def _warm_qr():
+    qr.get_renderer().render("otpauth://totp/warm-up?secret=JBSWY3DPEHPK3PXP&issuer=Cofrap")
+
+
+def _warm_totp():
+    totp = pyotp.TOTP(pyotp.random_base32())
+    totp.verify(totp.now(), valid_window=1)
+
+
+# Warm-up steps, in the order they run
+STEPS = {
+    "db": _warm_db,
+    "credcache": _warm_credcache,
+    "userfilter": _warm_userfilter,
+    "hashing": _warm_hashing,
+    "qr": _warm_qr,
+    "totp": _warm_totp,
+}
+
+
+def warm_up(components):
+    """
+    Pay the one-off costs of a cold replica ahead of its first request.
+
+    Every step is independent: a failing one (e.g. the database is not
+    reachable yet) is reported and the others still run.
+
+    Parameters
+    ----------
+    components : iterable of str
+        Names of the `STEPS` the function needs: `db` opens pooled connections
+        (`WARMUP_DB_CONNECTIONS`, default 1), `credcache` runs the first cache
+        sync, `userfilter` builds the known-users filter, `hashing` calibrates
+        the password hash cost and starts its workers, `qr` imports
+        qrcode/Pillow and renders a throwaway code, `totp` imports pyotp and
+        verifies a throwaway code.
+
+    Returns
+    -------
+    dict
+        `{"status": "ok" | "degraded", "steps": {name: ms}, "errors": {name: message}}`.
+    """
+    steps = {}
+    errors = {}
+    for name in STEPS:
+        if name not in components:
+            continue
+        start = time.perf_counter()
+        try:
+            with metrics.phase(f"warmup_{name}"):
+                STEPS[name]()
+        except Exception as e:
+            errors[name] = str(e)
+        steps[name] = round((time.perf_counter() - start) * 1000, 3)
+    return {"status": "degraded" if errors else "ok", "steps": steps, "errors": errors}
+
+
+def warm_up_in_background(components):
+    """Run `warm_up` on a daemon thread and return the thread."""
+    def run():
+        result = warm_up(components)
+        if result["errors"]:
+            log.warning("warm-up degraded: %s", result["errors"])
+
+    thread = threading.Thread(target=run, name="cofrap-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_warmup_request():
+    return has_request_context() and request.method in ("GET", "POST") and request.path == WARMUP_PATH
+
+
+def hook(*components):
+    """
+    Decorate an OpenFaaS `handle()` with a warm-up entry point.
+
+    - `GET /_/warmup` (or `POST`) runs `warm_up(components)` synchronously and
+      returns its report, with a 503 status if a step failed, so it can be
+      used as a readiness probe or called by the platform after a scale-up.
+    - With `WARMUP_ON_START=1`, the same warm-up is started on a background
+      thread as soon as the handler module is loaded.
+
+    Parameters
+    ----------
+    components : str
+        Warm-up steps needed by the function (see `warm_up`).
+    """
+    def decorator(handle):
+        if os.environ.get("WARMUP_ON_START", "0") == "1":
+            warm_up_in_background(components)
+
+        @functools.wraps(handle)
+        def wrapper(req):
+            if is_warmup_request():
+                result = warm_up(components)
+                resp = make_response(json.dumps(result), 503 if result["errors"] else 200)
+                resp.headers["Content-Type"] = "application/json"
+                return resp
+            return handle(req)
+        return wrapper
+    return decorator
@@ -0,0 +1,242 @@
+import itertools
+import logging
+import os
+import threading
+import time
+
+from . import metrics, shutdown
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Coalesce keys in memory and write them in batches on a daemon thread.
+
+    `add()` never touches the database: a key already waiting is coalesced,
+    and once `max_pending` keys wait new ones are dropped and counted. The
+    thread calls `flush(keys)` with up to `max_batch` distinct keys as soon
+    as that many are waiting, or `interval` seconds after the oldest one was
+    queued. A failed flush is logged, its keys are queued again and the next
+    attempt waits `interval` seconds.
+
+    Only suited to writes that can be lost: pending keys are gone if the
+    process dies, so the state they describe must be derivable again.
+
+    Parameters
+    ----------
+    flush : callable
+        Called with a list of keys, on the queue's thread.
+    max_batch : int
+        Keys per `flush` call, and the backlog that triggers one early.
+    interval : float
+        Maximum seconds a key waits before being flushed.
+    max_pending : int
+        Keys held at most; the others are dropped.
+    name : str
+        Name of the thread and `queue` label of the metrics.
+    """
+
+    def __init__(self, flush, max_batch=500, interval=1.0, max_pending=10000, name="write-behind"):
+        self._flush = flush
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_pending
+        self.name = name
+        self._cond = threading.Condition()
+        self._pending = {}  # insertion-ordered set
+        self._oldest = None
+        self._in_flight = 0
+        self._draining = 0
+        self._closed = False
+        self._counters = {"queued": 0, "coalesced": 0, "dropped": 0, "written": 0, "failed": 0, "flushes": 0}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def add(self, key):
+        """
+        Queue `key` for the next flush.
+
+        Returns
+        -------
+        bool
+            False if the queue was full, or closed, and the key was dropped.
+        """
+        with self._cond:
+            if key in self._pending:
+                self._counters["coalesced"] += 1
+                return True
+            if self._closed or len(self._pending) >= self.max_pending:
+                self._counters["dropped"] += 1
+                return False
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending[key] = None
+            self._counters["queued"] += 1
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+        return True
+
+    def _next_batch(self):
+        # Caller holds the lock; returns [] once closed
+        while not self._closed:
+            if not self._pending:
+                self._cond.wait()
+                continue
+            wait = self._oldest + self.interval - time.monotonic()
+            if wait <= 0 or self._draining or len(self._pending) >= self.max_batch:
+                batch = list(itertools.islice(self._pending, self.max_batch))
+                for key in batch:
+                    del self._pending[key]
+                self._oldest = time.monotonic() if self._pending else None
+                self._in_flight += len(batch)
+                return batch
+            self._cond.wait(wait)
+        return []
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self._flush(batch)
+                failed = False
+            except Exception:
+                log.warning("write-behind flush of %d %s keys failed", len(batch), self.name, exc_info=True)
+                failed = True
+            with self._cond:
+                self._in_flight -= len(batch)
+                self._counters["flushes"] += 1
+                if failed:
+                    self._counters["failed"] += len(batch)
+                    self._requeue(batch)
+                else:
+                    self._counters["written"] += len(batch)
+                self._cond.notify_all()
+                if failed:
+                    # Give the database a break before the retry
+                    self._cond.wait(self.interval)
+
+    def _requeue(self, batch):
+        # Caller holds the lock
+        if self._closed:
+            return
+        for key in batch:
+            if key not in self._pending and len(self._pending) < self.max_pending:
+                self._pending[key] = None
+        if self._pending:
+            self._oldest = time.monotonic()
+
+    def flush(self, timeout=None):
+        """
+        Flush every pending key now and wait for the writes.
+
+        Parameters
+        ----------
+        timeout : float or None
+            Maximum seconds to wait; None waits indefinitely.
+
+        Returns
+        -------
+        bool
+            True if nothing is left pending.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._draining += 1
+            self._cond.notify_all()
+            try:
+                while (self._pending or self._in_flight) and not self._closed:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return not self._pending
+            finally:
+                self._draining -= 1
+
+    def close(self):
+        """Stop the thread and drop the pending keys."""
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._oldest = None
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Return the backlog and the queue counters.
+
+        Returns
+        -------
+        dict
+            `pending`, `max_pending`, and the `queued`, `coalesced`,
+            `dropped`, `written`, `failed` and `flushes` counters.
+        """
+        with self._cond:
+            snapshot = {"pending": len(self._pending) + self._in_flight, "max_pending": self.max_pending}
+            snapshot.update(self._counters)
+        return snapshot
+
+
+SHUTDOWN_FLUSH_TIMEOUT = float(os.environ.get("WRITE_BEHIND_SHUTDOWN_TIMEOUT", 5))
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(name, flush):
+    """
+    Return the worker-wide queue `name`, created on first use with `flush`.
+
+    Configured from `WRITE_BEHIND_BATCH_SIZE` (default 500),
+    `WRITE_BEHIND_INTERVAL` (default 1 s) and `WRITE_BEHIND_MAX_PENDING`
+    (default 10000).
+    """
+    queue = _queues.get(name)
+    if queue is None:
+        with _queues_lock:
+            queue = _queues.get(name)
+            if queue is None:
+                queue = _queues[name] = WriteBehindQueue(
+                    flush,
+                    max_batch=int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 500)),
+                    interval=float(os.environ.get("WRITE_BEHIND_INTERVAL", 1)),
+                    max_pending=int(os.environ.get("WRITE_BEHIND_MAX_PENDING", 10000)),
+                    name=name,
+                )
+    return queue
+
+
+def _collect_metrics():
+    stats = {name: queue.stats() for name, queue in list(_queues.items())}
+    if not stats:
+        return []
+    return [
+        ("cofrap_write_behind_pending", "gauge", "Keys waiting in a write-behind queue.",
+         [((("queue", name),), s["pending"]) for name, s in stats.items()]),
+        ("cofrap_write_behind_events_total", "counter", "Write-behind queue outcomes, per key.",
+         [((("queue", name), ("event", key)), s[key])
+          for name, s in stats.items() for key in ("queued", "coalesced", "dropped", "written", "failed")]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+
+def flush_on_shutdown():
+    for queue in list(_queues.values()):
+        queue.flush(SHUTDOWN_FLUSH_TIMEOUT)
+
+
+shutdown.on_shutdown(flush_on_shutdown)
+
+
+def reset_queues():
+    """Stop and drop every worker-wide queue, discarding pending keys; `get_queue()` builds fresh ones."""
+    with _queues_lock:
+        for queue in _queues.values():
+            queue.close()
+        _queues.clear()
@@ -2,13 +2,19 @@ import importlib.util
 import inspect
 import os
 import builtins
+import sys
+
+# Handlers import the shared `common` package from the repo root
+sys.path.insert(0, os.path.abspath(".."))
 
 # Map paths to friendly function names
 paths = {
     "../generate-password/handler.py": "Generate Password",
     "../generate-2fa/handler.py": "Generate 2FA",
+    "../onboard-user/handler.py": "Onboard User",
     "../authenticate-user/handler.py": "Authenticate User",
     "../get-users/handler.py": "Get all users Function",
+    "../expire-credentials/handler.py": "Expire Credentials",
 }
 
 def extract_doc(file_path, title):
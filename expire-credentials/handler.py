@@ -0,0 +1,137 @@
+import os
+import json
+import time
+
+try:
+    from .common import breaker, deadline, metrics, pool, versions, warmup
+except ImportError:
+    from common import breaker, deadline, metrics, pool, versions, warmup
+
+DEFAULT_CHUNK_SIZE = int(os.environ.get("SWEEP_CHUNK_SIZE", 1000))
+DEFAULT_MAX_CHUNKS = int(os.environ.get("SWEEP_MAX_CHUNKS", 1000))
+
+
+def sweep_partition(connection, chunk_size, max_chunks, now):
+    """
+    Run the chunked sweep of `sweep_expired` on one database.
+
+    Returns
+    -------
+    tuple
+        `(rows_updated, chunks, complete)`.
+    """
+    rows_updated = 0
+    chunks = 0
+    last_chunk = 0.0
+    with connection.cursor() as cursor:
+        while chunks < max_chunks:
+            left = deadline.remaining()
+            if left is not None and left < last_chunk:
+                # Leave the rest to the next run rather than fail mid-chunk
+                break
+            chunk_start = time.perf_counter()
+            connection.begin()
+            affected = cursor.execute(
+                "UPDATE users SET expired = 1 WHERE expired = 0 AND expires_at < %s LIMIT %s",
+                (now, chunk_size)
+            )
+            if affected:
+                # Rows first, version last: the lock order of every other writer
+                versions.bump(cursor)
+                connection.commit()
+            else:
+                connection.rollback()
+            chunks += 1
+            rows_updated += affected
+            last_chunk = time.perf_counter() - chunk_start
+            if affected < chunk_size:
+                return rows_updated, chunks, True
+    return rows_updated, chunks, False
+
+
+def sweep_expired(chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=DEFAULT_MAX_CHUNKS, now=None):
+    """
+    Flag every account whose credentials are past `expires_at`.
+
+    Rows are updated by chunks of `chunk_size`, each chunk being its own
+    transaction, so row locks are held briefly and replication lag stays
+    bounded. Uses the (expired, expires_at) index of migration 004. A chunk
+    that flags accounts also bumps the `users` table version (migration 005);
+    an empty one is rolled back so the version only moves on real changes.
+    The sweep also stops early when the request deadline leaves less time
+    than the last chunk took. With `DB_SHARDS`, every shard is swept at
+    the same time, each with up to `max_chunks` chunks.
+
+    Parameters
+    ----------
+    chunk_size : int
+        Maximum number of rows updated per statement.
+    max_chunks : int
+        Maximum number of statements per run; the next run picks up the rest.
+    now : int, optional
+        Reference Unix timestamp, defaults to the current time.
+
+    Returns
+    -------
+    dict
+        `rows_updated`, `chunks`, `complete` (False if `max_chunks` or the
+        deadline was reached before every overdue account was flagged) and
+        `duration_ms`.
+    """
+    now = int(time.time()) if now is None else now
+    start = time.perf_counter()
+    with metrics.phase("db_write"):
+        swept = pool.scatter(lambda _, connection: sweep_partition(connection, chunk_size, max_chunks, now), read=False)
+    return {
+        "rows_updated": sum(rows for rows, _, _ in swept.values()),
+        "chunks": sum(chunks for _, chunks, _ in swept.values()),
+        "complete": all(complete for _, _, complete in swept.values()),
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+@warmup.hook("db")
+@metrics.instrumented("expire-credentials")
+def handle(req):
+    """
+    OpenFaaS entry point of the credential expiry sweeper.
+
+    Meant to be invoked on a schedule (cron-connector, see `stack.yaml`); it
+    marks every overdue account as expired in bounded chunks so that
+    `get-users` reports an accurate `expired` flag for the whole table.
+
+    Parameters
+    ----------
+    req : str
+        Optional JSON object overriding `chunk_size` and `max_chunks`.
+
+    Returns
+    -------
+    str
+        A JSON-formatted report:
+        {
+            "status": "ok",
+            "rows_updated": <int>,
+            "chunks": <int>,
+            "complete": <bool>,
+            "duration_ms": <float>
+        }
+        or `{"status": "error", "message": "<error details>"}`; a
+        `(body, 503 or 504, headers)` tuple with status `unavailable` or
+        `timeout` when the database breaker is open or the deadline spent.
+    """
+    try:
+        options = json.loads(req) if req and req.strip() else {}
+        chunk_size = int(options.get("chunk_size", DEFAULT_CHUNK_SIZE))
+        max_chunks = int(options.get("max_chunks", DEFAULT_MAX_CHUNKS))
+        if chunk_size < 1 or max_chunks < 1:
+            return json.dumps({"status": "error", "message": "chunk_size and max_chunks must be positive"})
+
+        report = sweep_expired(chunk_size, max_chunks)
+        return json.dumps({"status": "ok", **report})
+
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"status": status, "message": message}), code, headers
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)})
@@ -1,24 +1,93 @@
 import os
-import io
+import asyncio
 import json
 import base64
-import pyotp
-import pymysql
-import qrcode
-from flask import make_response
+from flask import has_request_context, make_response, request
 
-QR_DIR = "/home/app/qrcodes"
-os.makedirs(QR_DIR, exist_ok=True)
+try:
+    from .common import aiopool, artifacts, asgi, breaker, credcache, idempotency, lazy, metrics, pool, qr, warmup
+except ImportError:
+    from common import aiopool, artifacts, asgi, breaker, credcache, idempotency, lazy, metrics, pool, qr, warmup
+
+pyotp = lazy.module("pyotp")
+
+UPDATE_MFA_SQL = """
+    UPDATE users
+       SET mfa = %s
+     WHERE username = %s
+"""
+
+# An unknown user gets no secret, change-feed entry or artifact
+USER_NOT_FOUND = (json.dumps({"status": "error", "message": "user not found"}), 404)
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, Idempotency-Key",
+    "Access-Control-Max-Age": "3600",
+}
 
 
 def add_cors_headers(response):
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    response.headers["Access-Control-Max-Age"] = "3600"
+    for name, value in CORS_HEADERS.items():
+        response.headers[name] = value
     return response
 
 
+def new_secret(username):
+    """
+    Generate a TOTP secret and the provisioning URI to encode in the QR code.
+
+    Returns
+    -------
+    tuple
+        `(secret, uri)`.
+    """
+    secret = pyotp.random_base32()
+    totp = pyotp.TOTP(secret, digits=6)
+    return secret, totp.provisioning_uri(name=username, issuer_name="Cofrap")
+
+
+def provision(username):
+    """
+    Rotate the MFA secret of `username`: generate, render and store it.
+
+    The secret and its change-feed entry are written in one transaction;
+    the QR code artifact is only persisted once it is committed. Runs once
+    per idempotency key (see `handle`).
+
+    Returns
+    -------
+    tuple
+        `(body, status)` of the response, a 404 for an unknown user.
+    """
+    secret, uri = new_secret(username)
+    rendered = qr.get_renderer().render(uri)
+
+    encoded_secret = base64.b64encode(secret.encode()).decode()
+    qr_b64 = rendered.base64()
+
+    with pool.connection((username,)) as conn, metrics.phase("db_write"):
+        conn.begin()
+        with conn.cursor() as cur:
+            if not cur.execute(UPDATE_MFA_SQL, (encoded_secret, username)):
+                conn.rollback()
+                return USER_NOT_FOUND
+            credcache.publish_invalidation(cur, username)
+        conn.commit()
+
+    artifacts.get_writer().submit(f"{username}_2fa.{rendered.extension}", rendered.data)
+
+    resp_body = {
+        "code_mfa": qr_b64,
+        "qr_mimetype": rendered.mimetype,
+        "status": "ok"
+    }
+    return json.dumps(resp_body), 200
+
+
+@warmup.hook("db", "qr", "totp")
+@metrics.instrumented("generate-2fa")
 def handle(req):
     """
     Generate a TOTP-based MFA secret for a user, encode it as a QR code,
@@ -31,6 +100,7 @@ def handle(req):
     req : str
         A JSON-formatted string with the field:
         - `username` (str): the username for whom the MFA secret is generated.
+        An `Idempotency-Key` header (or `idempotency_key` field) makes retries safe, see Notes.
 
     Returns
     -------
@@ -38,10 +108,11 @@ def handle(req):
         If successful:
         {
             "code_mfa": "<base64-encoded QR code PNG>",
+            "qr_mimetype": "image/png",
             "status": "ok"
         }
 
-        If error:
+        If error (404 for a user that does not exist):
         {
             "status": "error",
             "message": "<error details>"
@@ -50,9 +121,17 @@ def handle(req):
     Notes
     -----
     - The TOTP secret is generated using `pyotp.random_base32()`
-    - The Base64-encoded secret is saved in the `mfa` field of the `users` table
-    - The QR code is saved locally as a PNG file at `QR_DIR/<username>_2fa.png`
+    - The Base64-encoded secret is saved in the `mfa` field of the `users` table; the user must
+      exist (see generate-password or onboard-user)
+    - The rotation is published to `credential_changes` so authenticate-user drops its cached copy
+    - The QR code is rendered once by `common.qr` (PNG by default, SVG with `QR_FORMAT=svg`)
+      and returned from the same bytes that are handed to the background artifact writer
+      as `<username>_2fa.<png|svg>` (see `common.artifacts`)
     - The QR code can be scanned by authenticator apps like Google Authenticator
+    - With an idempotency key, a retry of a successful request within `IDEMPOTENCY_TTL` gets the
+      same QR code back, with an `Idempotent-Replayed: true` header, instead of a new secret
+      overwriting the one the client already holds; concurrent duplicates share a single
+      execution (see `common.idempotency`). A key reused with another body is refused with a 422.
     """
     if os.environ.get("REQUEST_METHOD") == "OPTIONS":
         return add_cors_headers(make_response("", 204))
@@ -67,45 +146,86 @@ def handle(req):
             }), 400)
             return add_cors_headers(resp)
 
-        secret = pyotp.random_base32()
-        totp = pyotp.TOTP(secret, digits=6)
-        # code_2fa = totp.now()
-
-        uri = totp.provisioning_uri(name=username, issuer_name="Cofrap")
-        img = qrcode.make(uri)
-        qr_path = f"{QR_DIR}/{username}_2fa.png"
-        img.save(qr_path)
-
-        encoded_secret = base64.b64encode(secret.encode()).decode()
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        qr_b64 = base64.b64encode(buf.getvalue()).decode()
-
-        conn = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASSWORD'],
-            database=os.environ['DB_NAME']
-        )
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    UPDATE users
-                       SET mfa = %s
-                     WHERE username = %s
-                """, (encoded_secret, username))
-            conn.commit()
-
-        resp_body = {
-            "code_mfa": qr_b64,
-            "status": "ok"
-        }
-        resp = make_response(json.dumps(resp_body), 200)
+        key = idempotency.request_key(payload, request.headers if has_request_context() else {})
+        (body, status), replayed = idempotency.call("generate-2fa", key, payload, lambda: provision(username))
+        resp = make_response(body, status)
+        if replayed:
+            resp.headers[idempotency.REPLAYED_HEADER] = "true"
         return add_cors_headers(resp)
 
+    except idempotency.IdempotencyError as e:
+        return add_cors_headers(make_response(json.dumps({"status": "error", "message": str(e)}), e.status))
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return add_cors_headers(make_response(json.dumps({"status": status, "message": message}), code, headers))
     except Exception as e:
         resp = make_response(json.dumps({
             "status": "error",
             "message": str(e)
         }), 500)
         return add_cors_headers(resp)
+
+
+# -------------------- ASYNCIO VARIANT --------------------
+#
+# Same flow on a non-blocking MySQL client (`common.aiopool`); the QR code
+# is rendered in the default executor so it does not stall the event loop.
+
+
+async def provision_async(username):
+    """Same as `provision`, on the asyncio pool."""
+    secret, uri = new_secret(username)
+    rendered = await asyncio.to_thread(qr.get_renderer().render, uri)
+
+    encoded_secret = base64.b64encode(secret.encode()).decode()
+    async with aiopool.connection((username,)) as conn:
+        with metrics.phase("db_write"):
+            await conn.begin()
+            async with conn.cursor() as cur:
+                if not await cur.execute(UPDATE_MFA_SQL, (encoded_secret, username)):
+                    await conn.rollback()
+                    return USER_NOT_FOUND
+                await credcache.publish_invalidations_async(cur, [username])
+            await conn.commit()
+
+    artifacts.get_writer().submit(f"{username}_2fa.{rendered.extension}", rendered.data)
+
+    resp_body = {
+        "code_mfa": rendered.base64(),
+        "qr_mimetype": rendered.mimetype,
+        "status": "ok"
+    }
+    return json.dumps(resp_body), 200
+
+
+@metrics.instrumented("generate-2fa")
+async def handle_async(req, method="POST", query=None, headers=None):
+    """
+    Asyncio entry point, with the same request and response bodies as `handle`.
+
+    Served through `app` by an ASGI server (see `common.asgi`). Returns a
+    `(body, status, headers)` tuple.
+    """
+    if method == "OPTIONS":
+        return "", 204, CORS_HEADERS
+
+    try:
+        payload = json.loads(req)
+        username = payload.get("username") or ""
+        if not username:
+            return json.dumps({"status": "error", "message": "username is required"}), 400, CORS_HEADERS
+
+        key = idempotency.request_key(payload, headers or {})
+        (body, status), replayed = await idempotency.call_async("generate-2fa", key, payload, lambda: provision_async(username))
+        return body, status, {**CORS_HEADERS, idempotency.REPLAYED_HEADER: "true"} if replayed else CORS_HEADERS
+
+    except idempotency.IdempotencyError as e:
+        return json.dumps({"status": "error", "message": str(e)}), e.status, CORS_HEADERS
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"status": status, "message": message}), code, {**CORS_HEADERS, **headers}
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)}), 500, CORS_HEADERS
+
+
+app = asgi.app_for(handle_async)
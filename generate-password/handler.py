@@ -1,33 +1,246 @@
 import os
+import asyncio
 import json
-import random
-import string
-import base64
-import pymysql
-import qrcode
-import io
-from flask import request, make_response
+import time
+from flask import has_request_context, request, make_response
 
-QR_DIR = "/home/app/qrcodes"
-os.makedirs(QR_DIR, exist_ok=True)
+try:
+    from .common import aiopool, artifacts, asgi, breaker, credcache, deadline, hashing, idempotency, metrics, passwords, pool, qr, warmup
+except ImportError:
+    from common import aiopool, artifacts, asgi, breaker, credcache, deadline, hashing, idempotency, metrics, passwords, pool, qr, warmup
 
+# Hashing dominates a bulk request: about n / HASH_WORKERS x PASSWORD_HASH_TARGET_MS,
+# so 4 workers at 50 ms hash ~800 passwords in the default 10 s REQUEST_DEADLINE.
+# The default leaves room for QR rendering and the write; scale it with the deadline.
+BULK_MAX_SIZE = int(os.environ.get("GENERATE_PASSWORD_BULK_MAX_SIZE", 500))
 
-def generate_strong_password(length=24):
-    chars = string.ascii_letters + string.digits + string.punctuation
-    return ''.join(random.SystemRandom().choice(chars) for _ in range(length))
+# Passwords hashed between two deadline checks
+HASH_BATCH_SIZE = 64
+
+# Every value is a placeholder so that pymysql's executemany() folds the
+# rows into one multi-row INSERT statement
+UPSERT_USER_SQL = """
+    INSERT INTO users
+        (username, password, mfa, gendate, expired)
+    VALUES
+        (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        password = VALUES(password),
+        gendate = VALUES(gendate),
+        expired = 0
+"""
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, Idempotency-Key",
+    "Access-Control-Max-Age": "3600",
+}
+
+
+def generate_strong_password(length=None):
+    """
+    Generate one password with the worker's policy (see `common.passwords`).
+
+    Parameters
+    ----------
+    length : int, optional
+        Overrides the policy length (`PASSWORD_LENGTH`, default 24).
+    """
+    generator = passwords.get_generator()
+    if length is not None and length != generator.policy.length:
+        policy = generator.policy
+        generator = passwords.PasswordGenerator(passwords.PasswordPolicy(
+            length=length, classes=policy.classes, required=policy.required,
+            exclude_ambiguous=policy.exclude_ambiguous
+        ))
+    return generator.generate(1)[0]
+
+
+def generate_passwords(count):
+    """Generate `count` passwords in one draw from the worker's generator."""
+    with metrics.phase("password_generation"):
+        return passwords.get_generator().generate(count)
+
+
+def upsert_rows(credentials):
+    gendate = int(time.time())
+    return [(username, password_hash, '', gendate, 0) for username, password_hash in credentials]
+
+
+def store_passwords(credentials):
+    """
+    Create or update users with new password hashes in one transaction.
+
+    Relies on the UNIQUE key on `username` (migration 001): existing users get
+    their password, `gendate` and `expired` flag reset and keep their MFA
+    secret, new users are created with an empty one. With `DB_SHARDS`, there
+    is one transaction per shard, committed one after the other.
+
+    Parameters
+    ----------
+    credentials : list of tuple
+        `(username, password_hash)` pairs with distinct usernames, hashed by
+        `hash_credentials`.
+    """
+    rows = {row[0]: row for row in upsert_rows(credentials)}
+    for group in pool.group(rows).values():
+        with pool.connection(group) as conn, metrics.phase("db_write"):
+            conn.begin()
+            with conn.cursor() as cursor:
+                cursor.executemany(UPSERT_USER_SQL, [rows[username] for username in group])
+                credcache.publish_invalidations(cursor, group)
+            conn.commit()
+
+
+def bulk_error(usernames):
+    """Return the error message of an invalid bulk request, or None."""
+    if (not isinstance(usernames, list) or not usernames
+            or not all(isinstance(u, str) and u for u in usernames)):
+        return "usernames must be a non-empty list of usernames"
+    if len(set(usernames)) > BULK_MAX_SIZE:
+        return f"bulk generation is limited to {BULK_MAX_SIZE} usernames"
+    return None
+
+
+def check_hash_budget(last_batch):
+    left = deadline.remaining()
+    if left is not None and left <= last_batch:
+        raise deadline.DeadlineExceeded("deadline exceeded before hashing the remaining passwords")
+
+
+def hash_credentials(usernames, raw_passwords):
+    """
+    Pair every user with the `common.hashing` hash of their new password.
+
+    Passwords are hashed in parallel by the hashing pool: a bulk request of
+    `n` users costs about `n / HASH_WORKERS` times `PASSWORD_HASH_TARGET_MS`.
+    They go by batches of `HASH_BATCH_SIZE`, and hashing stops as soon as
+    the request deadline leaves less time than the last batch took, rather
+    than burn the CPU for an answer the gateway no longer waits for.
+
+    Raises
+    ------
+    deadline.DeadlineExceeded
+        If the remaining passwords cannot be hashed in time.
+    """
+    hashes = []
+    last_batch = 0.0
+    for start in range(0, len(raw_passwords), HASH_BATCH_SIZE):
+        check_hash_budget(last_batch)
+        batch_start = time.perf_counter()
+        hashes += hashing.hash_passwords(raw_passwords[start:start + HASH_BATCH_SIZE])
+        last_batch = time.perf_counter() - batch_start
+    return list(zip(usernames, hashes))
+
+
+async def hash_credentials_async(usernames, raw_passwords):
+    """Same as `hash_credentials`, awaiting the hashing pool."""
+    hashes = []
+    last_batch = 0.0
+    for start in range(0, len(raw_passwords), HASH_BATCH_SIZE):
+        check_hash_budget(last_batch)
+        batch_start = time.perf_counter()
+        hashes += await hashing.hash_passwords_async(raw_passwords[start:start + HASH_BATCH_SIZE])
+        last_batch = time.perf_counter() - batch_start
+    return list(zip(usernames, hashes))
+
+
+def render_qr_codes(usernames, raw_passwords):
+    """
+    Render the password QR code of every user and queue it for persistence.
+
+    Returns
+    -------
+    list of dict
+        `{"username": ..., "qr_code_base64": ...}` in the order of `usernames`.
+    """
+    renderer = qr.get_renderer()
+    writer = artifacts.get_writer()
+    results = []
+    for username, raw_pass in zip(usernames, raw_passwords):
+        rendered = renderer.render(raw_pass)
+        writer.submit(f"{username}_pwd_qr.{rendered.extension}", rendered.data)
+        results.append({
+            "username": username,
+            "qr_code_base64": rendered.base64()
+        })
+    return results
+
+
+def handle_bulk(usernames):
+    """
+    Generate passwords for a list of users and store them with a single upsert.
+
+    Parameters
+    ----------
+    usernames : list of str
+        Users to create or update; duplicates are ignored.
+
+    Returns
+    -------
+    tuple
+        `(body, status)`: `{"status": "ok", "results": [{"username": ..., "qr_code_base64": ...}, ...]}`
+        in the order of first appearance, or a 400 error for an invalid list.
+    """
+    error = bulk_error(usernames)
+    if error:
+        return json.dumps({"status": "error", "message": error}), 400
+    usernames = list(dict.fromkeys(usernames))
+
+    raw_passwords = generate_passwords(len(usernames))
+    store_passwords(hash_credentials(usernames, raw_passwords))
+
+    results = render_qr_codes(usernames, raw_passwords)
+    return json.dumps({"status": "ok", "results": results}), 200
+
+
+def provision(data):
+    """
+    Generate, store and render the new password(s) of a request.
+
+    Runs once per idempotency key (see `handle`).
+
+    Returns
+    -------
+    tuple
+        `(body, status)` of the response.
+    """
+    if "usernames" in data:
+        return handle_bulk(data["usernames"])
+
+    username = data.get("username") or ""
+    if not username:
+        return json.dumps({"status": "error", "message": "username is required"}), 400
+
+    with metrics.phase("password_generation"):
+        raw_pass = generate_strong_password()
+
+    rendered = qr.get_renderer().render(raw_pass)
+
+    store_passwords(hash_credentials([username], [raw_pass]))
+    # Only once committed: no artifact for a password that was never stored
+    artifacts.get_writer().submit(f"{username}_pwd_qr.{rendered.extension}", rendered.data)
+
+    payload = {
+        "status": "ok",
+        "qr_code_base64": rendered.base64(),
+        "qr_mimetype": rendered.mimetype
+    }
+    return json.dumps(payload), 200
 
 
 def add_cors_headers(response):
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    response.headers["Access-Control-Max-Age"] = "3600"
+    for name, value in CORS_HEADERS.items():
+        response.headers[name] = value
     return response
 
 
+@warmup.hook("db", "hashing", "qr")
+@metrics.instrumented("generate-password")
 def handle(req):
     """
-    Generate a strong password for a user, store it in the database (encoded),
+    Generate a strong password for a user, store its salted scrypt hash in the database,
     and return a QR code representing the password in base64 format.
 
     This function handles CORS preflight requests and JSON POST requests with a `username`.
@@ -38,6 +251,10 @@ def handle(req):
     req : str
         A JSON-formatted string with the field:
         - `username` (str): the username for which to generate or update a password.
+        or, for bulk provisioning:
+        - `usernames` (list of str): up to `GENERATE_PASSWORD_BULK_MAX_SIZE` (default 500)
+          usernames, written with a single `INSERT ... ON DUPLICATE KEY UPDATE` (see `handle_bulk`).
+        An `Idempotency-Key` header (or `idempotency_key` field) makes retries safe, see Notes.
 
     Returns
     -------
@@ -45,7 +262,8 @@ def handle(req):
         If successful:
         {
             "status": "ok",
-            "qr_code_base64": "<base64-encoded QR code PNG for the password>"
+            "qr_code_base64": "<base64-encoded QR code PNG for the password>",
+            "qr_mimetype": "image/png"
         }
 
         If error:
@@ -57,9 +275,17 @@ def handle(req):
     Notes
     -----
     - A strong password is randomly generated using letters, digits, and punctuation.
-    - The password is encoded in Base64 and stored in the `password` field of the `users` table.
-    - The QR code is saved to `QR_DIR/<username>_pwd_qr.png` and returned as a base64 string.
-    - The function supports updating an existing user or creating a new one.
+    - The password is hashed with salted scrypt (`common.hashing`) and stored in the `password`
+      field of the `users` table as `$scrypt$ln=..,r=..,p=..$<salt>$<digest>`; the plaintext
+      only leaves the function inside the QR code.
+    - The rotation is published to `credential_changes` so authenticate-user drops its cached copy.
+    - The QR code is rendered once by `common.qr` and returned as a base64 string; the same bytes
+      are persisted off the request path as `<username>_pwd_qr.<png|svg>` by `common.artifacts`.
+    - The function supports updating an existing user or creating a new one, in a single upsert.
+    - With an idempotency key, a retry of a successful request within `IDEMPOTENCY_TTL` gets the
+      same response back, with an `Idempotent-Replayed: true` header, and nothing is generated,
+      rendered or written again; concurrent duplicates share a single execution
+      (see `common.idempotency`). A key reused with another body is refused with a 422.
     """
     # Handle CORS preflight
     if request.method == "OPTIONS":
@@ -67,59 +293,18 @@ def handle(req):
 
     try:
         data = json.loads(req)
-        username = data.get("username") or ""
-        if not username:
-            return add_cors_headers(
-                make_response(json.dumps({
-                    "status": "error",
-                    "message": "username is required"
-                }), 400)
-            )
-
-        conn = pymysql.connect(host=os.environ['DB_HOST'], user=os.environ['DB_USER'], password=os.environ['DB_PASSWORD'], database=os.environ['DB_NAME'])
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT 1 FROM users WHERE username = %s", (username,))
-        exists = cursor.fetchone() is not None
-
-        raw_pass = generate_strong_password()
-        encoded_pass = base64.b64encode(raw_pass.encode()).decode()
-
-        img = qrcode.make(raw_pass)
-        qr_path = f"{QR_DIR}/{username}_pwd_qr.png"
-        img.save(qr_path)
-
-        if exists:
-            cursor.execute("""
-                UPDATE users
-                   SET password = %s,
-                       gendate = UNIX_TIMESTAMP(),
-                       expired = 0
-                 WHERE username = %s
-            """, (encoded_pass, username))
-
-        else:
-            cursor.execute("""
-                INSERT INTO users
-                    (username, password, mfa, gendate, expired)
-                VALUES
-                    (%s, %s, '', UNIX_TIMESTAMP(), 0)
-            """, (username, encoded_pass))
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        qr_b64 = base64.b64encode(buf.getvalue()).decode()
-        payload = {
-            "status": "ok",
-            "qr_code_base64": qr_b64
-        }
-        resp = make_response(json.dumps(payload), 200)
+        key = idempotency.request_key(data, request.headers if has_request_context() else {})
+        (body, status), replayed = idempotency.call("generate-password", key, data, lambda: provision(data))
+        resp = make_response(body, status)
+        if replayed:
+            resp.headers[idempotency.REPLAYED_HEADER] = "true"
         return add_cors_headers(resp)
 
+    except idempotency.IdempotencyError as e:
+        return add_cors_headers(make_response(json.dumps({"status": "error", "message": str(e)}), e.status))
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return add_cors_headers(make_response(json.dumps({"status": status, "message": message}), code, headers))
     except Exception as e:
         return add_cors_headers(
             make_response(json.dumps({
@@ -127,3 +312,83 @@ def handle(req):
                 "message": str(e)
             }), 500)
         )
+
+
+# -------------------- ASYNCIO VARIANT --------------------
+#
+# Same flow on a non-blocking MySQL client (`common.aiopool`). QR rendering
+# and bulk password generation are CPU-bound and run in the default executor
+# (`asyncio.to_thread`) so they do not stall the other requests of the loop;
+# password hashes are awaited from the `common.hashing` pool.
+
+
+async def store_passwords_async(credentials):
+    """Same as `store_passwords`, on the asyncio pool."""
+    rows = {row[0]: row for row in upsert_rows(credentials)}
+    for group in pool.group(rows).values():
+        async with aiopool.connection(group) as conn:
+            with metrics.phase("db_write"):
+                await conn.begin()
+                async with conn.cursor() as cursor:
+                    await cursor.executemany(UPSERT_USER_SQL, [rows[username] for username in group])
+                    await credcache.publish_invalidations_async(cursor, group)
+                await conn.commit()
+
+
+async def provision_async(data):
+    """Same as `provision`, on the asyncio pool."""
+    if "usernames" in data:
+        error = bulk_error(data["usernames"])
+        if error:
+            return json.dumps({"status": "error", "message": error}), 400
+        usernames = list(dict.fromkeys(data["usernames"]))
+        raw_passwords = await asyncio.to_thread(generate_passwords, len(usernames))
+        await store_passwords_async(await hash_credentials_async(usernames, raw_passwords))
+        results = await asyncio.to_thread(render_qr_codes, usernames, raw_passwords)
+        return json.dumps({"status": "ok", "results": results}), 200
+
+    username = data.get("username") or ""
+    if not username:
+        return json.dumps({"status": "error", "message": "username is required"}), 400
+
+    raw_pass = generate_passwords(1)[0]
+    rendered = await asyncio.to_thread(qr.get_renderer().render, raw_pass)
+
+    await store_passwords_async(await hash_credentials_async([username], [raw_pass]))
+    artifacts.get_writer().submit(f"{username}_pwd_qr.{rendered.extension}", rendered.data)
+
+    payload = {
+        "status": "ok",
+        "qr_code_base64": rendered.base64(),
+        "qr_mimetype": rendered.mimetype
+    }
+    return json.dumps(payload), 200
+
+
+@metrics.instrumented("generate-password")
+async def handle_async(req, method="POST", query=None, headers=None):
+    """
+    Asyncio entry point, with the same request and response bodies as `handle`.
+
+    Served through `app` by an ASGI server (see `common.asgi`). Returns a
+    `(body, status, headers)` tuple.
+    """
+    if method == "OPTIONS":
+        return "", 204, CORS_HEADERS
+
+    try:
+        data = json.loads(req)
+        key = idempotency.request_key(data, headers or {})
+        (body, status), replayed = await idempotency.call_async("generate-password", key, data, lambda: provision_async(data))
+        return body, status, {**CORS_HEADERS, idempotency.REPLAYED_HEADER: "true"} if replayed else CORS_HEADERS
+
+    except idempotency.IdempotencyError as e:
+        return json.dumps({"status": "error", "message": str(e)}), e.status, CORS_HEADERS
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"status": status, "message": message}), code, {**CORS_HEADERS, **headers}
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)}), 500, CORS_HEADERS
+
+
+app = asgi.app_for(handle_async)
@@ -1,20 +1,330 @@
-import pymysql
-import json
 import os
+import heapq
+import itertools
+import json
+import threading
+from flask import Response, has_request_context, request
 
-def handle(req):
+try:
+    from .common import aiopool, asgi, breaker, lazy, metrics, pool, versions, warmup
+except ImportError:
+    from common import aiopool, asgi, breaker, lazy, metrics, pool, versions, warmup
+
+pymysql = lazy.module("pymysql")
+aiomysql = lazy.module("aiomysql")
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("GET_USERS_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("GET_USERS_MAX_PAGE_SIZE", 1000))
+STREAM_BATCH_SIZE = 500
+
+# Columns of the public listing; those added by migrations for internal use
+# (`expires_at`) stay out of the response schema
+USER_COLUMNS = "id, username, password, mfa, gendate, expired"
+PAGE_SQL = f"SELECT {USER_COLUMNS} FROM users WHERE id > %s ORDER BY id LIMIT %s"
+LIST_SQL = f"SELECT {USER_COLUMNS} FROM users"
+STREAM_SQL = f"SELECT {USER_COLUMNS} FROM users ORDER BY id"
+
+STREAM_MIMETYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def compact_json(value):
+    return json.dumps(value, separators=(",", ":"), default=str)
+
+
+# `(etag, body)` of the last full listing served by this replica
+_listing = None
+_listing_lock = threading.Lock()
+
+
+def keyed_rows(parts):
+    """
+    Merge the rows read on each partition (see `pool.partitions`) in `(id, shard name)` order.
+
+    Every shard numbers its users on its own: ids are only unique per shard.
+
+    Returns
+    -------
+    list of tuple
+        `(id, shard name, row)` triples.
+    """
+    if len(parts) == 1:
+        (name, rows), = parts.items()
+        return [(row["id"], name, row) for row in rows]
+    return sorted(((row["id"], name, row) for name, rows in parts.items() for row in rows), key=lambda item: item[:2])
+
+
+def merge_rows(parts):
+    """Return the rows read on each partition as one list; a single partition's are kept in their order."""
+    if len(parts) == 1:
+        return next(iter(parts.values()))
+    return [row for _, _, row in keyed_rows(parts)]
+
+
+def read_rows(connection):
+    with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        cursor.execute(LIST_SQL)
+        return cursor.fetchall()
+
+
+def serialize(rows):
+    with metrics.phase("json_serialize"):
+        return json.dumps(rows, indent=2)
+
+
+def list_users(connection=None):
+    """Read the whole `users` table and serialize it, on `connection` or on a read connection of every shard."""
+    with metrics.phase("db_query"):
+        if connection is None:
+            rows = merge_rows(pool.scatter(lambda _, connection: read_rows(connection)))
+        else:
+            rows = read_rows(connection)
+    return serialize(rows)
+
+
+def read_version(connection):
+    with metrics.phase("db_version"):
+        with connection.cursor() as cursor:
+            return versions.read(cursor)
+
+
+def read_snapshot(_, connection):
+    # The version is read before the rows: a write landing in between is
+    # served under the older tag, never the reverse
+    etag = read_version(connection)
+    with metrics.phase("db_query"):
+        return etag, read_rows(connection)
+
+
+def read_listing():
+    """
+    Return `(etag, body)` of the listing, read on a single connection per shard.
+
+    On a read replica the version and the rows must come from the same
+    server to describe the same state of the table. With `DB_SHARDS` the tag
+    combines the versions of every shard (see `versions.combine`).
     """
-    Retrieves all user entries from the `users` table in the MariaDB database.
+    snapshots = pool.scatter(read_snapshot)
+    etag = versions.combine(tag for tag, _ in snapshots.values())
+    return etag, serialize(merge_rows({name: rows for name, (_, rows) in snapshots.items()}))
+
+
+def conditional_listing(if_none_match):
+    """
+    Return the full listing unless the client's copy is still current.
+
+    The version of the `users` table (`common.versions`, bumped by every
+    write path) is read first, with one primary-key lookup. A matching
+    `If-None-Match` needs nothing more; otherwise the body serialized for
+    that version is reused, and the table is only read again after a write.
+    Concurrent misses wait for a single rebuild. Reads go to the replicas
+    when `DB_READ_HOSTS` is set: a replica lagging behind the listing
+    already built is answered with that newer listing.
 
-    This function connects to the database using credentials provided in environment variables.
-    It fetches all rows from the `users` table and returns them as a JSON-formatted string.
-    It uses `DictCursor` to ensure that each row is returned as a dictionary.
+    Parameters
+    ----------
+    if_none_match : str or None
+        The request's `If-None-Match` header.
 
     Returns
     -------
+    tuple
+        `(etag, body)`: `body` is None when the client's copy is current.
+        `etag` is None, and the table read every time, if migration 005 is
+        not applied.
+    """
+    global _listing
+    etag = versions.combine(pool.scatter(lambda _, connection: read_version(connection)).values())
+    if etag is None:
+        return None, list_users()
+    cached = _listing
+    if cached is not None and not versions.is_newer(etag, cached[0]):
+        etag = cached[0]
+    if versions.if_none_match(if_none_match, etag):
+        return etag, None
+    if cached is None or cached[0] != etag:
+        with _listing_lock:
+            cached = _listing
+            if cached is None or versions.is_newer(etag, cached[0]):
+                cached = _listing = read_listing()
+    return cached
+
+
+def listing_headers(etag):
+    # `no-cache`: intermediaries may store the listing but must revalidate it
+    return {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
+
+
+def reset_listing():
+    global _listing
+    with _listing_lock:
+        _listing = None
+
+
+def page_start(name, after_id, after_shard):
+    """Return the `id` a partition's page starts after, for the `(after_id, after_shard)` cursor."""
+    if name is not None and after_shard is not None and name > after_shard:
+        # Shards sorting after the cursor's still hold their row of `after_id`
+        return after_id - 1
+    return after_id
+
+
+def fetch_page(after_id, limit, after_shard=None):
+    """
+    Fetch one page of users ordered by `id` (keyset pagination).
+
+    With `DB_SHARDS`, every shard is asked for a page at once and the rows
+    are merged in `(id, shard name)` order, ids being only unique per shard.
+
+    Parameters
+    ----------
+    after_id : int
+        Cursor: only users with an `id` strictly greater are returned.
+    limit : int
+        Maximum number of users in the page.
+    after_shard : str, optional
+        Shard of the cursor's row; with it, rows of that `id` on the shards
+        sorting after it are returned too.
+
+    Returns
+    -------
+    dict
+        `{"users": [...], "next_cursor": <int, str or None>}`; `next_cursor`
+        is the value to pass as `after` for the following page, or None on the
+        last one. With `DB_SHARDS` it is an `"<id>:<shard>"` string.
+    """
+    def read_page(name, connection):
+        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(PAGE_SQL, (page_start(name, after_id, after_shard), limit + 1))
+            return cursor.fetchall()
+
+    with metrics.phase("db_query"):
+        parts = pool.scatter(read_page)
+    return make_page(parts, limit)
+
+
+def make_page(parts, limit):
+    """Build the page of a `limit + 1` rows fetch per partition: an extra row tells if another page follows."""
+    merged = keyed_rows(parts)
+    has_more = len(merged) > limit
+    merged = merged[:limit]
+    if not has_more:
+        next_cursor = None
+    else:
+        last_id, name, _ = merged[-1]
+        next_cursor = last_id if name is None else f"{last_id}:{name}"
+    return {"users": [row for _, _, row in merged], "next_cursor": next_cursor}
+
+
+def page_args(args):
+    """Return the `(after_id, limit, after_shard)` cursor and clamped page size of a paginated request."""
+    limit = min(max(int(args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    after_id, _, after_shard = str(args.get("after", 0)).partition(":")
+    return int(after_id), limit, after_shard or None
+
+
+def partition_rows(name, factory):
+    """Yield the `(id, shard name, row)` triples of one partition in `id` order, through a server-side cursor."""
+    with factory() as connection:
+        with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+            cursor.execute(STREAM_SQL)
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row["id"], name, row
+
+
+def stream_batches(parts):
+    """Yield the rows of every partition by batches of `STREAM_BATCH_SIZE`, merged in `(id, shard name)` order."""
+    if len(parts) == 1:
+        with next(iter(parts.values()))() as connection:
+            with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+                cursor.execute(STREAM_SQL)
+                while True:
+                    rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                    if not rows:
+                        break
+                    yield rows
+        return
+    # `(id, shard name)` is unique: the rows themselves are never compared
+    merged = heapq.merge(*(partition_rows(name, factory) for name, factory in parts.items()))
+    rows = (row for _, _, row in merged)
+    while batch := list(itertools.islice(rows, STREAM_BATCH_SIZE)):
+        yield batch
+
+
+def stream_users(fmt):
+    """
+    Yield the whole `users` table as JSON text without buffering it.
+
+    Rows are read through an unbuffered server-side cursor in batches of
+    `STREAM_BATCH_SIZE`, so memory stays flat whatever the table size. With
+    `DB_SHARDS`, one cursor per shard is open and their rows are merged.
+
+    Parameters
+    ----------
+    fmt : str
+        `"json"` for a single compact JSON array, `"ndjson"` for one JSON
+        object per line.
+
+    Yields
+    ------
     str
-        A JSON-formatted string representing a list of users with all their fields.
+        Consecutive chunks of the response body.
+    """
+    ndjson = fmt == "ndjson"
+    first = True
+    if not ndjson:
+        yield "["
+    for rows in stream_batches(pool.partitions(read=True)):
+        yield encode_batch(rows, ndjson, first)
+        first = False
+    if not ndjson:
+        yield "]"
+
+
+def encode_batch(rows, ndjson, first):
+    if ndjson:
+        return "".join(compact_json(row) + "\n" for row in rows)
+    chunk = ",".join(compact_json(row) for row in rows)
+    return chunk if first else "," + chunk
+
+
+@warmup.hook("db")
+@metrics.instrumented("get-users")
+def handle(req):
+    """
+    Retrieves user entries from the `users` table in the MariaDB database.
+
+    This function borrows a connection from the worker's shared pool, configured from environment variables.
+    Without query parameters it fetches all rows from the `users` table and returns them as a JSON-formatted string.
+    It uses `DictCursor` to ensure that each row is returned as a dictionary. Over HTTP that listing
+    carries an `ETag` derived from the table version: a request whose `If-None-Match` matches gets
+    an empty `304 Not Modified`, and the serialized body is cached until the next write.
+
+    Query parameters
+    ----------------
+    limit : int, optional
+        Enables keyset pagination and sets the page size (capped at `GET_USERS_MAX_PAGE_SIZE`).
+    after : int or str, optional
+        Pagination cursor: the `next_cursor` returned by the previous page (defaults to 0);
+        an `"<id>:<shard>"` string when the table is sharded (`DB_SHARDS`).
+    stream : {"json", "ndjson"}, optional
+        Streams the whole table through a server-side cursor, as a compact JSON array
+        or as newline-delimited JSON, without loading it in memory.
+
+    Returns
+    -------
+    str or flask.Response
+        A JSON-formatted string representing a list of users with all their fields, or
+        `{"users": [...], "next_cursor": ...}` in paginated mode, or a streamed response.
         If an error occurs (e.g., connection failure, SQL error), a JSON object with an "error" message is returned.
+        While the database circuit breaker is open, or past the request deadline, the error
+        comes as a `(body, 503 or 504, headers)` tuple.
 
     Notes
     -----
@@ -23,19 +333,206 @@ def handle(req):
     - This function is useful for debugging or admin purposes and should be secured in a real-world deployment.
     """
     try:
-        connection = pymysql.connect(
-            host=os.environ['DB_HOST'],
-            user=os.environ['DB_USER'],
-            password=os.environ['DB_PASSWORD'],
-            database=os.environ['DB_NAME'],
-            cursorclass=pymysql.cursors.DictCursor
-        )
-
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT * FROM users")
-                rows = cursor.fetchall()
-                return json.dumps(rows, indent=2)
+        args = request.args if has_request_context() else {}
+
+        fmt = args.get("stream")
+        if fmt:
+            if fmt not in STREAM_MIMETYPES:
+                return json.dumps({"error": f"unsupported stream format: {fmt}"})
+            return Response(stream_users(fmt), mimetype=STREAM_MIMETYPES[fmt])
+
+        if "limit" in args or "after" in args:
+            after_id, limit, after_shard = page_args(args)
+            page = fetch_page(after_id, limit, after_shard)
+            with metrics.phase("json_serialize"):
+                return compact_json(page)
+
+        if not has_request_context():
+            return list_users()
+        etag, body = conditional_listing(request.headers.get("If-None-Match"))
+        if body is None:
+            return Response(status=304, headers=listing_headers(etag))
+        return Response(body, mimetype="application/json", headers=listing_headers(etag))
+
+    except breaker.UNAVAILABLE_ERRORS as e:
+        _, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"error": message}), code, headers
+    except Exception as e:
+        return json.dumps({ "error": str(e) })
+
+
+# -------------------- ASYNCIO VARIANT --------------------
+#
+# Same queries on a non-blocking MySQL client (`common.aiopool`).
+
+
+async def fetch_page_async(after_id, limit, after_shard=None):
+    """Same as `fetch_page`, on the asyncio pools."""
+    async def read_page(name, connection):
+        async with connection.cursor(aiomysql.DictCursor) as cursor:
+            await cursor.execute(PAGE_SQL, (page_start(name, after_id, after_shard), limit + 1))
+            return await cursor.fetchall()
+
+    with metrics.phase("db_query"):
+        parts = await aiopool.scatter(read_page)
+    return make_page(parts, limit)
+
+
+async def read_rows_async(connection):
+    async with connection.cursor(aiomysql.DictCursor) as cursor:
+        await cursor.execute(LIST_SQL)
+        return await cursor.fetchall()
+
+
+async def list_users_async(connection=None):
+    """Same as `list_users`, on the asyncio pools."""
+    with metrics.phase("db_query"):
+        if connection is None:
+            rows = merge_rows(await aiopool.scatter(lambda _, connection: read_rows_async(connection)))
+        else:
+            rows = await read_rows_async(connection)
+    return serialize(rows)
+
+
+async def read_version_async(connection):
+    with metrics.phase("db_version"):
+        async with connection.cursor() as cursor:
+            return await versions.read_async(cursor)
+
+
+async def read_snapshot_async(_, connection):
+    etag = await read_version_async(connection)
+    with metrics.phase("db_query"):
+        return etag, await read_rows_async(connection)
+
+
+async def read_listing_async():
+    """Same as `read_listing`, on the asyncio pools."""
+    snapshots = await aiopool.scatter(read_snapshot_async)
+    etag = versions.combine(tag for tag, _ in snapshots.values())
+    return etag, serialize(merge_rows({name: rows for name, (_, rows) in snapshots.items()}))
+
+
+async def conditional_listing_async(if_none_match):
+    """Same as `conditional_listing`, on the asyncio pools; concurrent misses may rebuild in parallel."""
+    global _listing
+    etag = versions.combine((await aiopool.scatter(lambda _, connection: read_version_async(connection))).values())
+    if etag is None:
+        return None, await list_users_async()
+    cached = _listing
+    if cached is not None and not versions.is_newer(etag, cached[0]):
+        etag = cached[0]
+    if versions.if_none_match(if_none_match, etag):
+        return etag, None
+    if cached is None or cached[0] != etag:
+        cached = await read_listing_async()
+        if not versions.is_newer(_listing and _listing[0], cached[0]):
+            _listing = cached
+    return cached
+
+
+async def partition_rows_async(name, factory):
+    """Same as `partition_rows`, as an async generator."""
+    async with factory() as connection:
+        async with connection.cursor(aiomysql.SSDictCursor) as cursor:
+            await cursor.execute(STREAM_SQL)
+            while True:
+                rows = await cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row["id"], name, row
+
+
+async def merge_async(iterators):
+    """Merge async iterators of sorted `(id, shard name, row)` triples into one stream of rows, like `heapq.merge`."""
+    heap = []
+    try:
+        for index, iterator in enumerate(iterators):
+            item = await anext(iterator, None)
+            if item is not None:
+                heap.append((item[:2], index, item[2]))
+        heapq.heapify(heap)
+        while heap:
+            _, index, row = heap[0]
+            yield row
+            item = await anext(iterators[index], None)
+            if item is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (item[:2], index, item[2]))
+    finally:
+        for iterator in iterators:
+            await iterator.aclose()
+
+
+async def stream_batches_async(parts):
+    """Same as `stream_batches`, as an async generator."""
+    if len(parts) == 1:
+        async with next(iter(parts.values()))() as connection:
+            async with connection.cursor(aiomysql.SSDictCursor) as cursor:
+                await cursor.execute(STREAM_SQL)
+                while True:
+                    rows = await cursor.fetchmany(STREAM_BATCH_SIZE)
+                    if not rows:
+                        break
+                    yield rows
+        return
+    batch = []
+    async for row in merge_async([partition_rows_async(name, factory) for name, factory in parts.items()]):
+        batch.append(row)
+        if len(batch) == STREAM_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def stream_users_async(fmt):
+    """Same as `stream_users`, as an async generator over unbuffered cursors."""
+    ndjson = fmt == "ndjson"
+    first = True
+    if not ndjson:
+        yield "["
+    async for rows in stream_batches_async(aiopool.partitions(read=True)):
+        yield encode_batch(rows, ndjson, first)
+        first = False
+    if not ndjson:
+        yield "]"
+
+
+@metrics.instrumented("get-users")
+async def handle_async(req, method="GET", query=None, headers=None):
+    """
+    Asyncio entry point, with the same query parameters, bodies and conditional GET as `handle`.
+
+    Served through `app` by an ASGI server (see `common.asgi`). Returns a
+    `(body, status, headers)` tuple; streamed bodies are async generators.
+    """
+    try:
+        args = query or {}
+
+        fmt = args.get("stream")
+        if fmt:
+            if fmt not in STREAM_MIMETYPES:
+                return json.dumps({"error": f"unsupported stream format: {fmt}"})
+            return stream_users_async(fmt), 200, {"Content-Type": STREAM_MIMETYPES[fmt]}
+
+        if "limit" in args or "after" in args:
+            page = await fetch_page_async(*page_args(args))
+            with metrics.phase("json_serialize"):
+                return compact_json(page)
 
+        etag, body = await conditional_listing_async((headers or {}).get("if-none-match"))
+        if body is None:
+            return "", 304, listing_headers(etag)
+        return body, 200, listing_headers(etag)
+
+    except breaker.UNAVAILABLE_ERRORS as e:
+        _, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"error": message}), code, headers
     except Exception as e:
-        return json.dumps({ "error": str(e) })
\ No newline at end of file
+        return json.dumps({ "error": str(e) })
+
+
+app = asgi.app_for(handle_async)
@@ -0,0 +1,273 @@
+import os
+import asyncio
+import base64
+import contextvars
+import json
+import threading
+import time
+from concurrent import futures
+from flask import request, make_response
+
+try:
+    from .common import aiopool, artifacts, asgi, breaker, credcache, hashing, lazy, metrics, passwords, pool, qr, warmup
+except ImportError:
+    from common import aiopool, artifacts, asgi, breaker, credcache, hashing, lazy, metrics, passwords, pool, qr, warmup
+
+pyotp = lazy.module("pyotp")
+
+RENDER_THREADS = int(os.environ.get("ONBOARD_RENDER_THREADS", 2))
+
+# Password and MFA secret land in the same statement: the row never exists
+# with one of them missing
+ONBOARD_USER_SQL = """
+    INSERT INTO users
+        (username, password, mfa, gendate, expired)
+    VALUES
+        (%s, %s, %s, %s, 0)
+    ON DUPLICATE KEY UPDATE
+        password = VALUES(password),
+        mfa = VALUES(mfa),
+        gendate = VALUES(gendate),
+        expired = 0
+"""
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+    "Access-Control-Max-Age": "3600",
+}
+
+
+def add_cors_headers(response):
+    for name, value in CORS_HEADERS.items():
+        response.headers[name] = value
+    return response
+
+
+def new_credentials(username):
+    """
+    Draw a password and a TOTP secret for `username`.
+
+    Returns
+    -------
+    tuple
+        `(password, secret, uri)`, `uri` being the provisioning URI to encode
+        in the MFA QR code.
+    """
+    with metrics.phase("password_generation"):
+        raw_pass = passwords.get_generator().generate(1)[0]
+    secret = pyotp.random_base32()
+    uri = pyotp.TOTP(secret, digits=6).provisioning_uri(name=username, issuer_name="Cofrap")
+    return raw_pass, secret, uri
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the worker-wide thread pool the QR codes are rendered on (`ONBOARD_RENDER_THREADS`, default 2)."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = futures.ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix="onboard-qr")
+    return _executor
+
+
+def render_and_hash(raw_pass, uri):
+    """
+    Render both QR codes and hash the password, all three at once.
+
+    The QR codes are rendered on the executor, each in a copy of the request
+    context so that their phases are still timed, while this thread waits for
+    the hashing pool.
+
+    Returns
+    -------
+    tuple
+        `(password_hash, password_qr, mfa_qr)`, the QR codes as `RenderedQR`.
+    """
+    renderer = qr.get_renderer()
+    renders = [
+        get_executor().submit(contextvars.copy_context().run, renderer.render, content)
+        for content in (raw_pass, uri)
+    ]
+    try:
+        password_hash = hashing.hash_password(raw_pass)
+    finally:
+        futures.wait(renders)
+    password_qr, mfa_qr = (render.result() for render in renders)
+    return password_hash, password_qr, mfa_qr
+
+
+def store_onboarding(username, password_hash, encoded_secret):
+    """
+    Create or reset `username` with both credentials in one transaction.
+
+    Relies on the UNIQUE key on `username` (migration 001). The change is
+    published to `credential_changes` in the same transaction.
+    """
+    with pool.connection((username,)) as conn, metrics.phase("db_write"):
+        conn.begin()
+        with conn.cursor() as cursor:
+            cursor.execute(ONBOARD_USER_SQL, (username, password_hash, encoded_secret, int(time.time())))
+            credcache.publish_invalidation(cursor, username)
+        conn.commit()
+
+
+def persist_artifacts(username, password_qr, mfa_qr):
+    writer = artifacts.get_writer()
+    writer.submit(f"{username}_pwd_qr.{password_qr.extension}", password_qr.data)
+    writer.submit(f"{username}_2fa.{mfa_qr.extension}", mfa_qr.data)
+
+
+def onboarding_payload(password_qr, mfa_qr):
+    return {
+        "status": "ok",
+        "qr_code_base64": password_qr.base64(),
+        "code_mfa": mfa_qr.base64(),
+        "qr_mimetype": password_qr.mimetype
+    }
+
+
+@warmup.hook("db", "hashing", "qr", "totp")
+@metrics.instrumented("onboard-user")
+def handle(req):
+    """
+    Onboard a user in one call: a strong password and a TOTP secret, stored together.
+
+    Replaces the `generate-password` then `generate-2fa` sequence: one
+    invocation, one pooled connection and one transaction per user, and no
+    window in which the row exists with an empty MFA secret. The two QR codes
+    are rendered concurrently while the password is hashed.
+
+    Parameters
+    ----------
+    req : str
+        A JSON-formatted string with the field:
+        - `username` (str): the user to create, or whose credentials are both reset.
+
+    Returns
+    -------
+    JSON response
+        If successful:
+        {
+            "status": "ok",
+            "qr_code_base64": "<base64-encoded QR code of the password>",
+            "code_mfa": "<base64-encoded QR code of the TOTP provisioning URI>",
+            "qr_mimetype": "image/png"
+        }
+
+        If error:
+        {
+            "status": "error",
+            "message": "<error message>"
+        }
+        with a 400 status for a missing username, 500 otherwise; 503 or 504
+        with status `unavailable` or `timeout` while the database circuit
+        breaker is open or once the request deadline is spent.
+
+    Notes
+    -----
+    - The password is hashed with salted scrypt (`common.hashing`), the TOTP secret
+      stored Base64-encoded in `mfa`, as `generate-password` and `generate-2fa` do.
+    - Both QR codes are persisted off the request path, once the transaction committed,
+      as `<username>_pwd_qr.<png|svg>` and `<username>_2fa.<png|svg>` by `common.artifacts`.
+    """
+    # Handle CORS preflight
+    if request.method == "OPTIONS":
+        return add_cors_headers(make_response('', 204))
+
+    try:
+        data = json.loads(req)
+        username = data.get("username") or ""
+        if not username:
+            return add_cors_headers(
+                make_response(json.dumps({
+                    "status": "error",
+                    "message": "username is required"
+                }), 400)
+            )
+
+        raw_pass, secret, uri = new_credentials(username)
+        password_hash, password_qr, mfa_qr = render_and_hash(raw_pass, uri)
+        store_onboarding(username, password_hash, base64.b64encode(secret.encode()).decode())
+        persist_artifacts(username, password_qr, mfa_qr)
+
+        resp = make_response(json.dumps(onboarding_payload(password_qr, mfa_qr)), 200)
+        return add_cors_headers(resp)
+
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return add_cors_headers(make_response(json.dumps({"status": status, "message": message}), code, headers))
+    except Exception as e:
+        return add_cors_headers(
+            make_response(json.dumps({
+                "status": "error",
+                "message": str(e)
+            }), 500)
+        )
+
+
+# -------------------- ASYNCIO VARIANT --------------------
+#
+# Same flow on a non-blocking MySQL client (`common.aiopool`): both QR codes
+# render in the default executor while the password hash is awaited.
+
+
+async def render_and_hash_async(raw_pass, uri):
+    """Same as `render_and_hash`, on the default executor and awaiting the hashing pool."""
+    renderer = qr.get_renderer()
+    password_qr, mfa_qr, (password_hash,) = await asyncio.gather(
+        asyncio.to_thread(renderer.render, raw_pass),
+        asyncio.to_thread(renderer.render, uri),
+        hashing.hash_passwords_async([raw_pass]),
+    )
+    return password_hash, password_qr, mfa_qr
+
+
+async def store_onboarding_async(username, password_hash, encoded_secret):
+    """Same as `store_onboarding`, on the asyncio pool."""
+    async with aiopool.connection((username,)) as conn:
+        with metrics.phase("db_write"):
+            await conn.begin()
+            async with conn.cursor() as cursor:
+                await cursor.execute(ONBOARD_USER_SQL, (username, password_hash, encoded_secret, int(time.time())))
+                await credcache.publish_invalidations_async(cursor, [username])
+            await conn.commit()
+
+
+@metrics.instrumented("onboard-user")
+async def handle_async(req, method="POST", query=None, headers=None):
+    """
+    Asyncio entry point, with the same request and response bodies as `handle`.
+
+    Served through `app` by an ASGI server (see `common.asgi`). Returns a
+    `(body, status, headers)` tuple.
+    """
+    if method == "OPTIONS":
+        return "", 204, CORS_HEADERS
+
+    try:
+        data = json.loads(req)
+        username = data.get("username") or ""
+        if not username:
+            return json.dumps({"status": "error", "message": "username is required"}), 400, CORS_HEADERS
+
+        raw_pass, secret, uri = new_credentials(username)
+        password_hash, password_qr, mfa_qr = await render_and_hash_async(raw_pass, uri)
+        await store_onboarding_async(username, password_hash, base64.b64encode(secret.encode()).decode())
+        persist_artifacts(username, password_qr, mfa_qr)
+
+        return json.dumps(onboarding_payload(password_qr, mfa_qr)), 200, CORS_HEADERS
+
+    except breaker.UNAVAILABLE_ERRORS as e:
+        status, message, code, headers = breaker.unavailable(e)
+        return json.dumps({"status": status, "message": message}), code, {**CORS_HEADERS, **headers}
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)}), 500, CORS_HEADERS
+
+
+app = asgi.app_for(handle_async)
@@ -0,0 +1,155 @@
+"""
+Versioned schema migrations for the COFRAP database.
+
+Migrations live in `sql/migrations/` as `NNN_description.sql` files and are
+applied in version order on top of `sql/init.sql`. Every applied version is
+recorded in the `schema_version` table, so running the tool again only
+applies what is missing.
+
+Usage
+-----
+    DB_HOST=... DB_USER=... DB_PASSWORD=... DB_NAME=... python sql/migrate.py [--target N] [--status]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+LOCK_NAME = "cofrap_schema_migrate"
+LOCK_TIMEOUT = 30
+
+_FILENAME = re.compile(r"^(\d+)_([\w-]+)\.sql$")
+
+
+def split_statements(sql):
+    """
+    Split a migration script into individual statements.
+
+    Parameters
+    ----------
+    sql : str
+        Script content; `--` line comments are ignored and statements are
+        terminated by `;`.
+
+    Returns
+    -------
+    list of str
+        Non-empty statements without their trailing `;`.
+    """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [stmt.strip() for stmt in "\n".join(lines).split(";") if stmt.strip()]
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """
+    Read every migration script from `directory`.
+
+    Returns
+    -------
+    list of tuple
+        `(version, name, statements)` sorted by version.
+    """
+    migrations = []
+    for filename in os.listdir(directory):
+        match = _FILENAME.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            statements = split_statements(f.read())
+        migrations.append((int(match.group(1)), match.group(2), statements))
+    migrations.sort()
+    versions = [m[0] for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"duplicate migration version in {directory}")
+    return migrations
+
+
+def ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+          version INT PRIMARY KEY,
+          name VARCHAR(100) NOT NULL,
+          applied_at BIGINT NOT NULL
+        )
+    """)
+
+
+def applied_versions(cursor):
+    """Return the set of migration versions already recorded in the database."""
+    cursor.execute("SELECT version FROM schema_version")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(conn, directory=MIGRATIONS_DIR, target=None):
+    """
+    Apply every pending migration up to `target`.
+
+    A named advisory lock serialises concurrent runners. Statements are
+    written to be re-runnable (`IF NOT EXISTS`), so a run interrupted
+    half-way through a migration can simply be repeated.
+
+    Parameters
+    ----------
+    conn : pymysql.Connection
+        An open connection to the COFRAP database.
+    directory : str
+        Folder holding the migration scripts.
+    target : int or None
+        Highest version to apply; all of them when None.
+
+    Returns
+    -------
+    list of int
+        Versions applied by this run, in order.
+    """
+    done = []
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+        if not cursor.fetchone()[0]:
+            raise RuntimeError("another migration run holds the schema lock")
+        try:
+            ensure_version_table(cursor)
+            applied = applied_versions(cursor)
+            for version, name, statements in load_migrations(directory):
+                if version in applied or (target is not None and version > target):
+                    continue
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (%s, %s, %s)",
+                    (version, name, int(time.time()))
+                )
+                conn.commit()
+                done.append(version)
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply COFRAP schema migrations.")
+    parser.add_argument("--target", type=int, help="highest migration version to apply")
+    parser.add_argument("--status", action="store_true", help="list applied and pending migrations only")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from common.pool import connect_from_env
+
+    conn = connect_from_env()
+    with conn:
+        if args.status:
+            with conn.cursor() as cursor:
+                ensure_version_table(cursor)
+                applied = applied_versions(cursor)
+            for version, name, _ in load_migrations():
+                print(f"{version:03d} {name}: {'applied' if version in applied else 'pending'}")
+            return 0
+        applied = migrate(conn, target=args.target)
+        print(f"applied {len(applied)} migration(s): {applied}" if applied else "schema is up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
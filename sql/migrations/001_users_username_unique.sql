@@ -0,0 +1,24 @@
+-- Point lookups in authenticate-user, generate-password and generate-2fa all
+-- filter on username: make it unique so they become index seeks.
+
+-- Keep only the most recent row for any username that was duplicated by
+-- concurrent generate-password calls before the key existed. The older rows
+-- are copied to `users_duplicates_archive` first, to be reviewed or restored
+-- by hand; the table stays empty when there was nothing to remove.
+CREATE TABLE IF NOT EXISTS users_duplicates_archive LIKE users;
+
+INSERT IGNORE INTO users_duplicates_archive
+SELECT older.*
+  FROM users older
+  JOIN users newer
+    ON newer.username = older.username
+   AND newer.id > older.id;
+
+DELETE older
+  FROM users older
+  JOIN users newer
+    ON newer.username = older.username
+   AND newer.id > older.id;
+
+ALTER TABLE users
+  ADD UNIQUE INDEX IF NOT EXISTS uq_users_username (username);
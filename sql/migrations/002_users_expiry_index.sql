@@ -0,0 +1,4 @@
+-- Supports expiry scans such as
+--   SELECT ... FROM users WHERE expired = 0 AND gendate < ?
+CREATE INDEX IF NOT EXISTS ix_users_expired_gendate
+  ON users (expired, gendate);
@@ -0,0 +1,10 @@
+-- Invalidation feed for the authenticate-user credential cache: provisioning
+-- functions append a row whenever they rotate a password or MFA secret.
+CREATE TABLE IF NOT EXISTS credential_changes (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  username VARCHAR(100) NOT NULL,
+  changed_at BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_credential_changes_changed_at
+  ON credential_changes (changed_at);
@@ -0,0 +1,9 @@
+-- Credentials expire six months (6 * 30 days) after gendate, the same rule
+-- as is_expired() in authenticate-user. Stored so it can be indexed.
+ALTER TABLE users
+  ADD COLUMN IF NOT EXISTS expires_at BIGINT AS (gendate + 15552000) PERSISTENT;
+
+-- Supports the expire-credentials sweep:
+--   UPDATE users SET expired = 1 WHERE expired = 0 AND expires_at < ?
+CREATE INDEX IF NOT EXISTS ix_users_expired_expires_at
+  ON users (expired, expires_at);
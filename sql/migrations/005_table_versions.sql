@@ -0,0 +1,11 @@
+-- Version counters: every write to `users` bumps its row in the same
+-- transaction, so get-users can answer conditional GETs (ETag /
+-- If-None-Match) with a primary-key lookup instead of reading the table.
+CREATE TABLE IF NOT EXISTS table_versions (
+  name VARCHAR(64) PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT IGNORE INTO table_versions (name, version, updated_at)
+  VALUES ('users', 0, UNIX_TIMESTAMP());
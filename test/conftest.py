@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+from unittest import mock
+
+# Handlers import the shared `common` package, which lives at the repo root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from common import aiopool, artifacts, breaker, credcache, hashing, idempotency, pool, sqlite, userfilter, writebehind  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def reset_worker_state(monkeypatch):
+    # Never leak a pooled mock connection or cached credentials between tests,
+    # and never write QR artifacts outside of a test's own directory. The
+    # known-users filter rebuilds on a thread: tests that need it enable it.
+    # Passwords are hashed at the lowest cost, in threads rather than processes
+    monkeypatch.setenv("ARTIFACT_STORE", "none")
+    monkeypatch.setenv("USER_FILTER", "0")
+    monkeypatch.setenv("PASSWORD_HASH_LN", "10")
+    monkeypatch.setenv("HASH_EXECUTOR", "thread")
+    pool.reset_pool()
+    credcache.reset_cache()
+    artifacts.reset_writer()
+    userfilter.reset_known_users()
+    hashing.reset_pool()
+    breaker.reset_breaker()
+    writebehind.reset_queues()
+    sqlite.reset_database()
+    idempotency.reset_store()
+    yield
+    pool.reset_pool()
+    credcache.reset_cache()
+    artifacts.reset_writer()
+    userfilter.reset_known_users()
+    hashing.reset_pool()
+    breaker.reset_breaker()
+    writebehind.reset_queues()
+    sqlite.reset_database()
+    idempotency.reset_store()
+
+
+@pytest.fixture
+def async_db(monkeypatch):
+    """
+    Route the asyncio pool to a mock connection.
+
+    Returns
+    -------
+    tuple
+        `(db_pool, connection, cursor)`; the cursor's `execute`, `executemany`
+        and `fetch*` methods are `AsyncMock`s to configure per test.
+    """
+    cursor = mock.MagicMock()
+    for name in ("execute", "executemany", "fetchone", "fetchall", "fetchmany"):
+        setattr(cursor, name, mock.AsyncMock())
+    connection = mock.MagicMock()
+    connection.cursor.return_value.__aenter__.return_value = cursor
+    for name in ("begin", "commit", "rollback"):
+        setattr(connection, name, mock.AsyncMock())
+    db_pool = mock.MagicMock()
+    db_pool.acquire = mock.AsyncMock(return_value=connection)
+    monkeypatch.setattr(aiopool, "create_pool_from_env", mock.AsyncMock(return_value=db_pool))
+    return db_pool, connection, cursor
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import pytest
+from unittest import mock
+
+from common import aiopool, asgi, deadline, metrics, pool
+
+# -------------------- TESTS --------------------
+
+
+def test_connection_is_released(async_db):
+    db_pool, connection, _ = async_db
+
+    async def borrow():
+        async with aiopool.connection() as conn:
+            return conn
+
+    assert asyncio.run(borrow()) is connection
+    db_pool.release.assert_called_once_with(connection)
+    connection.rollback.assert_not_called()
+
+
+def test_connection_rolls_back_on_error(async_db):
+    db_pool, connection, _ = async_db
+
+    async def fail():
+        async with aiopool.connection():
+            raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        asyncio.run(fail())
+    connection.rollback.assert_awaited_once()
+    db_pool.release.assert_called_once_with(connection)
+
+
+def test_pool_is_created_once_per_loop(async_db):
+    async def many():
+        return await asyncio.gather(*(aiopool.get_pool() for _ in range(20)))
+
+    pools = asyncio.run(many())
+    assert all(p is async_db[0] for p in pools)
+    aiopool.create_pool_from_env.assert_awaited_once()
+
+
+def test_acquire_timeout_raises_pool_exhausted(async_db, monkeypatch):
+    db_pool, _, _ = async_db
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "0.01")
+
+    async def never():
+        await asyncio.sleep(1)
+
+    db_pool.acquire = never
+
+    async def borrow():
+        async with aiopool.connection():
+            pass
+
+    with pytest.raises(pool.PoolExhausted):
+        asyncio.run(borrow())
+
+
+def test_acquire_past_the_deadline_raises_deadline_exceeded(async_db):
+    db_pool, _, _ = async_db
+
+    async def never():
+        await asyncio.sleep(1)
+
+    db_pool.acquire = never
+
+    async def borrow():
+        token = deadline.start(0.02)
+        try:
+            async with aiopool.connection():
+                pass
+        finally:
+            deadline.reset(token)
+
+    with pytest.raises(deadline.DeadlineExceeded):
+        asyncio.run(borrow())
+
+
+def call_app(app, method="POST", path="/", body=b"", query=b"", headers=()):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": list(headers)}
+    asyncio.run(app(scope, receive, send))
+    headers = dict(sent[0]["headers"])
+    return sent[0]["status"], headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def test_asgi_app_passes_request_to_handler():
+    @metrics.instrumented("test-asgi")
+    async def handle_async(req, method="POST", query=None, headers=None):
+        return json.dumps({"req": req, "method": method, "query": query, "etag": headers["if-none-match"]}), 201, {"X-Test": "1"}
+
+    status, headers, body = call_app(asgi.app_for(handle_async), body=b'{"a": 1}', query=b"limit=5",
+                                     headers=[(b"If-None-Match", b'"v1"')])
+
+    assert status == 201
+    assert headers[b"x-test"] == b"1"
+    assert b"server-timing" in headers
+    assert json.loads(body) == {"req": '{"a": 1}', "method": "POST", "query": {"limit": "5"}, "etag": '"v1"'}
+
+
+def test_asgi_app_streams_async_generators():
+    async def chunks():
+        yield "["
+        yield "1"
+        yield "]"
+
+    async def handle_async(req, method="GET", query=None, headers=None):
+        return chunks(), 200, {"Content-Type": "application/json"}
+
+    status, _, body = call_app(asgi.app_for(handle_async), method="GET")
+    assert status == 200
+    assert body == b"[1]"
+
+
+def test_asgi_app_serves_metrics():
+    handle_async = mock.AsyncMock()
+    status, headers, body = call_app(asgi.app_for(handle_async), method="GET", path="/metrics")
+    assert status == 200
+    assert headers[b"content-type"] == metrics.PROMETHEUS_CONTENT_TYPE.encode()
+    handle_async.assert_not_called()
+
+
+def test_deadline_cancels_a_slow_query(async_db):
+    db_pool, connection, cursor = async_db
+
+    async def slow(*args):
+        await asyncio.sleep(1)
+
+    cursor.execute.side_effect = slow
+
+    async def query():
+        token = deadline.start(0.01)
+        try:
+            async with aiopool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT SLEEP(1)")
+        finally:
+            deadline.reset(token)
+
+    with pytest.raises(deadline.DeadlineExceeded):
+        asyncio.run(query())
+    connection.close.assert_called_once()
+    connection.rollback.assert_not_called()
+    db_pool.release.assert_called_once_with(connection)
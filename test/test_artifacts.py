@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+from unittest import mock
+
+from common import artifacts
+
+# -------------------- TESTS --------------------
+
+
+def test_local_dir_store_creates_directory_lazily(tmp_path):
+    directory = tmp_path / "qrcodes"
+    store = artifacts.LocalDirStore(str(directory))
+    assert not directory.exists()
+    store.put("alice_2fa.png", b"png")
+    assert (directory / "alice_2fa.png").read_bytes() == b"png"
+
+
+def test_content_addressed_store_deduplicates(tmp_path):
+    store = artifacts.ContentAddressedStore(str(tmp_path))
+    store.put("alice_2fa.png", b"same")
+    store.put("bob_2fa.png", b"same")
+    objects = [f for _, _, files in os.walk(tmp_path / "objects") for f in files]
+    assert len(objects) == 1
+    assert (tmp_path / "refs" / "alice_2fa.png").read_text() == (tmp_path / "refs" / "bob_2fa.png").read_text()
+
+
+def test_content_addressed_store_cleanup(tmp_path):
+    store = artifacts.ContentAddressedStore(str(tmp_path), retention=60)
+    store.put("alice_2fa.png", b"old")
+    old = time.time() - 120
+    for dirpath, _, files in os.walk(tmp_path):
+        for f in files:
+            os.utime(os.path.join(dirpath, f), (old, old))
+    store.put("bob_2fa.png", b"new")
+    assert store.cleanup() == 2
+    assert (tmp_path / "refs" / "bob_2fa.png").exists()
+
+
+def test_background_writer_flush(tmp_path):
+    writer = artifacts.BackgroundWriter(artifacts.LocalDirStore(str(tmp_path)))
+    for i in range(20):
+        assert writer.submit(f"user{i}.png", b"x")
+    assert writer.flush(timeout=5)
+    assert len(os.listdir(tmp_path)) == 20
+    stats = writer.stats()
+    assert (stats["written"], stats["queue_depth"]) == (20, 0)
+
+
+def test_background_writer_drops_when_full():
+    release = threading.Event()
+    store = mock.Mock()
+    store.put.side_effect = lambda name, data: release.wait(5)
+    writer = artifacts.BackgroundWriter(store, max_queue=1)
+
+    results = [writer.submit(f"a{i}", b"x") for i in range(5)]
+    assert results[-1] is False
+    assert writer.stats()["dropped"] >= 1
+    release.set()
+    assert writer.flush(timeout=5)
+
+
+def test_background_writer_counts_failures():
+    store = mock.Mock()
+    store.put.side_effect = OSError("read-only volume")
+    writer = artifacts.BackgroundWriter(store)
+    writer.submit("a.png", b"x")
+    writer.flush(timeout=5)
+    assert writer.stats()["failed"] == 1
+
+
+def test_store_from_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("ARTIFACT_STORE", "cas")
+    monkeypatch.setenv("ARTIFACT_DIR", str(tmp_path))
+    assert isinstance(artifacts.store_from_env(), artifacts.ContentAddressedStore)
+    monkeypatch.setenv("ARTIFACT_STORE", "none")
+    assert isinstance(artifacts.store_from_env(), artifacts.NullStore)
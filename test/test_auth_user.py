@@ -1,7 +1,11 @@
+import asyncio
+import base64
 import importlib.util
+import json
 import os
 import sys
 import time
+import pyotp
 import pytest
 from unittest import mock
 
@@ -55,7 +59,7 @@ def test_is_expired_edge_case():
     'DB_PASSWORD': 'test_pass',
     'DB_NAME': 'test_db'
 })
-@mock.patch("authenticate_user.pymysql.connect")
+@mock.patch("common.pool.pymysql.connect")
 def test_fetch_user(mock_connect):
     # Set up mocks
     mock_conn = mock.MagicMock()
@@ -86,25 +90,82 @@ def test_fetch_user(mock_connect):
     "DB_PASSWORD": "test_pass",
     "DB_NAME": "test_db"
 })
-@mock.patch("authenticate_user.pymysql.connect")
-def test_mark_expired(mock_connect):
+@mock.patch("common.pool.pymysql.connect")
+def test_write_expired(mock_connect):
     mock_conn = mock.MagicMock()
     mock_cursor = mock.MagicMock()
+    mock_cursor.execute.return_value = 2
 
     mock_connect.return_value = mock_conn
     mock_conn.__enter__.return_value = mock_conn
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
     # Call function
-    authenticate_user.mark_expired("testuser")
+    assert authenticate_user.write_expired(["alice", "bob"]) == 2
 
-    # Assert SQL command was run with correct parameters
-    mock_cursor.execute.assert_called_once_with(
-        "UPDATE users SET expired = 1 WHERE username = %s", ("testuser",)
-    )
+    # One guarded UPDATE for the whole batch, with the table version bump
+    (sql, (cutoff, *usernames)), bump = (c.args for c in mock_cursor.execute.call_args_list)
+    assert sql == "UPDATE users SET expired = 1 WHERE expired = 0 AND gendate < %s AND username IN (%s, %s)"
+    assert usernames == ["alice", "bob"]
+    assert abs(cutoff - (time.time() - authenticate_user.EXPIRY_SECONDS)) < 5
+    assert bump == (authenticate_user.versions.BUMP_SQL, ("users",))
+    mock_conn.begin.assert_called_once()
     mock_conn.commit.assert_called_once()
 
 
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test_user",
+    "DB_PASSWORD": "test_pass",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_write_expired_rolls_back_when_nothing_changed(mock_connect):
+    mock_conn = mock.MagicMock()
+    mock_cursor = mock.MagicMock()
+    mock_cursor.execute.return_value = 0
+    mock_connect.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+    assert authenticate_user.write_expired(["alice"]) == 0
+
+    mock_cursor.execute.assert_called_once()
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+
+
+@mock.patch("authenticate_user.write_expired")
+@mock.patch("authenticate_user.fetch_user")
+def test_stored_expired_flag_short_circuits_login(mock_fetch_user, mock_write_expired):
+    # Fresh gendate, but the row is flagged: no verification and nothing to write
+    mock_fetch_user.return_value = ("cmVhbHBhc3M=", "c2VjcmV0", int(time.time()), 1)
+
+    with mock.patch.object(authenticate_user.hashing, "verify") as mock_verify:
+        for _ in range(3):
+            assert authenticate_user.authenticate_user("testuser", "realpass", "123456")["status"] == "expired"
+
+    mock_verify.assert_not_called()
+    assert authenticate_user.get_expiry_queue().stats()["queued"] == 0
+    mock_write_expired.assert_not_called()
+
+
+@mock.patch("authenticate_user.write_expired")
+@mock.patch("authenticate_user.fetch_user")
+def test_expiry_transition_is_queued_once(mock_fetch_user, mock_write_expired):
+    old = int(time.time()) - 200 * 24 * 3600
+    mock_fetch_user.return_value = ("cmVhbHBhc3M=", "c2VjcmV0", old, 0)
+
+    with mock.patch.object(authenticate_user.credcache.CredentialCache, "sync"):
+        for _ in range(3):
+            assert authenticate_user.authenticate_user("testuser", "realpass", "123456")["status"] == "expired"
+
+    # The first attempt flags the cached credentials, the retries stop on the flag
+    queue = authenticate_user.get_expiry_queue()
+    assert queue.stats()["queued"] == 1
+    assert queue.flush(timeout=5)
+    mock_write_expired.assert_called_once_with(["testuser"])
+
+
 @mock.patch("authenticate_user.decode_b64")
 @mock.patch("authenticate_user.fetch_user")
 @mock.patch("authenticate_user.is_expired", return_value=False)
@@ -119,3 +180,227 @@ def test_authenticate_user_success(mock_totp_cls, mock_is_expired, mock_fetch_us
 
     result = authenticate_user.authenticate_user("testuser", "realpass", "123456")
     assert result == {"status": "success", "message": "Authentication successful"}
+
+
+@mock.patch("authenticate_user.decode_b64")
+@mock.patch("authenticate_user.fetch_user")
+@mock.patch("authenticate_user.is_expired", return_value=False)
+@mock.patch("authenticate_user.pyotp.TOTP")
+def test_authenticate_user_served_from_cache(mock_totp_cls, mock_is_expired, mock_fetch_user, mock_decode):
+    mock_fetch_user.return_value = ("enc_pwd", "enc_mfa", 1234567890, 0)
+    mock_decode.side_effect = ["realpass", "secret"]
+    mock_totp_cls.return_value.verify.return_value = True
+
+    with mock.patch.object(authenticate_user.credcache.CredentialCache, "sync"):
+        first = authenticate_user.authenticate_user("testuser", "realpass", "123456")
+        second = authenticate_user.authenticate_user("testuser", "realpass", "123456")
+
+    assert first == second == {"status": "success", "message": "Authentication successful"}
+    mock_fetch_user.assert_called_once()
+    mock_totp_cls.assert_called_once_with("secret")
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test_user",
+    "DB_PASSWORD": "test_pass",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+@mock.patch("authenticate_user.fetch_user")
+@mock.patch("authenticate_user.pyotp.TOTP")
+def test_legacy_password_is_rehashed_on_login(mock_totp_cls, mock_fetch_user, mock_connect):
+    legacy = base64.b64encode(b"realpass").decode()
+    mock_fetch_user.return_value = (legacy, "c2VjcmV0", int(time.time()), 0)
+    mock_totp_cls.return_value.verify.return_value = True
+    mock_cursor = mock.MagicMock()
+    mock_connect.return_value.cursor.return_value.__enter__.return_value = mock_cursor
+
+    with mock.patch.object(authenticate_user.credcache.CredentialCache, "sync"):
+        result = authenticate_user.authenticate_user("alice", "realpass", "123456")
+
+    assert result["status"] == "success"
+    sql, rows = mock_cursor.executemany.call_args_list[0].args
+    assert sql == authenticate_user.UPGRADE_PASSWORD_SQL
+    (new_hash, username, old_value), = rows
+    assert (username, old_value) == ("alice", legacy)
+    assert authenticate_user.hashing.verify("realpass", authenticate_user.hashing.PasswordHash.parse(new_hash))
+    assert mock_cursor.executemany.call_args_list[1].args[0] == authenticate_user.credcache.PUBLISH_CHANGE_SQL
+    mock_connect.return_value.commit.assert_called_once()
+
+
+@mock.patch("common.pool.pymysql.connect")
+@mock.patch("authenticate_user.fetch_user")
+@mock.patch("authenticate_user.pyotp.TOTP")
+def test_hashed_password_is_verified_without_write(mock_totp_cls, mock_fetch_user, mock_connect):
+    stored = authenticate_user.hashing.hash_password("realpass")
+    mock_fetch_user.return_value = (stored, "c2VjcmV0", int(time.time()), 0)
+    mock_totp_cls.return_value.verify.return_value = True
+
+    with mock.patch.object(authenticate_user.credcache.CredentialCache, "sync"):
+        good = authenticate_user.authenticate_user("alice", "realpass", "123456")
+        bad = authenticate_user.authenticate_user("alice", "wrong", "123456")
+
+    assert good["status"] == "success"
+    assert bad == {"status": "auth_failed", "message": "Invalid password"}
+    mock_connect.assert_not_called()
+
+
+@mock.patch("authenticate_user.fetch_user")
+@mock.patch("authenticate_user.pyotp.TOTP")
+def test_failed_rehash_does_not_fail_login(mock_totp_cls, mock_fetch_user):
+    mock_fetch_user.return_value = ("cmVhbHBhc3M=", "c2VjcmV0", int(time.time()), 0)
+    mock_totp_cls.return_value.verify.return_value = True
+
+    with mock.patch.object(authenticate_user.credcache.CredentialCache, "sync"), \
+            mock.patch.object(authenticate_user.hashing, "hash_passwords", side_effect=authenticate_user.hashing.HashingBusy):
+        result = authenticate_user.authenticate_user("alice", "realpass", "123456")
+
+    assert result["status"] == "success"
+
+
+@mock.patch("authenticate_user.fetch_user", side_effect=authenticate_user.breaker.DeadlineExceeded("deadline exceeded"))
+def test_handle_reports_spent_deadline(mock_fetch_user):
+    with mock.patch.object(authenticate_user.credcache.CredentialCache, "sync"):
+        body, code, _ = authenticate_user.handle(json.dumps({"username": "alice", "password": "x", "otp_code": "1"}))
+    assert (json.loads(body)["status"], code) == ("timeout", 504)
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test_user",
+    "DB_PASSWORD": "test_pass",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_fetch_users_single_query(mock_connect):
+    mock_cursor = mock.MagicMock()
+    mock_connect.return_value.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [("alice", "p", "m", 1, 0)]
+
+    result = authenticate_user.fetch_users(["alice", "bob"])
+
+    assert result == {"alice": ("p", "m", 1, 0)}
+    mock_cursor.execute.assert_called_once_with(
+        "SELECT username, password, mfa, gendate, expired FROM users WHERE username IN (%s, %s)",
+        ("alice", "bob")
+    )
+
+
+@mock.patch("authenticate_user.mark_expired")
+@mock.patch("authenticate_user.fetch_users")
+@mock.patch("authenticate_user.pyotp.TOTP")
+def test_authenticate_users_batch(mock_totp_cls, mock_fetch_users, mock_mark_expired):
+    now = int(time.time())
+    old = now - (7 * 30 * 24 * 60 * 60)
+    mock_fetch_users.return_value = {
+        "alice": ("cmVhbHBhc3M=", "c2VjcmV0", now, 0),   # "realpass" / "secret"
+        "bob": ("cmVhbHBhc3M=", "c2VjcmV0", old, 0),
+    }
+    mock_totp_cls.return_value.verify.return_value = True
+
+    entries = [
+        {"username": "alice", "password": "realpass", "otp_code": "123456"},
+        {"username": "alice", "password": "wrong", "otp_code": "123456"},
+        {"username": "bob", "password": "realpass", "otp_code": "123456"},
+        {"username": "carol", "password": "x", "otp_code": "123456"},
+        {"username": "dave"},
+    ]
+    with mock.patch.object(authenticate_user.credcache.CredentialCache, "sync"):
+        results = authenticate_user.authenticate_users(entries)
+
+    assert [r["status"] for r in results] == ["success", "auth_failed", "expired", "auth_failed", "error"]
+    assert results[3]["message"] == "User not found"
+    mock_fetch_users.assert_called_once()
+    assert sorted(mock_fetch_users.call_args.args[0]) == ["alice", "bob", "carol"]
+    mock_mark_expired.assert_called_once_with("bob")
+
+
+@mock.patch("authenticate_user.authenticate_users")
+def test_handle_batch(mock_authenticate_users):
+    mock_authenticate_users.return_value = [{"status": "success", "message": "Authentication successful"}]
+    req = json.dumps({"credentials": [{"username": "a", "password": "b", "otp_code": "c"}]})
+
+    result = json.loads(authenticate_user.handle(req))
+
+    assert result == {"results": [{"status": "success", "message": "Authentication successful"}]}
+
+
+def test_handle_batch_too_large():
+    req = json.dumps({"credentials": [{}] * (authenticate_user.BATCH_MAX_SIZE + 1)})
+    result = json.loads(authenticate_user.handle(req))
+    assert result["status"] == "error"
+
+
+@mock.patch("authenticate_user.mark_expired")
+@mock.patch("authenticate_user.load_credentials")
+@mock.patch("authenticate_user.is_expired", return_value=True)
+def test_authenticate_user_expired_without_login_write(mock_is_expired, mock_load, mock_mark_expired):
+    mock_load.return_value = mock.Mock(gendate=1234567890, expired=0)
+
+    with mock.patch.object(authenticate_user, "MARK_EXPIRED_ON_LOGIN", False):
+        result = authenticate_user.authenticate_user("testuser", "pwd", "123456")
+
+    assert result["status"] == "expired"
+    mock_mark_expired.assert_not_called()
+
+
+def test_handle_async_success(async_db):
+    _, _, cursor = async_db
+    secret = pyotp.random_base32()
+    cursor.fetchone.side_effect = [
+        (0,),  # first credential_changes poll
+        (base64.b64encode(b"secret_pw").decode(), base64.b64encode(secret.encode()).decode(), int(time.time()), 0),
+    ]
+
+    req = json.dumps({"username": "alice", "password": "secret_pw", "otp_code": pyotp.TOTP(secret).now()})
+    body, status, headers = asyncio.run(authenticate_user.handle_async(req))
+
+    assert json.loads(body)["status"] == "success"
+    assert status == 200
+    assert "Server-Timing" in headers
+    assert mock.call(authenticate_user.FETCH_USER_SQL, ("alice",)) in cursor.execute.await_args_list
+    # The legacy base64 row is upgraded to a hash of the same password
+    sql, rows = cursor.executemany.await_args_list[0].args
+    assert sql == authenticate_user.UPGRADE_PASSWORD_SQL
+    (new_hash, username, old_value), = rows
+    assert (username, old_value) == ("alice", base64.b64encode(b"secret_pw").decode())
+    assert authenticate_user.hashing.verify("secret_pw", authenticate_user.hashing.PasswordHash.parse(new_hash))
+
+
+@mock.patch("authenticate_user.write_expired")
+def test_handle_async_batch_marks_expired_once(mock_write_expired, async_db):
+    _, _, cursor = async_db
+    cursor.fetchone.return_value = (0,)
+    old = int(time.time()) - 200 * 24 * 3600
+    cursor.fetchall.return_value = [("bob", base64.b64encode(b"pw").decode(), base64.b64encode(b"MFA").decode(), old, 0)]
+
+    req = json.dumps({"credentials": [
+        {"username": "bob", "password": "pw", "otp_code": "123456"},
+        {"username": "carol", "password": "pw", "otp_code": "123456"},
+    ]})
+    body, _, _ = asyncio.run(authenticate_user.handle_async(req))
+
+    assert [r["status"] for r in json.loads(body)["results"]] == ["expired", "auth_failed"]
+    # Nothing written on the event loop: the transition waits in the write-behind queue
+    assert not any("UPDATE" in c.args[0] for c in cursor.execute.await_args_list)
+    assert authenticate_user.get_expiry_queue().flush(timeout=5)
+    mock_write_expired.assert_called_once_with(["bob"])
+
+
+@mock.patch("authenticate_user.fetch_user")
+def test_unknown_user_is_rejected_without_query(mock_fetch_user, monkeypatch):
+    monkeypatch.setenv("USER_FILTER", "1")
+    known = authenticate_user.userfilter.get_known_users()
+    known._filter = authenticate_user.userfilter.BloomFilter(100)
+    known._filter.add("alice")
+    known._next_refresh = float("inf")
+    mock_fetch_user.return_value = None
+
+    assert authenticate_user.authenticate_user("mallory", "pw", "123456") == authenticate_user.NOT_FOUND_RESULT
+    mock_fetch_user.assert_not_called()
+
+    # A name the filter lets through but the database does not know is cached as missing
+    assert authenticate_user.authenticate_user("alice", "pw", "123456") == authenticate_user.NOT_FOUND_RESULT
+    assert authenticate_user.authenticate_user("alice", "pw", "123456") == authenticate_user.NOT_FOUND_RESULT
+    mock_fetch_user.assert_called_once_with("alice")
@@ -0,0 +1,127 @@
+import os
+import pytest
+import pymysql
+from unittest import mock
+
+from common import breaker, deadline, metrics, pool
+
+# -------------------- TESTS --------------------
+
+
+def make_breaker(**kwargs):
+    now = [0.0]
+    options = {"failure_ratio": 0.5, "min_calls": 4, "window": 10, "open_seconds": 5}
+    options.update(kwargs)
+    return breaker.CircuitBreaker(clock=lambda: now[0], **options), now
+
+
+def call(circuit, error=None):
+    with circuit.guard():
+        if error is not None:
+            raise error
+
+
+def fail(circuit, times=1):
+    for _ in range(times):
+        with pytest.raises(pymysql.err.OperationalError):
+            call(circuit, pymysql.err.OperationalError(2013, "Lost connection"))
+
+
+def test_opens_once_failure_ratio_is_reached():
+    circuit, _ = make_breaker()
+    call(circuit)
+    fail(circuit, 2)
+    assert circuit.state == breaker.CLOSED  # 3 calls: below min_calls
+    fail(circuit)
+
+    assert circuit.state == breaker.OPEN
+    with pytest.raises(breaker.CircuitOpen) as refused:
+        call(circuit)
+    assert refused.value.retry_after == 5
+    assert circuit.stats()["rejected"] == 1
+
+
+def test_query_errors_are_not_failures():
+    circuit, _ = make_breaker()
+    for _ in range(4):
+        with pytest.raises(pymysql.err.IntegrityError):
+            call(circuit, pymysql.err.IntegrityError(1062, "Duplicate entry"))
+    assert circuit.state == breaker.CLOSED
+
+
+def test_old_outcomes_leave_the_window():
+    circuit, now = make_breaker()
+    fail(circuit, 3)
+    now[0] = 11
+    call(circuit)
+    assert circuit.state == breaker.CLOSED
+    assert circuit.stats()["calls"] == 1
+
+
+def test_half_open_probe_closes_or_reopens():
+    circuit, now = make_breaker()
+    fail(circuit, 4)
+
+    now[0] = 5
+    fail(circuit)  # the probe fails: open again
+    assert circuit.state == breaker.OPEN
+
+    now[0] = 10
+    with circuit.guard():
+        assert circuit.state == breaker.HALF_OPEN
+        with pytest.raises(breaker.CircuitOpen):
+            call(circuit)  # a single probe at a time
+    assert circuit.state == breaker.CLOSED
+    assert circuit.stats()["opened"] == 2
+
+
+def test_unavailable_statuses():
+    assert breaker.unavailable(breaker.CircuitOpen(2.2)) == (
+        "unavailable", "Database unavailable, retry later", 503, {"Retry-After": "3"}
+    )
+    assert breaker.unavailable(deadline.DeadlineExceeded())[::2] == ("timeout", 504)
+    assert breaker.unavailable(pool.PoolExhausted("busy"))[2:] == (503, {"Retry-After": "1"})
+
+
+def test_exhausted_pool_is_not_an_outcome():
+    circuit, _ = make_breaker()
+    connection_pool = pool.ConnectionPool(mock.MagicMock, max_size=1, acquire_timeout=0.001, breaker=circuit)
+    with connection_pool.connection():
+        for _ in range(30):
+            with pytest.raises(pool.PoolExhausted):
+                with connection_pool.connection():
+                    pass
+    assert circuit.stats()["calls"] == 1
+    fail(circuit, 3)
+    assert circuit.state == breaker.OPEN
+
+
+def test_exhausted_pool_gives_the_probe_back():
+    circuit, now = make_breaker()
+    fail(circuit, 4)
+    now[0] = 5
+    with pytest.raises(pool.PoolExhausted):
+        call(circuit, pool.PoolExhausted("busy"))
+    call(circuit)
+    assert circuit.state == breaker.CLOSED
+
+
+def test_disabled_breaker(monkeypatch):
+    monkeypatch.setenv("DB_BREAKER", "0")
+    assert breaker.get_breaker() is None
+
+
+@mock.patch.dict(os.environ, {"DB_HOST": "localhost", "DB_USER": "test", "DB_PASSWORD": "test", "DB_NAME": "test_db",
+                              "DB_BREAKER_MIN_CALLS": "2"})
+@mock.patch("common.pool.pymysql.connect", side_effect=pymysql.err.OperationalError(2003, "Can't connect"))
+def test_pool_fails_fast_once_open(mock_connect):
+    for _ in range(2):
+        with pytest.raises(pymysql.err.OperationalError):
+            with pool.get_pool().connection():
+                pass
+
+    with pytest.raises(breaker.CircuitOpen):
+        with pool.get_pool().connection():
+            pass
+    assert mock_connect.call_count == 2
+    assert 'cofrap_db_breaker_state{state="open"} 1' in metrics.REGISTRY.render()
@@ -0,0 +1,160 @@
+from unittest import mock
+from contextlib import contextmanager
+
+from common import credcache
+
+# -------------------- TESTS --------------------
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def creds(password="pwd"):
+    return credcache.Credentials(password, mock.Mock(), 1234567890, 0)
+
+
+def test_hit_and_miss_counters():
+    cache = credcache.CredentialCache()
+    assert cache.get("alice") is None
+    cache.put("alice", creds())
+    assert cache.get("alice").password == "pwd"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = credcache.CredentialCache(ttl=10, clock=clock)
+    cache.put("alice", creds())
+    clock.now = 11
+    assert cache.get("alice") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_lru_eviction():
+    cache = credcache.CredentialCache(max_size=2)
+    cache.put("alice", creds())
+    cache.put("bob", creds())
+    cache.get("alice")
+    cache.put("carol", creds())
+    assert cache.get("bob") is None
+    assert cache.get("alice") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate():
+    cache = credcache.CredentialCache()
+    cache.put("alice", creds())
+    cache.invalidate("alice")
+    assert cache.get("alice") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def fake_connection(cursor):
+    conn = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+
+    @contextmanager
+    def connection():
+        yield conn
+
+    return connection
+
+
+def test_sync_applies_remote_invalidations():
+    clock = FakeClock()
+    cache = credcache.CredentialCache(sync_interval=5, clock=clock)
+    cursor = mock.MagicMock()
+    cursor.fetchone.return_value = (7,)
+    cache.sync(fake_connection(cursor))
+
+    cache.put("alice", creds())
+    cache.put("bob", creds())
+    cursor.fetchall.return_value = [(8, "alice")]
+
+    # Not due yet: nothing is read
+    cache.sync(fake_connection(cursor))
+    assert cursor.fetchall.call_count == 0
+
+    clock.now = 6
+    cache.sync(fake_connection(cursor))
+    cursor.execute.assert_called_with(
+        "SELECT id, username FROM credential_changes WHERE id > %s ORDER BY id", (7,)
+    )
+    assert cache.get("alice") is None
+    assert cache.get("bob") is not None
+
+
+def test_sync_picks_up_ids_committed_out_of_order(monkeypatch):
+    clock = FakeClock()
+    cache = credcache.CredentialCache(sync_interval=5, clock=clock)
+    cursor = mock.MagicMock()
+    cursor.fetchone.return_value = (7,)
+    cache.sync(fake_connection(cursor))
+    notified = []
+    monkeypatch.setattr(credcache, "_listeners", [notified.append])
+
+    # Id 8 is still uncommitted when 9 is read
+    cache.put("alice", creds())
+    cursor.fetchall.return_value = [(9, "bob")]
+    clock.now = 6
+    cache.sync(fake_connection(cursor))
+    assert notified == ["bob"]
+
+    cursor.fetchall.return_value = [(8, "alice"), (9, "bob"), (10, "carol")]
+    clock.now = 12
+    cache.sync(fake_connection(cursor))
+    cursor.execute.assert_called_with(credcache.CHANGES_SQL, (7,))
+    assert cache.get("alice") is None
+    assert notified == ["bob", "alice", "carol"]
+
+    # Once filled, the gap is no longer read again
+    cursor.fetchall.return_value = []
+    clock.now = 18
+    cache.sync(fake_connection(cursor))
+    cursor.execute.assert_called_with(credcache.CHANGES_SQL, (10,))
+
+
+def test_sync_stops_waiting_for_a_rolled_back_id():
+    clock = FakeClock()
+    cache = credcache.CredentialCache(sync_interval=5, clock=clock)
+    cursor = mock.MagicMock()
+    cursor.fetchone.return_value = (7,)
+    cache.sync(fake_connection(cursor))
+
+    cursor.fetchall.return_value = [(9, "bob")]
+    clock.now = 6
+    cache.sync(fake_connection(cursor))
+    clock.now = 6 + credcache.CHANGE_GAP_TIMEOUT + 1
+    cache.sync(fake_connection(cursor))
+    clock.now += 6
+    cache.sync(fake_connection(cursor))
+    cursor.execute.assert_called_with(credcache.CHANGES_SQL, (9,))
+
+
+def test_failed_sync_clears_cache():
+    cache = credcache.CredentialCache()
+    cache.put("alice", creds())
+
+    @contextmanager
+    def broken():
+        raise ConnectionError("db down")
+        yield
+
+    cache.sync(broken)
+    assert cache.get("alice") is None
+
+
+def test_publish_invalidation_drops_local_entry():
+    credcache.get_cache().put("alice", creds())
+    cursor = mock.MagicMock()
+    credcache.publish_invalidation(cursor, "alice")
+    assert credcache.get_cache().get("alice") is None
+    sql, rows = cursor.executemany.call_args.args
+    assert "INSERT INTO credential_changes" in sql
+    assert [row[0] for row in rows] == ["alice"]
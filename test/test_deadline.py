@@ -0,0 +1,53 @@
+import time
+import pytest
+
+from common import deadline
+
+# -------------------- TESTS --------------------
+
+
+def test_no_deadline_outside_of_a_request():
+    assert deadline.remaining() is None
+    assert deadline.bound(5) == 5
+    deadline.check()
+
+
+def test_bound_caps_timeouts():
+    token = deadline.start(2)
+    try:
+        assert 1.9 < deadline.bound(5) <= 2
+        assert deadline.bound(0.5) == 0.5
+        assert 1.9 < deadline.bound(None) <= 2
+    finally:
+        deadline.reset(token)
+    assert deadline.remaining() is None
+
+
+def test_spent_deadline_raises():
+    token = deadline.start(0.001)
+    try:
+        time.sleep(0.002)
+        assert deadline.expired()
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.bound(5, "a query")
+    finally:
+        deadline.reset(token)
+
+
+def test_nested_start_never_extends():
+    outer = deadline.start(1)
+    try:
+        inner = deadline.start(60)
+        assert deadline.remaining() <= 1
+        deadline.reset(inner)
+    finally:
+        deadline.reset(outer)
+
+
+def test_zero_budget_disables(monkeypatch):
+    monkeypatch.setenv("REQUEST_DEADLINE", "0")
+    token = deadline.start()
+    try:
+        assert deadline.remaining() is None
+    finally:
+        deadline.reset(token)
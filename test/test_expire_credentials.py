@@ -0,0 +1,126 @@
+import importlib.util
+import os
+import sys
+import json
+import time
+from unittest import mock
+
+# Load the handler module safely
+handler_path = os.path.abspath("expire-credentials/handler.py")
+spec = importlib.util.spec_from_file_location("expire_credentials", handler_path)
+expire_credentials = importlib.util.module_from_spec(spec)
+sys.modules["expire_credentials"] = expire_credentials
+spec.loader.exec_module(expire_credentials)
+
+# -------------------- TESTS --------------------
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_sweep_expired_in_chunks(mock_connect):
+    mock_conn = mock_connect.return_value
+    mock_cursor = mock.MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    # Each chunk flags accounts then bumps the table version (1 row)
+    mock_cursor.execute.side_effect = [100, 1, 100, 1, 42, 1]
+
+    report = expire_credentials.sweep_expired(chunk_size=100, max_chunks=10, now=1700000000)
+
+    assert report["rows_updated"] == 242
+    assert report["chunks"] == 3
+    assert report["complete"] is True
+    assert mock_cursor.execute.call_args_list[0] == mock.call(
+        "UPDATE users SET expired = 1 WHERE expired = 0 AND expires_at < %s LIMIT %s",
+        (1700000000, 100)
+    )
+    assert mock_conn.commit.call_count == 3
+    mock_cursor.execute.assert_called_with(expire_credentials.versions.BUMP_SQL, ("users",))
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_sweep_without_overdue_accounts_keeps_version(mock_connect):
+    mock_conn = mock_connect.return_value
+    mock_cursor = mock.MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.execute.side_effect = [0]
+
+    report = expire_credentials.sweep_expired(chunk_size=100, max_chunks=10)
+
+    assert (report["rows_updated"], report["complete"]) == (0, True)
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_sweep_expired_stops_at_max_chunks(mock_connect):
+    mock_cursor = mock.MagicMock()
+    mock_connect.return_value.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.execute.return_value = 10
+
+    report = expire_credentials.sweep_expired(chunk_size=10, max_chunks=2)
+
+    assert (report["rows_updated"], report["chunks"], report["complete"]) == (20, 2, False)
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_sweep_expired_stops_before_the_deadline(mock_connect):
+    mock_cursor = mock.MagicMock()
+    mock_connect.return_value.cursor.return_value.__enter__.return_value = mock_cursor
+
+    def slow_chunk(sql, args=None):
+        time.sleep(0.03)
+        return 10
+
+    mock_cursor.execute.side_effect = slow_chunk
+    token = expire_credentials.deadline.start(0.1)
+    try:
+        report = expire_credentials.sweep_expired(chunk_size=10, max_chunks=100)
+    finally:
+        expire_credentials.deadline.reset(token)
+
+    # Each chunk takes ~60 ms (update + version bump): a third would not fit
+    assert (report["chunks"], report["complete"]) == (1, False)
+
+
+@mock.patch("expire_credentials.sweep_expired")
+def test_handle_reports(mock_sweep):
+    mock_sweep.return_value = {"rows_updated": 3, "chunks": 1, "complete": True, "duration_ms": 1.5}
+    result = json.loads(expire_credentials.handle(json.dumps({"chunk_size": 50})))
+    assert result["status"] == "ok"
+    assert result["rows_updated"] == 3
+    mock_sweep.assert_called_once_with(50, expire_credentials.DEFAULT_MAX_CHUNKS)
+
+
+def test_handle_rejects_invalid_chunk_size():
+    result = json.loads(expire_credentials.handle(json.dumps({"chunk_size": 0})))
+    assert result["status"] == "error"
+
+
+@mock.patch("expire_credentials.sweep_expired", side_effect=expire_credentials.breaker.CircuitOpen(4.5))
+def test_handle_reports_open_breaker(mock_sweep):
+    body, code, headers = expire_credentials.handle(None)
+    assert json.loads(body)["status"] == "unavailable"
+    assert (code, headers) == (503, {"Retry-After": "5"})
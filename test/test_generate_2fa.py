@@ -1,26 +1,23 @@
+import asyncio
+import base64
 import importlib.util
 import os
 import sys
 import json
-import tempfile
-import shutil
+import threading
+import time
 from unittest import mock
 
-# Set up safe QR_DIR
-temp_qr_dir = tempfile.mkdtemp()
+from flask import Flask
 
-# Load handler
+from common import idempotency
+
+# Load handler (no import-time side effects: QR codes are persisted by common.artifacts)
 handler_path = os.path.abspath("generate-2fa/handler.py")
 spec = importlib.util.spec_from_file_location("generate_2fa", handler_path)
 generate_2fa = importlib.util.module_from_spec(spec)
 sys.modules["generate_2fa"] = generate_2fa
-generate_2fa.QR_DIR = temp_qr_dir
-
-# Disable real directory creation
-original_makedirs = os.makedirs
-os.makedirs = lambda path, exist_ok=False: None
 spec.loader.exec_module(generate_2fa)
-os.makedirs = original_makedirs  # restore
 
 # -------------------- TESTS --------------------
 
@@ -31,10 +28,10 @@ os.makedirs = original_makedirs  # restore
     "DB_NAME": "test_db",
     "REQUEST_METHOD": "POST" 
 })
-@mock.patch("generate_2fa.pymysql.connect")
-@mock.patch("generate_2fa.qrcode.make")
+@mock.patch("common.pool.pymysql.connect")
+@mock.patch("common.artifacts.BackgroundWriter.submit")
 @mock.patch("generate_2fa.make_response")
-def test_generate_2fa_success(mock_make_response, mock_qrcode_make, mock_connect):
+def test_generate_2fa_success(mock_make_response, mock_submit, mock_connect):
     # Simulate DB behavior
     mock_conn = mock.MagicMock()
     mock_cursor = mock.MagicMock()
@@ -42,11 +39,6 @@ def test_generate_2fa_success(mock_make_response, mock_qrcode_make, mock_connect
     mock_conn.__enter__.return_value = mock_conn
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
-    # Simulate QR code generation
-    mock_img = mock.MagicMock()
-    mock_img.save.return_value = None
-    mock_qrcode_make.return_value = mock_img
-
     # Simulate response building
     mock_resp = mock.Mock()
     mock_resp.headers = {}
@@ -58,8 +50,135 @@ def test_generate_2fa_success(mock_make_response, mock_qrcode_make, mock_connect
     # Assertions
     mock_make_response.assert_called()
     assert "Access-Control-Allow-Origin" in mock_resp.headers
+    body = json.loads(mock_make_response.call_args.args[0])
+    assert body["code_mfa"].startswith("iVBORw0KGgo")  # PNG signature
+    name, data = mock_submit.call_args.args
+    assert name == "testuser_2fa.png"
+    assert base64.b64encode(data).decode() == body["code_mfa"]
+    mock_conn.begin.assert_called_once()
+    mock_conn.commit.assert_called_once()
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "user",
+    "DB_PASSWORD": "pass",
+    "DB_NAME": "test_db",
+    "REQUEST_METHOD": "POST"
+})
+@mock.patch("common.pool.pymysql.connect")
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_unknown_user_is_not_published(mock_submit, mock_connect):
+    mock_conn = mock_connect.return_value
+    mock_cursor = mock.MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.execute.return_value = 0
+
+    body, status = generate_2fa.provision("ghost")
+
+    assert status == 404
+    assert json.loads(body)["status"] == "error"
+    assert mock_cursor.execute.call_count == 1
+    mock_cursor.executemany.assert_not_called()
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+    mock_submit.assert_not_called()
+
+
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_handle_async_success(mock_submit, async_db):
+    _, connection, cursor = async_db
+
+    body, status, headers = asyncio.run(generate_2fa.handle_async(json.dumps({"username": "testuser"})))
+
+    payload = json.loads(body)
+    assert status == 200
+    assert "Access-Control-Allow-Origin" in headers
+    assert payload["code_mfa"].startswith("iVBORw0KGgo")
+    assert cursor.execute.await_args_list[0].args[0] == generate_2fa.UPDATE_MFA_SQL
+    assert mock_submit.call_args.args[0] == "testuser_2fa.png"
+    connection.begin.assert_awaited_once()
+    connection.commit.assert_awaited_once()
+
+
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_handle_async_unknown_user(mock_submit, async_db):
+    _, connection, cursor = async_db
+    cursor.execute.return_value = 0
+
+    body, status, _ = asyncio.run(generate_2fa.handle_async(json.dumps({"username": "ghost"})))
+
+    assert status == 404
+    cursor.executemany.assert_not_awaited()
+    connection.rollback.assert_awaited_once()
+    connection.commit.assert_not_awaited()
+    mock_submit.assert_not_called()
+
+
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_handle_async_replays_an_idempotent_request(mock_submit, async_db):
+    _, _, cursor = async_db
+    req = json.dumps({"username": "testuser"})
+
+    async def scenario():
+        first = await generate_2fa.handle_async(req, headers={"idempotency-key": "retry-1"})
+        retry = await generate_2fa.handle_async(req, headers={"idempotency-key": "retry-1"})
+        other = await generate_2fa.handle_async(json.dumps({"username": "other"}), headers={"idempotency-key": "retry-1"})
+        return first, retry, other
+
+    first, retry, other = asyncio.run(scenario())
+
+    assert retry[:2] == first[:2]
+    assert retry[2]["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first[2]
+    assert mock_submit.call_count == 1
+    assert [c.args[0] for c in cursor.execute.await_args_list].count(generate_2fa.UPDATE_MFA_SQL) == 1
+    assert other[1] == 422
+
+
+@mock.patch.dict(os.environ, {"REQUEST_METHOD": "POST"})
+@mock.patch("generate_2fa.provision")
+def test_handle_coalesces_concurrent_duplicates(mock_provision):
+    started = threading.Event()
+    release = threading.Event()
+
+    def provision(username):
+        started.set()
+        release.wait(5)
+        return json.dumps({"status": "ok"}), 200
+
+    mock_provision.side_effect = provision
+    app = Flask(__name__)
+    statuses = []
+
+    def call():
+        with app.test_request_context("/", method="POST", headers={"Idempotency-Key": "dup"}):
+            resp = generate_2fa.handle(json.dumps({"username": "testuser"}))
+            statuses.append((resp.status_code, resp.headers.get("Idempotent-Replayed")))
+
+    first = threading.Thread(target=call)
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=call)
+    second.start()
+    while idempotency.get_store().stats()["coalesced"] < 1:
+        time.sleep(0.01)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    mock_provision.assert_called_once_with("testuser")
+    assert len(statuses) == 2
+    assert set(statuses) == {(200, None), (200, "true")}
+
 
-# -------------------- CLEANUP --------------------
+@mock.patch.dict(os.environ, {"REQUEST_METHOD": "OPTIONS"})
+def test_preflight_allows_the_idempotency_key():
+    with Flask(__name__).test_request_context("/", method="OPTIONS"):
+        resp = generate_2fa.handle("")
+    assert resp.status_code == 204
+    assert "Idempotency-Key" in resp.headers["Access-Control-Allow-Headers"]
 
-def teardown_module(module):
-    shutil.rmtree(temp_qr_dir)
+    _, status, headers = asyncio.run(generate_2fa.handle_async("", method="OPTIONS"))
+    assert status == 204
+    assert "Idempotency-Key" in headers["Access-Control-Allow-Headers"]
@@ -1,31 +1,21 @@
+import asyncio
 import importlib.util
 import os
-import tempfile
-import shutil
 import sys
+import time
 import json
 from unittest import mock
+from flask import Flask
 
-# Create a temporary directory for QR codes
-temp_dir = tempfile.mkdtemp()
+import pytest
 
-# Prepare import without executing it yet
+# Load handler (no import-time side effects: QR codes are persisted by common.artifacts)
 handler_path = os.path.abspath("generate-password/handler.py")
 spec = importlib.util.spec_from_file_location("generate_password", handler_path)
 generate_password = importlib.util.module_from_spec(spec)
-
-# Inject safe QR_DIR BEFORE loading module
 sys.modules["generate_password"] = generate_password
-generate_password.QR_DIR = temp_dir
-
-# Patch os.makedirs to skip the unsafe call inside the module
-original_makedirs = os.makedirs
-os.makedirs = lambda path, exist_ok=False: None
 spec.loader.exec_module(generate_password)
 
-# Restore os.makedirs for normal usage
-os.makedirs = original_makedirs
-
 # -------------------- TESTS --------------------
 
 def test_generate_strong_password_length():
@@ -40,10 +30,10 @@ def test_generate_strong_password_length():
     "DB_PASSWORD": "test",
     "DB_NAME": "test_db"
 })
-@mock.patch("generate_password.pymysql.connect")
-@mock.patch("generate_password.qrcode.make")
+@mock.patch("common.pool.pymysql.connect")
+@mock.patch("common.artifacts.BackgroundWriter.submit")
 @mock.patch("generate_password.make_response")
-def test_handle_success(mock_make_response, mock_qrcode, mock_connect):
+def test_handle_success(mock_make_response, mock_submit, mock_connect):
     # Setup mocks
     mock_conn = mock.MagicMock()
     mock_cursor = mock.MagicMock()
@@ -51,11 +41,6 @@ def test_handle_success(mock_make_response, mock_qrcode, mock_connect):
     mock_conn.cursor.return_value = mock_cursor
     mock_cursor.fetchone.return_value = None 
 
-    # Fake QR
-    mock_qr = mock.MagicMock()
-    mock_qrcode.return_value = mock_qr
-    mock_qr.save.return_value = None
-
     # Mock request and response
     mock_request = mock.Mock()
     mock_request.method = "POST"
@@ -70,6 +55,7 @@ def test_handle_success(mock_make_response, mock_qrcode, mock_connect):
     # Assertions
     assert resp.headers["Access-Control-Allow-Origin"] == "*"
     mock_make_response.assert_called()
+    assert mock_submit.call_args.args[0] == "testuser_pwd_qr.png"
 
 
 @mock.patch("generate_password.make_response")
@@ -96,8 +82,145 @@ def test_handle_invalid_json(mock_make_response):
         response_body = mock_make_response.call_args[0][0]
         assert "status" in response_body
 
-# -------------------- CLEANUP --------------------
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_store_passwords_single_upsert(mock_connect):
+    mock_conn = mock_connect.return_value
+    mock_cursor = mock.MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+    generate_password.store_passwords([("alice", "cA=="), ("bob", "cB==")])
+
+    mock_conn.begin.assert_called_once()
+    mock_conn.commit.assert_called_once()
+    sql, rows = mock_cursor.executemany.call_args_list[0].args
+    assert sql == generate_password.UPSERT_USER_SQL
+    assert "ON DUPLICATE KEY UPDATE" in sql
+    assert [row[:3] for row in rows] == [("alice", "cA==", ""), ("bob", "cB==", "")]
+
+
+def test_hash_credentials_stores_salted_hashes():
+    stored = generate_password.hash_credentials(["alice", "bob"], ["pw-a", "pw-a"])
+
+    assert [u for u, _ in stored] == ["alice", "bob"]
+    assert stored[0][1] != stored[1][1]
+    hashing = generate_password.hashing
+    assert all(hashing.verify("pw-a", hashing.PasswordHash.parse(h)) for _, h in stored)
+
+
+@mock.patch("generate_password.store_passwords", side_effect=ConnectionError("db down"))
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_failed_write_leaves_no_artifact(mock_submit, mock_store):
+    with pytest.raises(ConnectionError):
+        generate_password.provision({"username": "alice"})
+    mock_submit.assert_not_called()
+
+
+@mock.patch("generate_password.store_passwords")
+def test_bulk_hashing_stops_before_the_deadline(mock_store):
+    batches = []
+
+    def slow_batch(passwords):
+        batches.append(len(passwords))
+        time.sleep(0.04)
+        return ["h"] * len(passwords)
+
+    usernames = [f"user{i}" for i in range(generate_password.HASH_BATCH_SIZE * 5)]
+    token = generate_password.deadline.start(0.1)
+    try:
+        with mock.patch.object(generate_password.hashing, "hash_passwords", side_effect=slow_batch), \
+                pytest.raises(generate_password.deadline.DeadlineExceeded):
+            generate_password.handle_bulk(usernames)
+    finally:
+        generate_password.deadline.reset(token)
+
+    # ~40 ms a batch: the third would not fit, nothing is written
+    assert len(batches) == 2
+    mock_store.assert_not_called()
+
+
+@mock.patch("generate_password.store_passwords")
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+@mock.patch("generate_password.make_response")
+def test_handle_bulk(mock_make_response, mock_submit, mock_store):
+    mock_make_response.return_value = mock.Mock(headers={})
+    mock_request = mock.Mock()
+    mock_request.method = "POST"
+
+    with mock.patch("generate_password.request", mock_request):
+        generate_password.handle(json.dumps({"usernames": ["alice", "bob", "alice"]}))
+
+    mock_store.assert_called_once()
+    assert [u for u, _ in mock_store.call_args.args[0]] == ["alice", "bob"]
+    body = json.loads(mock_make_response.call_args.args[0])
+    assert [r["username"] for r in body["results"]] == ["alice", "bob"]
+
+
+@mock.patch("generate_password.make_response")
+def test_handle_bulk_invalid_list(mock_make_response):
+    mock_request = mock.Mock()
+    mock_request.method = "POST"
+
+    with mock.patch("generate_password.request", mock_request):
+        generate_password.handle(json.dumps({"usernames": ["alice", ""]}))
+
+    assert mock_make_response.call_args.args[1] == 400
+
+
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_handle_async_bulk(mock_submit, async_db):
+    _, connection, cursor = async_db
+
+    req = json.dumps({"usernames": ["alice", "bob", "alice"]})
+    body, status, headers = asyncio.run(generate_password.handle_async(req))
+
+    assert status == 200
+    assert headers["Access-Control-Allow-Origin"] == "*"
+    assert [r["username"] for r in json.loads(body)["results"]] == ["alice", "bob"]
+    connection.begin.assert_awaited_once()
+    connection.commit.assert_awaited_once()
+    assert cursor.executemany.await_args_list[0].args[0] == generate_password.UPSERT_USER_SQL
+    assert [name for name, _ in (c.args for c in mock_submit.call_args_list)] == ["alice_pwd_qr.png", "bob_pwd_qr.png"]
+
+
+def test_handle_async_preflight():
+    body, status, headers = asyncio.run(generate_password.handle_async("", method="OPTIONS"))
+    assert status == 204
+    assert headers["Access-Control-Allow-Methods"] == "GET, POST, OPTIONS"
+    assert "Idempotency-Key" in headers["Access-Control-Allow-Headers"]
+
+
+def test_handle_preflight_allows_the_idempotency_key():
+    with Flask(__name__).test_request_context("/", method="OPTIONS"):
+        resp = generate_password.handle("")
+    assert resp.status_code == 204
+    assert "Idempotency-Key" in resp.headers["Access-Control-Allow-Headers"]
+
+
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_handle_async_bulk_replay(mock_submit, async_db):
+    _, connection, _ = async_db
+    req = json.dumps({"usernames": ["alice", "bob"], "idempotency_key": "batch-7"})
+
+    async def scenario():
+        return [await generate_password.handle_async(req) for _ in range(2)]
+
+    first, retry = asyncio.run(scenario())
+
+    assert retry[:2] == first[:2]
+    assert retry[2]["Idempotent-Replayed"] == "true"
+    assert mock_submit.call_count == 2
+    connection.commit.assert_awaited_once()
 
 
-def teardown_module(module):
-    shutil.rmtree(temp_dir)
+def test_handle_async_rejects_an_invalid_key():
+    req = json.dumps({"username": "alice", "idempotency_key": ""})
+    body, status, _ = asyncio.run(generate_password.handle_async(req))
+    assert status == 400
+    assert "idempotency key" in json.loads(body)["message"]
@@ -1,8 +1,10 @@
+import asyncio
 import importlib.util
 import os
 import sys
 import json
 from unittest import mock
+from flask import Flask
 
 # Load the handler module safely
 handler_path = os.path.abspath("get-users/handler.py")
@@ -19,7 +21,7 @@ spec.loader.exec_module(get_users)
     "DB_PASSWORD": "test",
     "DB_NAME": "test_db"
 })
-@mock.patch("get_users.pymysql.connect")
+@mock.patch("common.pool.pymysql.connect")
 def test_get_users_success(mock_connect):
     # Mock DB connection and cursor
     mock_conn = mock.MagicMock()
@@ -43,3 +45,178 @@ def test_get_users_success(mock_connect):
     assert isinstance(parsed, list)
     assert parsed[0]["username"] == "alice"
     assert parsed[1]["username"] == "bob"
+
+
+DB_ENV = {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+}
+
+
+def mock_db(mock_connect):
+    mock_conn = mock.MagicMock()
+    mock_cursor = mock.MagicMock()
+    mock_connect.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    return mock_cursor
+
+
+def mock_conn_cursor_class(mock_connect):
+    return mock_connect.return_value.cursor.call_args.args[0]
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_get_users_paginated(mock_connect):
+    mock_cursor = mock_db(mock_connect)
+    mock_cursor.fetchall.return_value = [{"id": 11, "username": "a"}, {"id": 12, "username": "b"}, {"id": 13, "username": "c"}]
+
+    with Flask(__name__).test_request_context("/?limit=2&after=10"):
+        resp = get_users.handle(None)
+        result = json.loads(resp.get_data(as_text=True))
+
+    mock_cursor.execute.assert_called_once_with(
+        get_users.PAGE_SQL, (10, 3)
+    )
+    assert [u["username"] for u in result["users"]] == ["a", "b"]
+    assert result["next_cursor"] == 12
+    assert "db_query;dur=" in resp.headers["Server-Timing"]
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_get_users_last_page_has_no_cursor(mock_connect):
+    mock_cursor = mock_db(mock_connect)
+    mock_cursor.fetchall.return_value = [{"id": 13, "username": "c"}]
+
+    with Flask(__name__).test_request_context("/?limit=2&after=12"):
+        result = json.loads(get_users.handle(None).get_data(as_text=True))
+
+    assert result["next_cursor"] is None
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_get_users_stream_json(mock_connect):
+    mock_cursor = mock_db(mock_connect)
+    mock_cursor.fetchmany.side_effect = [[{"id": 1}, {"id": 2}], [{"id": 3}], []]
+
+    with Flask(__name__).test_request_context("/?stream=json"):
+        resp = get_users.handle(None)
+        body = "".join(resp.response)
+
+    assert resp.mimetype == "application/json"
+    assert json.loads(body) == [{"id": 1}, {"id": 2}, {"id": 3}]
+    assert mock_conn_cursor_class(mock_connect) is get_users.pymysql.cursors.SSDictCursor
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_get_users_stream_ndjson(mock_connect):
+    mock_cursor = mock_db(mock_connect)
+    mock_cursor.fetchmany.side_effect = [[{"id": 1}, {"id": 2}], []]
+
+    with Flask(__name__).test_request_context("/?stream=ndjson"):
+        resp = get_users.handle(None)
+        lines = "".join(resp.response).splitlines()
+
+    assert resp.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in lines] == [{"id": 1}, {"id": 2}]
+
+
+def test_handle_async_page(async_db):
+    _, _, cursor = async_db
+    cursor.fetchall.return_value = [{"id": 1}, {"id": 2}, {"id": 3}]
+
+    body, status, _ = asyncio.run(get_users.handle_async(None, query={"limit": "2", "after": "0"}))
+
+    assert status == 200
+    assert json.loads(body) == {"users": [{"id": 1}, {"id": 2}], "next_cursor": 2}
+    cursor.execute.assert_awaited_once_with(get_users.PAGE_SQL, (0, 3))
+
+
+def test_handle_async_stream_ndjson(async_db):
+    _, _, cursor = async_db
+    cursor.fetchmany.side_effect = [[{"id": 1}, {"id": 2}], []]
+
+    async def collect():
+        body, status, headers = await get_users.handle_async(None, query={"stream": "ndjson"})
+        assert headers["Content-Type"] == "application/x-ndjson"
+        return "".join([chunk async for chunk in body])
+
+    assert asyncio.run(collect()) == '{"id":1}\n{"id":2}\n'
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_listing_is_revalidated_with_etag(mock_connect):
+    get_users.reset_listing()
+    mock_cursor = mock_db(mock_connect)
+    mock_cursor.fetchone.return_value = (7, 1700000000)
+    mock_cursor.fetchall.return_value = [{"id": 1, "username": "alice"}]
+    app = Flask(__name__)
+
+    with app.test_request_context("/"):
+        first = get_users.handle(None)
+    etag = first.headers["ETag"]
+    with app.test_request_context("/", headers={"If-None-Match": etag}):
+        unchanged = get_users.handle(None)
+    with app.test_request_context("/"):
+        cached = get_users.handle(None)
+
+    assert first.status_code == 200
+    assert json.loads(first.get_data(as_text=True)) == [{"id": 1, "username": "alice"}]
+    assert etag == '"users-7-1700000000"'
+    assert unchanged.status_code == 304
+    assert unchanged.get_data() == b""
+    assert cached.get_data() == first.get_data()
+    listing_queries = [c for c in mock_cursor.execute.call_args_list if c.args[0] == get_users.LIST_SQL]
+    assert len(listing_queries) == 1
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_listing_is_rebuilt_after_a_write(mock_connect):
+    get_users.reset_listing()
+    mock_cursor = mock_db(mock_connect)
+    # Each rebuild reads the version again, on the connection that reads the rows
+    mock_cursor.fetchone.side_effect = [(7, 1700000000), (7, 1700000000), (8, 1700000060), (8, 1700000060)]
+    mock_cursor.fetchall.side_effect = [[{"id": 1}], [{"id": 1}, {"id": 2}]]
+    app = Flask(__name__)
+
+    with app.test_request_context("/"):
+        first = get_users.handle(None)
+    with app.test_request_context("/", headers={"If-None-Match": first.headers["ETag"]}):
+        second = get_users.handle(None)
+
+    assert second.status_code == 200
+    assert second.headers["ETag"] == '"users-8-1700000060"'
+    assert json.loads(second.get_data(as_text=True)) == [{"id": 1}, {"id": 2}]
+
+
+def test_handle_async_not_modified(async_db):
+    get_users.reset_listing()
+    _, _, cursor = async_db
+    cursor.fetchone.return_value = (3, 1700000000)
+
+    body, status, headers = asyncio.run(
+        get_users.handle_async(None, headers={"if-none-match": 'W/"users-3-1700000000"'})
+    )
+
+    assert (body, status) == ("", 304)
+    assert headers["ETag"] == '"users-3-1700000000"'
+    cursor.fetchall.assert_not_awaited()
+
+
+def test_listing_leaves_internal_columns_out(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "users.db"))
+    with get_users.pool.get_pool().connection() as conn, conn.cursor() as cursor:
+        cursor.execute("INSERT INTO users (username, password, mfa, gendate, expired) VALUES ('alice', 'pw', '', 1721916574, 0)")
+
+    columns = {"id", "username", "password", "mfa", "gendate", "expired"}
+    assert set(json.loads(get_users.list_users())[0]) == columns
+    assert set(get_users.fetch_page(0, 10, None)["users"][0]) == columns
+    assert set(json.loads("".join(get_users.stream_users("json")))[0]) == columns
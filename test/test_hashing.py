@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import pytest
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from common import breaker, deadline, hashing
+
+# -------------------- TESTS --------------------
+
+
+def test_hash_round_trip():
+    stored = hashing.hash_password("s3cret!")
+
+    assert hashing.is_hash(stored)
+    assert stored.startswith("$scrypt$ln=10,r=8,p=1$")
+    verifier = hashing.PasswordHash.parse(stored)
+    assert verifier.encoded == stored
+    assert hashing.verify("s3cret!", verifier)
+    assert not hashing.verify("s3cret?", verifier)
+
+
+def test_salts_are_unique():
+    first, second = hashing.hash_passwords(["same", "same"])
+    assert first != second
+
+
+def test_malformed_hash_is_rejected():
+    with pytest.raises(ValueError):
+        hashing.PasswordHash.parse("$scrypt$ln=10$abc")
+
+
+def test_legacy_plaintext_verifier():
+    assert not hashing.is_hash("cmVhbHBhc3M=")
+    assert hashing.verify("realpass", "realpass")
+    assert not hashing.verify("realpas", "realpass")
+    assert hashing.needs_rehash("realpass")
+
+
+def test_needs_rehash_only_below_current_cost(monkeypatch):
+    weak = hashing.PasswordHash(hashing.ScryptParams(10), b"salt", b"digest")
+    strong = hashing.PasswordHash(hashing.ScryptParams(12), b"salt", b"digest")
+    monkeypatch.setenv("PASSWORD_HASH_LN", "11")
+    hashing.reset_pool()
+
+    assert hashing.needs_rehash(weak)
+    assert not hashing.needs_rehash(strong)
+
+
+def test_calibrate_stays_within_bounds():
+    params = hashing.calibrate(target_ms=0.001, max_ln=12)
+    assert params.ln == 10
+    assert hashing.calibrate(target_ms=10 ** 6, max_ln=11).ln == 11
+
+
+def test_verify_many_mixes_hashes_and_legacy():
+    stored = hashing.PasswordHash.parse(hashing.hash_password("pw"))
+    pairs = [("pw", stored), ("nope", stored), ("pw", "pw")]
+
+    assert hashing.verify_many(pairs) == [True, False, True]
+    assert asyncio.run(hashing.verify_many_async(pairs)) == [True, False, True]
+
+
+def test_saturated_pool_rejects():
+    blocker = threading.Event()
+
+    class Stalled:
+        def submit(self, *args):
+            future = Future()
+            threading.Thread(target=lambda: (blocker.wait(), future.set_result(b""))).start()
+            return future
+
+    busy = hashing.HashingPool(Stalled(), max_pending=1, queue_timeout=0.01)
+    params = hashing.ScryptParams(10)
+    busy.submit("a", b"salt", params)
+    with pytest.raises(hashing.HashingBusy):
+        busy.submit("b", b"salt", params)
+    with pytest.raises(hashing.HashingBusy):
+        asyncio.run(busy.submit_async("c", b"salt", params))
+    blocker.set()
+
+    assert busy.stats()["rejected"] == 2
+
+
+def test_batches_leave_slots_to_single_logins():
+    blocker = threading.Event()
+
+    class Stalled:
+        def submit(self, *args):
+            future = Future()
+            threading.Thread(target=lambda: (blocker.wait(), future.set_result(b""))).start()
+            return future
+
+    shared = hashing.HashingPool(Stalled(), max_pending=4, queue_timeout=0.01)
+    params = hashing.ScryptParams(10)
+    try:
+        for _ in range(shared.max_batch_pending):
+            shared.submit("bulk", b"salt", params, batch=True)
+        token = deadline.start(0.05)
+        try:
+            with pytest.raises(deadline.DeadlineExceeded):
+                shared.submit("bulk", b"salt", params, batch=True)
+        finally:
+            deadline.reset(token)
+        shared.submit("login", b"salt", params)
+        assert shared.stats()["in_flight"] == 3
+    finally:
+        blocker.set()
+
+
+def test_busy_pool_is_answered_with_503():
+    assert breaker.unavailable(hashing.HashingBusy("saturated"))[2:] == (503, {"Retry-After": "1"})
+
+
+def test_process_pool_runs_scrypt(monkeypatch):
+    monkeypatch.setenv("HASH_EXECUTOR", "process")
+    monkeypatch.setenv("HASH_WORKERS", "1")
+    hashing.reset_pool()
+
+    stored = hashing.hash_password("pw")
+
+    assert isinstance(hashing.get_pool().executor, ProcessPoolExecutor)
+    assert hashing.verify("pw", hashing.PasswordHash.parse(stored))
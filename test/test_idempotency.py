@@ -0,0 +1,172 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from common import deadline, idempotency, metrics
+
+# -------------------- TESTS --------------------
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_replays_the_stored_response():
+    store = idempotency.IdempotencyStore()
+    calls = []
+
+    def execute():
+        calls.append(1)
+        return '{"n": 1}', 200
+
+    assert store.run("k", "fp", execute) == (('{"n": 1}', 200), False)
+    assert store.run("k", "fp", execute) == (('{"n": 1}', 200), True)
+    assert len(calls) == 1
+    assert store.stats()["replays"] == 1
+
+
+def test_key_reused_with_another_request_is_refused():
+    store = idempotency.IdempotencyStore()
+    store.run("k", "fp", lambda: ("{}", 200))
+    with pytest.raises(idempotency.KeyConflict):
+        store.run("k", "other", lambda: ("{}", 200))
+
+
+def test_failures_are_not_stored():
+    store = idempotency.IdempotencyStore()
+    assert store.run("k", "fp", lambda: ("{}", 503)) == (("{}", 503), False)
+    with pytest.raises(RuntimeError):
+        store.run("k", "fp", lambda: (_ for _ in ()).throw(RuntimeError("boom")))
+    assert store.run("k", "fp", lambda: ("{}", 200)) == (("{}", 200), False)
+
+
+def test_entries_expire_and_are_bounded():
+    clock = Clock()
+    store = idempotency.IdempotencyStore(max_size=2, max_bytes=10, ttl=60, clock=clock)
+    store.run("a", "fp", lambda: ("aaaa", 200))
+    store.run("b", "fp", lambda: ("bbbb", 200))
+    store.run("c", "fp", lambda: ("cccc", 200))
+    assert store.stats()["size"] == 2
+    assert store.run("a", "fp", lambda: ("new", 200)) == (("new", 200), False)
+
+    store.run("big", "fp", lambda: ("x" * 11, 200))
+    assert store.stats()["bytes"] <= 10
+
+    clock.now = 61
+    assert store.run("a", "fp", lambda: ("newer", 200)) == (("newer", 200), False)
+    assert store.stats()["expirations"] == 1
+
+
+def test_concurrent_duplicates_share_one_execution():
+    store = idempotency.IdempotencyStore()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def execute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "{}", 200
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.run("k", "fp", execute))) for _ in range(4)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while store.stats()["coalesced"] < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(replayed for _, replayed in results) == [False, True, True, True]
+
+
+def test_waiter_runs_again_when_the_execution_raises():
+    store = idempotency.IdempotencyStore()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.05)
+        raise RuntimeError("database down")
+
+    def first():
+        with pytest.raises(RuntimeError):
+            store.run("k", "fp", failing)
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    assert started.wait(5)
+    assert store.run("k", "fp", lambda: ("{}", 200)) == (("{}", 200), False)
+    thread.join(5)
+
+
+def test_waiting_is_bounded_by_the_deadline():
+    store = idempotency.IdempotencyStore()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "{}", 200
+
+    thread = threading.Thread(target=store.run, args=("k", "fp", slow))
+    thread.start()
+    assert started.wait(5)
+    token = deadline.start(0.05)
+    try:
+        with pytest.raises(deadline.DeadlineExceeded):
+            store.run("k", "fp", slow)
+    finally:
+        deadline.reset(token)
+        release.set()
+        thread.join(5)
+
+
+def test_async_duplicates_share_one_execution():
+    store = idempotency.IdempotencyStore()
+    calls = []
+
+    async def execute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "{}", 200
+
+    async def scenario():
+        return await asyncio.gather(*(store.run_async("k", "fp", execute) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert [replayed for _, replayed in results].count(False) == 1
+
+
+def test_request_key():
+    assert idempotency.request_key({"username": "alice"}, {}) is None
+    assert idempotency.request_key({}, {"idempotency-key": "abc"}) == "abc"
+    assert idempotency.request_key({"idempotency_key": "abc"}, {}) == "abc"
+    with pytest.raises(idempotency.InvalidKey):
+        idempotency.request_key({"idempotency_key": 12}, {})
+    with pytest.raises(idempotency.InvalidKey):
+        idempotency.request_key({}, {"idempotency-key": "x" * 256})
+    assert idempotency.fingerprint({"username": "a", "idempotency_key": "1"}) == idempotency.fingerprint({"username": "a"})
+
+
+def test_call_namespaces_keys_and_exports_metrics():
+    assert idempotency.call("generate-2fa", "k", {}, lambda: ("2fa", 200)) == (("2fa", 200), False)
+    assert idempotency.call("generate-password", "k", {}, lambda: ("pwd", 200)) == (("pwd", 200), False)
+    assert idempotency.call("generate-2fa", None, {}, lambda: ("again", 200)) == (("again", 200), False)
+
+    exposition = metrics.REGISTRY.render()
+    assert "cofrap_idempotency_entries 2" in exposition
+    assert 'cofrap_idempotency_events_total{event="executions"} 2' in exposition
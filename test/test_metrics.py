@@ -0,0 +1,62 @@
+import time
+from flask import Flask
+
+from common import metrics
+
+# -------------------- TESTS --------------------
+
+
+def test_histogram_buckets():
+    h = metrics.Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3):
+        h.observe(value)
+    assert h.counts == [2, 1, 1]
+    assert h.count == 4
+
+
+def test_server_timing_merges_phases():
+    header = metrics.server_timing([("db_query", 0.001), ("totp_verify", 0.0005), ("db_query", 0.002)], 0.004)
+    assert header == "db_query;dur=3.000, totp_verify;dur=0.500, total;dur=4.000"
+
+
+def test_render_prometheus():
+    registry = metrics.Registry()
+    registry.inc("cofrap_requests_total", (("function", "f"), ("code", "200")))
+    registry.observe("cofrap_phase_duration_seconds", (("function", "f"), ("phase", "db_query")), 0.002)
+    registry.register_collector(lambda: [("cofrap_test_gauge", "gauge", "A gauge.", [((("state", "idle"),), 3)])])
+
+    text = registry.render()
+
+    assert '# TYPE cofrap_requests_total counter' in text
+    assert 'cofrap_requests_total{function="f",code="200"} 1' in text
+    assert 'cofrap_phase_duration_seconds_bucket{function="f",phase="db_query",le="0.0025"} 1' in text
+    assert 'cofrap_phase_duration_seconds_bucket{function="f",phase="db_query",le="+Inf"} 1' in text
+    assert 'cofrap_test_gauge{state="idle"} 3' in text
+
+
+@metrics.instrumented("test-fn")
+def handle(req):
+    with metrics.phase("work"):
+        time.sleep(0.001)
+    return '{"status": "ok"}'
+
+
+def test_instrumented_adds_server_timing():
+    with Flask(__name__).test_request_context("/", method="POST"):
+        resp = handle("{}")
+    assert resp.get_data(as_text=True) == '{"status": "ok"}'
+    assert resp.headers["Server-Timing"].startswith("work;dur=")
+
+
+def test_instrumented_outside_http_keeps_body():
+    assert handle("{}") == '{"status": "ok"}'
+
+
+def test_metrics_endpoint():
+    handle("{}")
+    with Flask(__name__).test_request_context("/metrics", method="GET"):
+        resp = handle(None)
+    body = resp.get_data(as_text=True)
+    assert resp.headers["Content-Type"].startswith("text/plain")
+    assert 'cofrap_phase_duration_seconds_count{function="test-fn",phase="work"}' in body
+    assert 'cofrap_request_duration_seconds_count{function="test-fn"}' in body
@@ -0,0 +1,76 @@
+import importlib.util
+import os
+import sys
+import pytest
+from unittest import mock
+
+# Load the migration runner
+migrate_path = os.path.abspath("sql/migrate.py")
+spec = importlib.util.spec_from_file_location("migrate", migrate_path)
+migrate = importlib.util.module_from_spec(spec)
+sys.modules["migrate"] = migrate
+spec.loader.exec_module(migrate)
+
+# -------------------- TESTS --------------------
+
+
+def test_split_statements_ignores_comments():
+    sql = "-- header\nCREATE TABLE a (x INT);\n\n-- second\nCREATE INDEX i ON a (x);\n"
+    assert migrate.split_statements(sql) == ["CREATE TABLE a (x INT)", "CREATE INDEX i ON a (x)"]
+
+
+def test_shipped_migrations_are_ordered():
+    versions = [version for version, _, _ in migrate.load_migrations()]
+    assert versions == sorted(versions)
+    assert versions[:2] == [1, 2]
+
+
+def test_duplicate_users_are_archived_before_removal():
+    _, _, statements = migrate.load_migrations()[0]
+    archive = next(i for i, stmt in enumerate(statements) if stmt.startswith("INSERT IGNORE INTO users_duplicates_archive"))
+    delete = next(i for i, stmt in enumerate(statements) if stmt.startswith("DELETE"))
+    assert statements[0].startswith("CREATE TABLE IF NOT EXISTS users_duplicates_archive")
+    assert archive < delete
+
+
+def test_duplicate_versions_rejected(tmp_path):
+    (tmp_path / "001_a.sql").write_text("SELECT 1;")
+    (tmp_path / "1_b.sql").write_text("SELECT 2;")
+    with pytest.raises(ValueError):
+        migrate.load_migrations(str(tmp_path))
+
+
+def make_conn(applied):
+    conn = mock.MagicMock()
+    cursor = mock.MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    cursor.fetchone.return_value = (1,)
+    cursor.fetchall.return_value = [(v,) for v in applied]
+    return conn, cursor
+
+
+def test_migrate_applies_only_pending(tmp_path):
+    (tmp_path / "001_first.sql").write_text("CREATE TABLE a (x INT);")
+    (tmp_path / "002_second.sql").write_text("CREATE INDEX i ON a (x);")
+    conn, cursor = make_conn(applied=[1])
+
+    assert migrate.migrate(conn, str(tmp_path)) == [2]
+
+    executed = [c.args[0] for c in cursor.execute.call_args_list]
+    assert "CREATE TABLE a (x INT)" not in executed
+    assert "CREATE INDEX i ON a (x)" in executed
+    assert cursor.execute.call_args_list[-1].args[0] == "SELECT RELEASE_LOCK(%s)"
+
+
+def test_migrate_respects_target(tmp_path):
+    (tmp_path / "001_first.sql").write_text("CREATE TABLE a (x INT);")
+    (tmp_path / "002_second.sql").write_text("CREATE INDEX i ON a (x);")
+    conn, _ = make_conn(applied=[])
+    assert migrate.migrate(conn, str(tmp_path), target=1) == [1]
+
+
+def test_migrate_refuses_without_lock(tmp_path):
+    conn, cursor = make_conn(applied=[])
+    cursor.fetchone.return_value = (0,)
+    with pytest.raises(RuntimeError):
+        migrate.migrate(conn, str(tmp_path))
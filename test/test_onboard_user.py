@@ -0,0 +1,114 @@
+import asyncio
+import base64
+import importlib.util
+import os
+import sys
+import json
+from unittest import mock
+
+import pyotp
+
+# Load handler (no import-time side effects: QR codes are persisted by common.artifacts)
+handler_path = os.path.abspath("onboard-user/handler.py")
+spec = importlib.util.spec_from_file_location("onboard_user", handler_path)
+onboard_user = importlib.util.module_from_spec(spec)
+sys.modules["onboard_user"] = onboard_user
+spec.loader.exec_module(onboard_user)
+
+# -------------------- TESTS --------------------
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+@mock.patch("onboard_user.make_response")
+def test_handle_success(mock_make_response, mock_submit, mock_connect):
+    mock_conn = mock.MagicMock()
+    mock_cursor = mock.MagicMock()
+    mock_connect.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_resp = mock.Mock()
+    mock_resp.headers = {}
+    mock_make_response.return_value = mock_resp
+
+    mock_request = mock.Mock()
+    mock_request.method = "POST"
+
+    with mock.patch("onboard_user.request", mock_request):
+        onboard_user.handle(json.dumps({"username": "alice"}))
+
+    body = json.loads(mock_make_response.call_args.args[0])
+    assert body["status"] == "ok"
+    assert body["qr_code_base64"].startswith("iVBORw0KGgo")  # PNG signature
+    assert body["code_mfa"].startswith("iVBORw0KGgo")
+    assert "Access-Control-Allow-Origin" in mock_resp.headers
+
+    # One connection, one transaction holding both credentials
+    assert mock_connect.call_count == 1
+    mock_conn.begin.assert_called_once()
+    mock_conn.commit.assert_called_once()
+    sql, (username, password_hash, mfa, _) = mock_cursor.execute.call_args_list[0].args
+    assert sql == onboard_user.ONBOARD_USER_SQL
+    assert username == "alice"
+    assert password_hash.startswith("$scrypt$")
+    assert len(base64.b64decode(mfa).decode()) == 32
+
+    names = [call.args[0] for call in mock_submit.call_args_list]
+    assert names == ["alice_pwd_qr.png", "alice_2fa.png"]
+
+
+def test_render_and_hash_renders_both_codes():
+    uri = pyotp.TOTP(pyotp.random_base32()).provisioning_uri(name="alice", issuer_name="Cofrap")
+    password_hash, password_qr, mfa_qr = onboard_user.render_and_hash("S3cret!password", uri)
+
+    assert onboard_user.hashing.verify("S3cret!password", onboard_user.hashing.PasswordHash.parse(password_hash))
+    assert password_qr.data != mfa_qr.data
+    assert password_qr.mimetype == mfa_qr.mimetype == "image/png"
+
+
+@mock.patch("onboard_user.make_response")
+def test_handle_missing_username(mock_make_response):
+    mock_request = mock.Mock()
+    mock_request.method = "POST"
+    mock_make_response.return_value = mock.Mock(headers={})
+
+    with mock.patch("onboard_user.request", mock_request):
+        onboard_user.handle(json.dumps({}))
+
+    assert "username is required" in mock_make_response.call_args.args[0]
+    assert mock_make_response.call_args.args[1] == 400
+
+
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_handle_async_success(mock_submit, async_db):
+    _, connection, cursor = async_db
+
+    body, status, headers = asyncio.run(onboard_user.handle_async(json.dumps({"username": "bob"})))
+
+    payload = json.loads(body)
+    assert status == 200
+    assert headers["Access-Control-Allow-Origin"] == "*"
+    assert payload["qr_code_base64"].startswith("iVBORw0KGgo")
+    assert payload["code_mfa"].startswith("iVBORw0KGgo")
+    connection.begin.assert_awaited_once()
+    connection.commit.assert_awaited_once()
+    assert cursor.execute.await_args_list[0].args[0] == onboard_user.ONBOARD_USER_SQL
+    assert [call.args[0] for call in mock_submit.call_args_list] == ["bob_pwd_qr.png", "bob_2fa.png"]
+
+
+@mock.patch("common.artifacts.BackgroundWriter.submit")
+def test_handle_async_nothing_persisted_on_failure(mock_submit, async_db):
+    _, connection, cursor = async_db
+    cursor.execute.side_effect = RuntimeError("write failed")
+
+    body, status, _ = asyncio.run(onboard_user.handle_async(json.dumps({"username": "bob"})))
+
+    assert status == 500
+    assert json.loads(body)["status"] == "error"
+    connection.commit.assert_not_awaited()
+    mock_submit.assert_not_called()
@@ -0,0 +1,83 @@
+import os
+import string
+from collections import Counter
+import pytest
+
+from common import passwords
+
+# -------------------- TESTS --------------------
+
+
+def test_rejection_sampling_is_unbiased():
+    # Every byte value once per block: the accepted ones must cover the alphabet evenly
+    generator = passwords.PasswordGenerator(
+        passwords.PasswordPolicy(length=1, classes=("lower", "upper", "digits", "punctuation"), required=()),
+        block_size=256,
+        urandom=lambda n: bytes(range(256)) * (n // 256 + 1),
+    )
+    counts = Counter(generator.generate(188 * 3))
+    assert len(generator.policy.alphabet) == 94
+    assert set(counts) == set(generator.policy.alphabet)
+    assert set(counts.values()) == {6}
+
+
+def test_required_classes_are_present():
+    generator = passwords.PasswordGenerator(passwords.PasswordPolicy(length=4))
+    for password in generator.generate(500):
+        assert len(password) == 4
+        assert any(c in string.ascii_lowercase for c in password)
+        assert any(c in string.ascii_uppercase for c in password)
+        assert any(c in string.digits for c in password)
+        assert any(c in string.punctuation for c in password)
+
+
+def test_ambiguous_characters_are_excluded():
+    policy = passwords.PasswordPolicy(length=64, classes=("lower", "upper", "digits"), exclude_ambiguous=True)
+    generated = "".join(passwords.PasswordGenerator(policy).generate(200))
+    assert not set(generated) & set(passwords.AMBIGUOUS)
+    assert set(generated) <= set(string.ascii_letters + string.digits)
+
+
+def test_passwords_are_distinct():
+    generated = passwords.PasswordGenerator().generate(10000)
+    assert len(generated) == 10000
+    assert len(set(generated)) == 10000
+
+
+def test_buffer_is_dropped_after_fork(monkeypatch):
+    calls = []
+
+    def urandom(n):
+        calls.append(n)
+        return os.urandom(n)
+
+    generator = passwords.PasswordGenerator(urandom=urandom)
+    generator.generate(1)
+    generator.generate(1)
+    assert len(calls) == 1  # second password served from the buffered block
+
+    monkeypatch.setattr(passwords.os, "getpid", lambda: -1)
+    generator.generate(1)
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"classes": ("emoji",)},
+    {"classes": ("lower",), "required": ("digits",)},
+    {"length": 2},
+])
+def test_invalid_policies(kwargs):
+    with pytest.raises(ValueError):
+        passwords.PasswordPolicy(**kwargs)
+
+
+def test_generator_from_env(monkeypatch):
+    monkeypatch.setenv("PASSWORD_LENGTH", "12")
+    monkeypatch.setenv("PASSWORD_CLASSES", "lower,digits")
+    passwords.reset_generator()
+    try:
+        password = passwords.get_generator().generate(1)[0]
+    finally:
+        passwords.reset_generator()
+    assert len(password) == 12
+    assert set(password) <= set(string.ascii_lowercase + string.digits)
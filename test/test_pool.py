@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+import pytest
+from unittest import mock
+
+from common import deadline, pool
+
+# -------------------- TESTS --------------------
+
+
+def make_pool(**kwargs):
+    connections = []
+
+    def connect():
+        conn = mock.MagicMock()
+        connections.append(conn)
+        return conn
+
+    return pool.ConnectionPool(connect, **kwargs), connections
+
+
+def test_connection_is_reused():
+    p, connections = make_pool()
+    with p.connection() as first:
+        pass
+    with p.connection() as second:
+        pass
+    assert first is second
+    assert len(connections) == 1
+    assert p.stats()["reused"] == 1
+
+
+def test_counters_are_exact_under_concurrency():
+    p, _ = make_pool(max_size=4)
+    borrows = 500
+
+    def borrow():
+        for _ in range(borrows):
+            with p.connection():
+                pass
+
+    threads = [threading.Thread(target=borrow) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = p.stats()
+    assert stats["created"] + stats["reused"] == 8 * borrows
+
+
+def test_connection_borrowed_during_close_is_closed_on_return():
+    p, connections = make_pool()
+    with p.connection():
+        with p.connection():
+            pass
+        p.close()
+        connections[1].close.assert_called_once()
+        connections[0].close.assert_not_called()
+    connections[0].close.assert_called_once()
+    assert p.stats()["size"] == 0
+
+
+def test_max_size_is_enforced():
+    p, _ = make_pool(max_size=1, acquire_timeout=0.05)
+    with p.connection():
+        with pytest.raises(pool.PoolExhausted):
+            with p.connection():
+                pass
+
+
+def test_waiter_gets_released_connection():
+    p, connections = make_pool(max_size=1, acquire_timeout=2)
+    borrowed = threading.Event()
+    got = []
+
+    def worker():
+        borrowed.wait()
+        with p.connection() as conn:
+            got.append(conn)
+
+    t = threading.Thread(target=worker)
+    t.start()
+    with p.connection():
+        borrowed.set()
+    t.join()
+    assert got == connections
+
+
+def test_old_connection_is_recycled():
+    p, connections = make_pool(max_lifetime=0)
+    with p.connection():
+        pass
+    with p.connection():
+        pass
+    assert len(connections) == 2
+    connections[0].close.assert_called_once()
+    assert p.stats()["recycled"] == 1
+
+
+def test_dead_idle_connection_is_replaced():
+    p, connections = make_pool(ping_interval=0)
+    with p.connection() as conn:
+        conn.ping.side_effect = ConnectionError("gone")
+    with p.connection() as conn:
+        assert conn is connections[1]
+    assert p.stats()["failed_checks"] == 1
+
+
+def test_broken_connection_is_discarded_on_error():
+    p, connections = make_pool()
+    with pytest.raises(RuntimeError):
+        with p.connection() as conn:
+            conn.rollback.side_effect = ConnectionError("gone")
+            raise RuntimeError("query failed")
+    assert p.stats()["size"] == 0
+    connections[0].close.assert_called_once()
+
+
+@mock.patch.dict(os.environ, {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+})
+@mock.patch("common.pool.pymysql.connect")
+def test_get_pool_is_shared(mock_connect):
+    with pool.get_pool().connection():
+        pass
+    with pool.get_pool().connection():
+        pass
+    mock_connect.assert_called_once()
+
+
+def test_prefill_opens_idle_connections():
+    p, connections = make_pool(max_size=3)
+    assert p.prefill(2) == 2
+    assert p.prefill(2) == 0
+    assert p.stats()["idle"] == 2
+    assert p.prefill(5) == 1
+    with p.connection() as conn:
+        pass
+    assert conn is connections[-1]
+    assert len(connections) == 3
+
+
+def test_borrow_caps_socket_timeouts_by_deadline():
+    p, connections = make_pool()
+    token = deadline.start(2)
+    try:
+        with p.connection() as conn:
+            assert 1.9 < conn._read_timeout <= 2
+            assert 1.9 < conn._write_timeout <= 2
+    finally:
+        deadline.reset(token)
+    with p.connection() as conn:
+        assert (conn._read_timeout, conn._write_timeout) == (10, 10)
+
+
+def test_spent_deadline_is_reported_as_such():
+    p, _ = make_pool()
+    token = deadline.start(0.001)
+    try:
+        with pytest.raises(deadline.DeadlineExceeded):
+            with p.connection():
+                time.sleep(0.002)
+                raise TimeoutError("timed out")
+        with pytest.raises(deadline.DeadlineExceeded):
+            with p.connection():
+                pass
+    finally:
+        deadline.reset(token)
+
+
+def test_waiting_past_the_deadline_is_reported_as_such():
+    p, _ = make_pool(max_size=1, acquire_timeout=5)
+    with p.connection():
+        token = deadline.start(0.05)
+        try:
+            with pytest.raises(deadline.DeadlineExceeded):
+                with p.connection():
+                    pass
+        finally:
+            deadline.reset(token)
+        with pytest.raises(pool.PoolExhausted):
+            p.acquire_timeout = 0.01
+            with p.connection():
+                pass
@@ -0,0 +1,61 @@
+import base64
+import io
+import pytest
+import qrcode
+
+from common import qr
+
+# -------------------- TESTS --------------------
+
+
+def test_png_render():
+    rendered = qr.QRRenderer().render("hello")
+    assert rendered.data.startswith(b"\x89PNG")
+    assert rendered.mimetype == "image/png"
+    assert base64.b64decode(rendered.base64()) == rendered.data
+
+
+def test_png_matches_legacy_qrcode_make():
+    buf = io.BytesIO()
+    qrcode.make("hello").save(buf, format="PNG")
+    assert qr.QRRenderer().render("hello").data == buf.getvalue()
+
+
+def test_fixed_mask_pattern():
+    rendered = qr.QRRenderer(mask_pattern=3).render("hello")
+    assert rendered.data.startswith(b"\x89PNG")
+
+
+def test_svg_render():
+    rendered = qr.QRRenderer(fmt="svg").render("hello")
+    assert b"<svg" in rendered.data
+    assert rendered.extension == "svg"
+
+
+def test_compression_level_changes_output_size():
+    fast = qr.QRRenderer(compress_level=0).render("hello")
+    small = qr.QRRenderer(compress_level=9).render("hello")
+    assert len(small.data) < len(fast.data)
+
+
+def test_invalid_options():
+    with pytest.raises(ValueError):
+        qr.QRRenderer(fmt="gif")
+    with pytest.raises(ValueError):
+        qr.QRRenderer(error_correction="Z")
+
+
+def test_save_writes_same_bytes(tmp_path):
+    rendered = qr.QRRenderer().render("hello")
+    path = rendered.save(str(tmp_path / "alice_2fa"))
+    assert path.endswith("alice_2fa.png")
+    with open(path, "rb") as f:
+        assert f.read() == rendered.data
+
+
+def test_render_cache():
+    renderer = qr.QRRenderer(cache_size=1)
+    first = renderer.render("a")
+    assert renderer.render("a").data is first.data
+    renderer.render("b")
+    assert renderer.render("a").data is not first.data
@@ -0,0 +1,146 @@
+import asyncio
+import os
+from unittest import mock
+
+from common import aiopool, credcache, pool, replicas
+
+DB_ENV = {
+    "DB_HOST": "primary",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db",
+    "DB_READ_HOSTS": "replica-a,replica-b:3307",
+}
+
+# -------------------- TESTS --------------------
+
+
+def make_set(**kwargs):
+    now = [0.0]
+    replica_set = replicas.ReplicaSet(
+        [replicas.Replica("a"), replicas.Replica("b")], clock=lambda: now[0], **kwargs
+    )
+    return replica_set, now
+
+
+def names(candidates):
+    return [replica.host for replica in candidates]
+
+
+def test_candidates_rotate_round_robin():
+    replica_set, _ = make_set()
+    assert names(replica_set.candidates()) == ["a", "b"]
+    assert names(replica_set.candidates()) == ["b", "a"]
+
+
+def test_failed_replica_is_retried_later():
+    replica_set, now = make_set(retry_interval=30)
+    replica_set.report_failure(replica_set.replicas[0])
+
+    assert names(replica_set.candidates()) == ["b"]
+    now[0] = 31
+    assert names(replica_set.candidates()) == ["b", "a"]
+
+
+def test_lagging_replica_waits_for_next_check():
+    replica_set, now = make_set(max_lag=5, check_interval=10)
+    lagging = replica_set.replicas[0]
+
+    assert not replica_set.report_lag(lagging, 12)
+    assert names(replica_set.candidates()) == ["b"]
+    now[0] = 10
+    assert replica_set.needs_check(lagging)
+    assert names(replica_set.candidates()) == ["b", "a"]
+    assert not replica_set.report_lag(lagging, None)  # replication stopped
+    assert replica_set.stats()["lagging"] == 2
+
+
+def test_recent_writes_read_from_primary():
+    replica_set, now = make_set(max_lag=5, check_interval=5)
+    replica_set.mark_written("alice")
+
+    assert names(replica_set.candidates(["bob", "alice"])) == []
+    assert names(replica_set.candidates(["bob"])) == ["a", "b"]
+    now[0] = 11
+    assert names(replica_set.candidates(["alice"])) == ["b", "a"]
+    assert replica_set.stats()["primary_recent_write"] == 1
+
+
+def test_lag_from_status():
+    assert replicas.lag_from_status(None) == 0.0
+    assert replicas.lag_from_status({"Seconds_Behind_Master": 3}) == 3.0
+    assert replicas.lag_from_status({"Seconds_Behind_Master": None}) is None
+
+
+def test_no_replicas_configured(monkeypatch):
+    monkeypatch.delenv("DB_READ_HOSTS", raising=False)
+    assert replicas.get_replicas() is None
+    assert replicas.staleness_window() == 0.0
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_read_connection_uses_a_fresh_replica(mock_connect):
+    cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchone.return_value = {"Seconds_Behind_Master": 0}
+
+    with pool.read_connection() as conn:
+        assert conn is mock_connect.return_value
+    with pool.read_connection():
+        pass
+
+    hosts = [c.kwargs["host"] for c in mock_connect.call_args_list]
+    assert hosts == ["replica-a", "replica-b"]
+    assert mock_connect.call_args.kwargs["port"] == 3307
+    cursor.execute.assert_called_with(replicas.LAG_SQL)
+    assert replicas.get_replicas().stats()["replica"] == 2
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_read_connection_falls_back_to_primary(mock_connect):
+    primary = mock.MagicMock()
+    lagging = mock.MagicMock()
+    lagging.cursor.return_value.__enter__.return_value.fetchone.return_value = {"Seconds_Behind_Master": 60}
+
+    def connect(host, **kwargs):
+        if host == "replica-a":
+            raise OSError("connection refused")
+        return lagging if host == "replica-b" else primary
+
+    mock_connect.side_effect = connect
+
+    with pool.read_connection() as conn:
+        assert conn is primary
+
+    stats = replicas.get_replicas().stats()
+    assert stats["failures"] == 1 and stats["lagging"] == 1 and stats["primary_fallback"] == 1
+    assert not any(state["usable"] for state in stats["replicas"].values())
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_credential_change_reads_own_write_from_primary(mock_connect):
+    replica_set = replicas.get_replicas()
+    credcache.publish_invalidations(mock.MagicMock(), ["alice"])
+
+    with pool.read_connection(["alice"]):
+        pass
+
+    assert mock_connect.call_args.kwargs["host"] == "primary"
+    assert replica_set.stats()["primary_recent_write"] == 1
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+def test_async_read_connection_uses_replica_pool(async_db):
+    db_pool, connection, cursor = async_db
+    cursor.fetchone.return_value = {"Seconds_Behind_Master": 1}
+
+    async def borrow():
+        async with aiopool.read_connection() as conn:
+            return conn
+
+    assert asyncio.run(borrow()) is connection
+    aiopool.create_pool_from_env.assert_awaited_once_with("replica-a", 3306)
+    cursor.execute.assert_awaited_once_with(replicas.LAG_SQL)
+    db_pool.release.assert_called_once_with(connection)
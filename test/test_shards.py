@@ -0,0 +1,172 @@
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import sqlite3
+import time
+
+import pyotp
+import pytest
+
+from common import aiopool, hashing, pool, shards
+
+
+def load_handler(directory, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.abspath(f"{directory}/handler.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+authenticate_user = load_handler("authenticate-user", "shards_authenticate_user")
+expire_credentials = load_handler("expire-credentials", "shards_expire_credentials")
+generate_password = load_handler("generate-password", "shards_generate_password")
+get_users = load_handler("get-users", "shards_get_users")
+
+USERNAMES = [f"user{i:02d}" for i in range(12)]
+
+
+@pytest.fixture
+def sharded(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    monkeypatch.setenv("DB_SHARDS", ",".join(f"{name}={tmp_path / name}.db" for name in "abc"))
+    return {name: tmp_path / f"{name}.db" for name in "abc"}
+
+
+def rows_of(path):
+    check = sqlite3.connect(path)
+    try:
+        return {row[0] for row in check.execute("SELECT username FROM users")}
+    finally:
+        check.close()
+
+
+def store(usernames, gendate=None):
+    credentials = [(username, hashing.hash_password("pw")) for username in usernames]
+    generate_password.store_passwords(credentials)
+    if gendate is not None:
+        for group in pool.group(usernames).values():
+            with pool.connection(group) as conn, conn.cursor() as cursor:
+                cursor.executemany("UPDATE users SET gendate = %s WHERE username = %s", [(gendate, u) for u in group])
+
+
+def walk_pages(fetch, limit):
+    seen = []
+    args = {"limit": limit}
+    while True:
+        page = fetch(*get_users.page_args(args))
+        seen += [row["username"] for row in page["users"]]
+        if page["next_cursor"] is None:
+            return seen
+        args = {"limit": limit, "after": page["next_cursor"]}
+
+
+# -------------------- TESTS --------------------
+
+
+def test_keys_are_spread_over_every_shard():
+    ring = shards.ShardMap([shards.Shard(name, name) for name in "abc"])
+    counts = {}
+    for i in range(3000):
+        owner = ring.owner(f"user{i}")
+        counts[owner.name] = counts.get(owner.name, 0) + 1
+    assert set(counts) == {"a", "b", "c"}
+    assert min(counts.values()) > 700
+
+
+def test_adding_a_shard_only_moves_keys_to_it():
+    before = shards.ShardMap([shards.Shard(name, name) for name in "abc"])
+    after = shards.ShardMap([shards.Shard(name, name) for name in "abcd"])
+    keys = [f"user{i}" for i in range(3000)]
+    moved = [key for key in keys if before.owner(key).name != after.owner(key).name]
+    assert all(after.owner(key).name == "d" for key in moved)
+    assert 450 < len(moved) < 1050
+
+
+def test_owner_of_requires_a_single_shard():
+    ring = shards.ShardMap([shards.Shard(name, name) for name in "abc"])
+    groups = ring.group(USERNAMES)
+    assert len(groups) > 1
+    name, keys = next(iter(groups.items()))
+    assert ring.owner_of(keys).name == name
+    with pytest.raises(ValueError):
+        ring.owner_of(USERNAMES)
+    with pytest.raises(ValueError):
+        ring.owner_of([])
+
+
+def test_shard_map_is_read_from_env(monkeypatch):
+    assert shards.get_shards() is None
+    monkeypatch.setenv("DB_SHARDS", "a=db-a:3307, db-b")
+    shard_map = shards.get_shards()
+    assert [(s.name, s.host, s.port) for s in shard_map.shards] == [("a", "db-a", 3307), ("db-b", "db-b", 3306)]
+    assert shards.get_shards() is shard_map
+    with pytest.raises(ValueError):
+        shards.ShardMap([shards.Shard("a", "x"), shards.Shard("a", "y")])
+
+
+def test_writes_and_logins_go_to_the_owning_shard(sharded):
+    store(USERNAMES)
+
+    groups = pool.group(USERNAMES)
+    for name, path in sharded.items():
+        assert rows_of(path) == set(groups.get(name, []))
+
+    secret = pyotp.random_base32()
+    username = USERNAMES[5]
+    with pool.connection((username,)) as conn, conn.cursor() as cursor:
+        cursor.execute("UPDATE users SET mfa = %s WHERE username = %s", (base64.b64encode(secret.encode()).decode(), username))
+    result = authenticate_user.authenticate_user(username, "pw", pyotp.TOTP(secret).now())
+    assert result["status"] == "success"
+    assert authenticate_user.fetch_users(USERNAMES).keys() == set(USERNAMES)
+
+
+def test_expiry_writes_span_shards(sharded):
+    store(USERNAMES, gendate=int(time.time()) - 200 * 24 * 3600)
+
+    assert authenticate_user.write_expired(USERNAMES[:6]) == 6
+    report = expire_credentials.sweep_expired(chunk_size=2)
+    assert report["rows_updated"] == 6
+    assert report["complete"]
+
+
+def test_get_users_merges_every_shard(sharded):
+    store(USERNAMES)
+
+    assert sorted(walk_pages(get_users.fetch_page, 5)) == sorted(USERNAMES)
+    assert len(walk_pages(get_users.fetch_page, 1)) == len(USERNAMES)
+    assert sorted(row["username"] for row in json.loads(get_users.list_users())) == sorted(USERNAMES)
+    streamed = json.loads("".join(get_users.stream_users("json")))
+    assert [row["username"] for row in streamed] == walk_pages(get_users.fetch_page, 5)
+
+
+def test_listing_tag_moves_with_any_shard(sharded):
+    store(USERNAMES[:1])
+    first, _ = get_users.conditional_listing(None)
+    store(USERNAMES[1:2])
+    second, body = get_users.conditional_listing(first)
+
+    assert second != first and body is not None
+    assert get_users.conditional_listing(second) == (second, None)
+
+
+def test_async_get_users_merges_every_shard(sharded):
+    store(USERNAMES)
+
+    async def scenario():
+        pages = []
+        args = {"limit": 4}
+        while True:
+            page = await get_users.fetch_page_async(*get_users.page_args(args))
+            pages += [row["username"] for row in page["users"]]
+            if page["next_cursor"] is None:
+                break
+            args = {"limit": 4, "after": page["next_cursor"]}
+        streamed = "".join([chunk async for chunk in get_users.stream_users_async("ndjson")])
+        await aiopool.close_pool()
+        return pages, [json.loads(line)["username"] for line in streamed.splitlines()]
+
+    pages, streamed = asyncio.run(scenario())
+    assert pages == streamed == walk_pages(get_users.fetch_page, 4)
+    assert sorted(pages) == sorted(USERNAMES)
@@ -0,0 +1,146 @@
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import sqlite3
+import time
+
+import pyotp
+import pytest
+
+from common import aiopool, deadline, hashing, pool, sqlite
+
+
+def load_handler(directory, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.abspath(f"{directory}/handler.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Under their own names, so that the mock.patch targets of the handler tests keep pointing at their modules
+authenticate_user = load_handler("authenticate-user", "sqlite_authenticate_user")
+expire_credentials = load_handler("expire-credentials", "sqlite_expire_credentials")
+get_users = load_handler("get-users", "sqlite_get_users")
+
+
+@pytest.fixture
+def sqlite_backend(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "cofrap.db"))
+    return tmp_path / "cofrap.db"
+
+
+def add_user(username, password, secret, gendate=None, expired=0):
+    with pool.get_pool().connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO users (username, password, mfa, gendate, expired) VALUES (%s, %s, %s, %s, %s)",
+            (username, hashing.hash_password(password), base64.b64encode(secret.encode()).decode(),
+             int(time.time()) if gendate is None else gendate, expired),
+        )
+
+
+# -------------------- TESTS --------------------
+
+
+def test_translate_upsert():
+    sql = "INSERT INTO users (username, password) VALUES (%s, %s) ON DUPLICATE KEY UPDATE password = VALUES(password)"
+    assert sqlite.translate(sql) == (
+        "INSERT INTO users (username, password) VALUES (?, ?) "
+        "ON CONFLICT(username) DO UPDATE SET password = excluded.password"
+    )
+
+
+def test_translate_update_limit_and_insert_ignore():
+    assert sqlite.translate("UPDATE users SET expired = 1 WHERE expired = 0 AND expires_at < %s LIMIT %s") == (
+        "UPDATE users SET expired = 1 WHERE rowid IN "
+        "(SELECT rowid FROM users WHERE expired = 0 AND expires_at < ? LIMIT ?)"
+    )
+    assert sqlite.translate("INSERT IGNORE INTO t (a) VALUES (%s)") == "INSERT OR IGNORE INTO t (a) VALUES (?)"
+
+
+def test_unknown_backend_is_rejected(monkeypatch):
+    monkeypatch.setenv("DB_BACKEND", "oracle")
+    with pytest.raises(ValueError):
+        pool.get_pool()
+
+
+def test_file_database_is_created_in_wal_mode(sqlite_backend):
+    with pool.get_pool().connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT version FROM table_versions WHERE name = %s", ("users",))
+        assert cursor.fetchone() == (0,)
+
+    assert sqlite_backend.exists()
+    check = sqlite3.connect(sqlite_backend)
+    assert check.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    indexes = {row[1] for row in check.execute("PRAGMA index_list(users)")}
+    assert {"uq_users_username", "ix_users_expired_gendate", "ix_users_expired_expires_at"} <= indexes
+    check.close()
+
+
+def test_login_on_sqlite_backend(sqlite_backend):
+    secret = pyotp.random_base32()
+    add_user("alice", "S3cret!password", secret)
+
+    result = authenticate_user.authenticate_user("alice", "S3cret!password", pyotp.TOTP(secret).now())
+
+    assert result["status"] == "success"
+    assert authenticate_user.authenticate_user("bob", "x", "123456") == authenticate_user.NOT_FOUND_RESULT
+
+
+def test_expiry_writes_on_sqlite_backend(sqlite_backend):
+    old = int(time.time()) - 200 * 24 * 3600
+    add_user("alice", "pw", pyotp.random_base32(), gendate=old)
+    add_user("bob", "pw", pyotp.random_base32(), gendate=old)
+
+    assert authenticate_user.write_expired(["alice"]) == 1
+    assert expire_credentials.sweep_expired(chunk_size=10)["rows_updated"] == 1
+
+    with pool.get_pool().connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE expired = 1")
+        assert cursor.fetchone() == (2,)
+        cursor.execute("SELECT version FROM table_versions WHERE name = 'users'")
+        assert cursor.fetchone() == (2,)
+
+
+def test_get_users_on_sqlite_backend(sqlite_backend):
+    for name in ("alice", "bob", "carol"):
+        add_user(name, "pw", pyotp.random_base32())
+
+    page = get_users.fetch_page(0, 2)
+
+    assert [row["username"] for row in page["users"]] == ["alice", "bob"]
+    assert page["next_cursor"] == page["users"][-1]["id"]
+    assert [row["username"] for row in json.loads(get_users.list_users())] == ["alice", "bob", "carol"]
+
+
+def test_async_pool_on_sqlite_backend(sqlite_backend):
+    async def scenario():
+        async with aiopool.connection() as conn:
+            await conn.begin()
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "INSERT INTO users (username, password, mfa, gendate) VALUES (%s, %s, %s, %s)",
+                    ("alice", "cA==", "bQ==", int(time.time())),
+                )
+            await conn.commit()
+        async with aiopool.read_connection(("alice",)) as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT username FROM users")
+                rows = await cursor.fetchall()
+        await aiopool.close_pool()
+        return rows
+
+    assert asyncio.run(scenario()) == [("alice",)]
+
+
+def test_statement_is_interrupted_at_the_deadline(sqlite_backend):
+    runaway = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT COUNT(*) FROM n"
+    token = deadline.start(0.05)
+    try:
+        with pytest.raises(deadline.DeadlineExceeded):
+            with pool.get_pool().connection() as conn, conn.cursor() as cursor:
+                cursor.execute(runaway)
+    finally:
+        deadline.reset(token)
@@ -0,0 +1,74 @@
+import importlib.util
+import json
+import os
+import sys
+import threading
+import pyotp
+
+# Load the benchmark stand-in database
+standin_path = os.path.abspath("bench/standin.py")
+spec = importlib.util.spec_from_file_location("standin", standin_path)
+standin = importlib.util.module_from_spec(spec)
+sys.modules["standin"] = standin
+spec.loader.exec_module(standin)
+
+# Load the authenticate-user handler under its own name, so that the
+# mock.patch targets of test_auth_user keep pointing at their module
+handler_path = os.path.abspath("authenticate-user/handler.py")
+spec = importlib.util.spec_from_file_location("standin_authenticate_user", handler_path)
+authenticate_user = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(authenticate_user)
+
+# -------------------- TESTS --------------------
+
+
+def test_seed_is_reproducible():
+    first = standin.StandInDatabase(users=5, seed=1)
+    second = standin.StandInDatabase(users=5, seed=1)
+    assert first.accounts == second.accounts
+    assert first.count() == 5
+
+
+def test_login_against_standin():
+    db = standin.StandInDatabase(users=20, seed=3)
+    db.install()
+    username, password, secret = db.accounts[7]
+
+    result = authenticate_user.handle(json.dumps({
+        "username": username, "password": password, "otp_code": pyotp.TOTP(secret).now()
+    }))
+
+    assert json.loads(result)["status"] == "success"
+    assert db.opened >= 1
+
+
+def test_concurrent_writers_take_turns():
+    db = standin.StandInDatabase(users=10, seed=4)
+    reader = db.connect()
+    reading = reader.cursor()
+    reading.execute("SELECT username FROM users")
+    reading.fetchone()  # a reader mid-scan must not lock the writers out
+    errors = []
+
+    def write(n):
+        conn = db.connect()
+        try:
+            for i in range(20):
+                with conn.cursor() as cursor:
+                    conn.begin()
+                    cursor.execute("UPDATE users SET gendate = gendate + 1 WHERE username = %s", (db.accounts[n][0],))
+                    cursor.execute("INSERT INTO credential_changes (username, changed_at) VALUES (%s, %s)", (str(n), i))
+                    conn.commit()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert db.count("SELECT COUNT(*) FROM credential_changes") == 80
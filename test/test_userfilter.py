@@ -0,0 +1,100 @@
+import importlib.util
+import os
+import sys
+from unittest import mock
+
+from common import credcache, pool, userfilter
+
+# Load the benchmark stand-in database
+standin_path = os.path.abspath("bench/standin.py")
+spec = importlib.util.spec_from_file_location("standin", standin_path)
+standin = importlib.util.module_from_spec(spec)
+sys.modules["standin"] = standin
+spec.loader.exec_module(standin)
+
+# -------------------- TESTS --------------------
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = userfilter.BloomFilter(5000, error_rate=0.01)
+    for i in range(5000):
+        bloom.add(f"user{i}")
+    assert all(f"user{i}" in bloom for i in range(5000))
+    false_positives = sum(f"other{i}" in bloom for i in range(20000))
+    assert false_positives < 20000 * 0.02
+
+
+def test_negative_cache_expires():
+    now = [0.0]
+    cache = userfilter.NegativeCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.add("ghost")
+    assert "ghost" in cache
+    now[0] = 11
+    assert "ghost" not in cache
+    for name in ("a", "b", "c"):
+        cache.add(name)
+    assert "a" not in cache and "c" in cache
+
+
+def test_rebuild_from_users_table():
+    db = standin.StandInDatabase(users=50, seed=3)
+    db.install()
+    known = userfilter.KnownUsers(pool.get_pool().connection)
+
+    assert known.might_exist("anybody")  # not built yet: everything may exist
+    assert known.rebuild()
+    known._next_refresh = float("inf")
+
+    assert all(known.might_exist(username) for username, _, _ in db.accounts)
+    assert not known.might_exist("mallory")
+    assert known.stats()["rejected"] == 1
+
+
+def test_rebuild_failure_keeps_everything_possible():
+    connection = mock.MagicMock(side_effect=Exception("DB down"))
+    known = userfilter.KnownUsers(connection)
+    assert not known.rebuild()
+    assert not known.ready
+    assert known.stats()["rebuild_failures"] == 1
+
+
+def test_missing_names_go_to_the_negative_cache():
+    known = userfilter.KnownUsers(mock.MagicMock(), refresh_interval=600)
+    known._next_refresh = float("inf")
+    known.record_missing("ghost")
+    assert not known.might_exist("ghost")
+    known.add("ghost")
+    assert known.might_exist("ghost")
+
+
+def test_published_changes_reach_the_filter(monkeypatch):
+    monkeypatch.setenv("USER_FILTER", "1")
+    known = userfilter.get_known_users()
+    known._filter = userfilter.BloomFilter(100)
+    known._next_refresh = float("inf")
+    assert not known.might_exist("newbie")
+
+    credcache.publish_invalidations(mock.MagicMock(), ["newbie"])
+
+    assert known.might_exist("newbie")
+
+
+def test_disabled_filter(monkeypatch):
+    monkeypatch.setenv("USER_FILTER", "0")
+    assert userfilter.get_known_users() is None
+
+
+def test_recent_names_survive_a_lagging_rebuild():
+    now = [0.0]
+    known = userfilter.KnownUsers(mock.MagicMock(), recent_window=10, clock=lambda: now[0])
+    known._scan = lambda: userfilter.BloomFilter(100)  # a replica that has not seen "newbie" yet
+    known.add("newbie")
+
+    assert known.rebuild()
+    known._next_refresh = float("inf")
+    assert known.might_exist("newbie")
+
+    now[0] = 11
+    assert known.rebuild()
+    known._next_refresh = float("inf")
+    assert not known.might_exist("newbie")
@@ -0,0 +1,51 @@
+from unittest import mock
+
+from common import versions
+
+# -------------------- TESTS --------------------
+
+
+def test_read_returns_etag():
+    cursor = mock.MagicMock()
+    cursor.fetchone.return_value = (12, 1700000000)
+
+    assert versions.read(cursor) == '"users-12-1700000000"'
+    cursor.execute.assert_called_once_with(versions.READ_SQL, ("users",))
+
+
+def test_read_without_counter_row():
+    cursor = mock.MagicMock()
+    cursor.fetchone.return_value = None
+    assert versions.read(cursor) is None
+
+
+def test_bump_uses_the_write_cursor():
+    cursor = mock.MagicMock()
+    versions.bump(cursor)
+    cursor.execute.assert_called_once_with(versions.BUMP_SQL, ("users",))
+
+
+def test_if_none_match():
+    tag = '"users-1-2"'
+    assert versions.if_none_match(tag, tag)
+    assert versions.if_none_match('"other", W/"users-1-2"', tag)
+    assert versions.if_none_match("*", tag)
+    assert not versions.if_none_match('"users-1-3"', tag)
+    assert not versions.if_none_match(None, tag)
+    assert not versions.if_none_match("*", None)
+
+
+def test_is_newer():
+    assert versions.is_newer('"users-8-1700000060"', '"users-7-1700000000"')
+    assert not versions.is_newer('"users-7-1700000000"', '"users-7-1700000000"')
+    # A recreated counter row restarts at a lower version, later in time
+    assert versions.is_newer('"users-1-1800000000"', '"users-9-1700000000"')
+    assert versions.is_newer('"users-1-1700000000"', None)
+    assert not versions.is_newer(None, '"users-1-1700000000"')
+
+
+def test_combine():
+    assert versions.combine(['"users-3-1700000000"', '"users-4-1700000060"']) == '"users-7-1700000060"'
+    assert versions.combine(['"users-3-1700000000"']) == '"users-3-1700000000"'
+    assert versions.combine(['"users-3-1700000000"', None]) is None
+    assert versions.combine([]) is None
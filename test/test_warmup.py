@@ -0,0 +1,74 @@
+import json
+import os
+import sys
+from unittest import mock
+from flask import Flask
+
+from common import lazy, metrics, pool, qr, warmup
+
+DB_ENV = {
+    "DB_HOST": "localhost",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_NAME": "test_db"
+}
+
+# -------------------- TESTS --------------------
+
+
+def test_lazy_module_imports_on_first_use():
+    sys.modules.pop("colorsys", None)
+    module = lazy.module("colorsys")
+    assert "colorsys" not in sys.modules
+    assert module.rgb_to_hsv(1.0, 0.0, 0.0) == (0.0, 1.0, 1.0)
+    assert "colorsys" in sys.modules
+
+
+def test_lazy_module_forwards_patches():
+    module = lazy.module("colorsys")
+    with mock.patch.object(module, "ONE_THIRD", 0.5):
+        assert sys.modules["colorsys"].ONE_THIRD == 0.5
+    assert module.ONE_THIRD == 1.0 / 3.0
+
+
+def test_qr_stack_is_not_imported_with_the_renderer():
+    assert isinstance(qr.qrcode, lazy.LazyModule)
+    assert isinstance(qr.Image, lazy.LazyModule)
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect")
+def test_warm_up_runs_requested_steps(mock_connect, monkeypatch):
+    monkeypatch.setenv("WARMUP_DB_CONNECTIONS", "2")
+    result = warmup.warm_up(["db", "qr", "totp"])
+
+    assert result["status"] == "ok"
+    assert list(result["steps"]) == ["db", "qr", "totp"]
+    assert mock_connect.call_count == 2
+    assert pool.get_pool().stats()["idle"] == 2
+
+
+@mock.patch.dict(os.environ, DB_ENV)
+@mock.patch("common.pool.pymysql.connect", side_effect=Exception("DB down"))
+def test_warm_up_reports_failed_steps(mock_connect):
+    result = warmup.warm_up(["db", "totp"])
+    assert result["status"] == "degraded"
+    assert result["errors"] == {"db": "DB down"}
+    assert "totp" in result["steps"]
+
+
+@warmup.hook("totp")
+@metrics.instrumented("test-warmup")
+def handle(req):
+    return "handled"
+
+
+def test_hook_serves_warmup_path():
+    app = Flask(__name__)
+    with app.test_request_context(warmup.WARMUP_PATH):
+        resp = handle(None)
+        assert resp.status_code == 200
+        assert json.loads(resp.get_data(as_text=True))["steps"].keys() == {"totp"}
+    with app.test_request_context("/", method="POST", data="{}"):
+        assert handle("{}").get_data(as_text=True) == "handled"
+    assert handle("{}") == "handled"
@@ -0,0 +1,125 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from common import metrics, writebehind
+
+# -------------------- TESTS --------------------
+
+
+class Recorder:
+    def __init__(self, fail=0):
+        self.batches = []
+        self.fail = fail
+        self.called = threading.Event()
+
+    def __call__(self, keys):
+        self.called.set()
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("database down")
+        self.batches.append(list(keys))
+
+
+def test_flushes_a_full_batch_without_waiting_for_the_timer():
+    flush = Recorder()
+    queue = writebehind.WriteBehindQueue(flush, max_batch=3, interval=60)
+    try:
+        for key in ("a", "b", "c", "d"):
+            queue.add(key)
+        assert flush.called.wait(5)
+        time.sleep(0.05)
+        assert flush.batches == [["a", "b", "c"]]
+        assert queue.stats()["pending"] == 1
+    finally:
+        queue.close()
+
+
+def test_flushes_on_the_timer():
+    flush = Recorder()
+    queue = writebehind.WriteBehindQueue(flush, max_batch=100, interval=0.05)
+    try:
+        queue.add("a")
+        queue.add("b")
+        assert flush.called.wait(5)
+        assert flush.batches == [["a", "b"]]
+    finally:
+        queue.close()
+
+
+def test_duplicates_are_coalesced():
+    flush = Recorder()
+    queue = writebehind.WriteBehindQueue(flush, max_batch=100, interval=60)
+    try:
+        for _ in range(5):
+            queue.add("alice")
+        assert queue.flush(timeout=5)
+        assert flush.batches == [["alice"]]
+        stats = queue.stats()
+        assert (stats["queued"], stats["coalesced"], stats["written"], stats["flushes"]) == (1, 4, 1, 1)
+    finally:
+        queue.close()
+
+
+def test_failed_flush_is_retried():
+    flush = Recorder(fail=1)
+    queue = writebehind.WriteBehindQueue(flush, max_batch=100, interval=0.05)
+    try:
+        queue.add("alice")
+        assert queue.flush(timeout=5)
+        assert flush.batches == [["alice"]]
+        stats = queue.stats()
+        assert (stats["failed"], stats["written"], stats["pending"]) == (1, 1, 0)
+    finally:
+        queue.close()
+
+
+def test_drops_keys_once_full():
+    queue = writebehind.WriteBehindQueue(Recorder(), max_batch=100, interval=60, max_pending=2)
+    try:
+        assert queue.add("a") and queue.add("b")
+        assert not queue.add("c")
+        assert queue.add("a")  # already pending
+        assert queue.stats()["dropped"] == 1
+    finally:
+        queue.close()
+
+
+def test_closed_queue_drops_pending_keys():
+    flush = Recorder()
+    queue = writebehind.WriteBehindQueue(flush, max_batch=100, interval=60)
+    queue.add("a")
+    queue.close()
+    assert not queue.add("b")
+    assert queue.flush(timeout=1)
+    assert flush.batches == []
+
+
+def test_get_queue_is_shared_and_exported(monkeypatch):
+    monkeypatch.setenv("WRITE_BEHIND_BATCH_SIZE", "7")
+    queue = writebehind.get_queue("expired", Recorder())
+    assert writebehind.get_queue("expired", Recorder()) is queue
+    assert queue.max_batch == 7
+
+    queue.add("alice")
+    exposition = metrics.REGISTRY.render()
+    assert 'cofrap_write_behind_pending{queue="expired"} 1' in exposition
+    assert 'cofrap_write_behind_events_total{queue="expired",event="queued"} 1' in exposition
+
+
+def test_pending_keys_are_flushed_on_sigterm():
+    # authenticate-user only imports `common.writebehind`: SIGTERM must still run the final flush
+    script = (
+        "import os, signal, time\n"
+        "from common import writebehind\n"
+        "queue = writebehind.get_queue('expired', lambda keys: print('flushed', sorted(keys), flush=True))\n"
+        "queue.add('alice')\n"
+        "os.kill(os.getpid(), signal.SIGTERM)\n"
+        "time.sleep(5)\n"
+    )
+    env = {**os.environ, "WRITE_BEHIND_INTERVAL": "60"}
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=30, env=env)
+    assert result.returncode == 0
+    assert "flushed ['alice']" in result.stdout